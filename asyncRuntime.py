@@ -0,0 +1,280 @@
+'''This Python script, asyncRuntime.py, provides the building blocks of the asynchronous runtime of the main client, in
+   which a single event loop reads the serial port, handles every frame, and keeps many database uploads in flight at
+   once, instead of a serial reader thread, a pool of upload worker threads and a sleeping thread per periodic task.
+   It is built on Trollius, the Python 2 port of asyncio. Coroutines are written as generators, waiting on other
+   coroutines with "yield From(...)" and returning values with "raise Return(...)".'''
+from collections import deque
+import serialPorts
+import uploadScheduler
+
+#The asynchronous runtime is optional, so the classic runtime keeps working on a Raspberry Pi without Trollius.
+try:
+    import trollius as asyncio
+    from trollius import From, Return
+    from concurrent.futures import ThreadPoolExecutor
+    coroutine = asyncio.coroutine
+except ImportError, e:
+    asyncio = None
+    From = lambda future: future
+    Return = StopIteration
+    coroutine = lambda function: function
+
+
+
+'''The function newLoop creates the event loop of the asynchronous runtime, and makes it the default event loop of the
+   calling thread. A RuntimeError is raised if Trollius is not installed.'''
+def newLoop():
+    if asyncio is None:
+        raise RuntimeError("The asynchronous runtime requires Trollius (pip install trollius)")
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    return loop
+
+
+
+'''The function sleep returns a coroutine which waits "seconds" seconds without holding up the event loop.'''
+def sleep(seconds):
+    return asyncio.sleep(seconds)
+
+
+
+'''The function gather returns a future which waits for every coroutine or future in "tasks", and holds the list of
+   their results in the same order.'''
+def gather(tasks):
+    return asyncio.gather(*tasks)
+
+
+
+'''The coroutine periodic calls "function" every "interval" seconds, forever. A call that fails is reported, rather
+   than stopping the runtime.'''
+@coroutine
+def periodic(interval, function):
+    while 1:
+        yield From(asyncio.sleep(interval))
+        try:
+            function()
+        except Exception, e:
+            print "Periodic task %s failed. Error: %s." %(getattr(function, "__name__", function), e)
+
+
+
+'''The asyncSerialSource class reads frames from the serial ports whenever the event loop reports a port readable, and
+   hands them to a handler one at a time, in the order they were read, as (port name, frame) pairs, or by weighted round
+   robin between the priority classes of uploadScheduler.py if they are given a priority function. It takes the place
+   of the serial reader threads and ingest pipeline of the classic runtime, and reports the same statistics. A port
+   which fails is no longer watched, and is reopened once its retry delay has passed, without holding up the others.'''
+class asyncSerialSource(object):
+
+    '''The asyncSerialSource properties are as follows:
+       ports is the serialPortSet of the serial ports to read.
+       loop is the event loop watching the serial ports.
+       queueSize is the greatest number of frames waiting to be handled. Once it is reached, the serial ports are no
+       longer watched until half of the waiting frames have been handled, so that the monitor nodes are held back by the
+       serial input buffers rather than frames being dropped.
+       priorityFunction returns the priority class of a frame, or is None to handle the frames in the order they were
+       read, and weights maps each priority class to its weight.'''
+    def __init__(self, ports, loop, queueSize=1000, priorityFunction=None, weights=None):
+        self.ports = ports
+        self.loop = loop
+        self.queueSize = queueSize
+        self.priorityFunction = priorityFunction
+        if priorityFunction:
+            self.frames = uploadScheduler.priorityQueues(weights)
+        else:
+            self.frames = deque()
+        self.waiter = None
+        self.reading = False
+        self.started = False
+        self.enqueued = 0
+        self.maxDepth = 0
+        self.pauses = 0
+        self.processed = 0
+        self.failed = 0
+
+    '''The start method starts watching every open serial port for input. When first called, it also schedules the
+       reopening of the ports which could not be opened.'''
+    def start(self):
+        for port in self.ports:
+            if (port.state == "open"):
+                self.loop.add_reader(port.ser.fileno(), self.readReady, port)
+            elif not self.started:
+                self.loop.call_later(port.retryIn(), self.reopen, port)
+        self.reading = True
+        self.started = True
+
+    '''The pause method stops watching the serial ports for input, until start is called again.'''
+    def pause(self):
+        for port in self.ports:
+            if (port.state == "open"):
+                self.loop.remove_reader(port.ser.fileno())
+        self.reading = False
+        self.pauses += 1
+
+    '''The readReady method is called by the event loop whenever the serial port "port" has input waiting. It reads
+       the frames waiting in the serial input buffer without blocking, and wakes up the handling coroutine. If the port
+       fails, it is no longer watched, and its reopening is scheduled.'''
+    def readReady(self, port):
+        try:
+            frames = port.ser.readWaiting()
+        except serialPorts.PORT_ERRORS, e:
+            self.loop.remove_reader(port.ser.fileno())
+            port.failed(e)
+            self.loop.call_later(port.retryIn(), self.reopen, port)
+            return
+        if self.priorityFunction:
+            for frame in frames:
+                self.frames.put(self.priorityFunction(frame), (port.name, frame))
+        else:
+            self.frames.extend([(port.name, frame) for frame in frames])
+        self.enqueued += len(frames)
+        if (len(self.frames) > self.maxDepth):
+            self.maxDepth = len(self.frames)
+        if (len(self.frames) >= self.queueSize) and self.reading:
+            self.pause()
+        if self.frames and (self.waiter is not None) and (not self.waiter.done()):
+            self.waiter.set_result(None)
+
+    '''The reopen method reopens the serial port "port" which has gone down, and watches it again, or schedules another
+       attempt once its retry delay has passed.'''
+    def reopen(self, port):
+        if not port.open():
+            self.loop.call_later(port.retryIn(), self.reopen, port)
+        elif self.reading:
+            self.loop.add_reader(port.ser.fileno(), self.readReady, port)
+
+    '''The coroutine get returns the next waiting (port name, frame) pair, waiting for one to arrive if necessary. With
+       priority classes, it also returns the (priority class, time queued) pair of the frame, and None otherwise.'''
+    @coroutine
+    def get(self):
+        while not self.frames:
+            self.waiter = asyncio.Future(loop=self.loop)
+            yield From(self.waiter)
+        taken = None
+        if self.priorityFunction:
+            (priority, queued, frame) = self.frames.take()
+            taken = (priority, queued)
+        else:
+            frame = self.frames.popleft()
+        if (not self.reading) and (len(self.frames) <= self.queueSize / 2):
+            self.start()
+        raise Return((frame, taken))
+
+    '''The coroutine serve passes every (port name, frame) pair to "handler", forever. A frame that cannot be handled
+       is discarded, rather than stopping the runtime.'''
+    @coroutine
+    def serve(self, handler):
+        while 1:
+            (message, taken) = yield From(self.get())
+            try:
+                handler(message)
+                self.processed += 1
+            except Exception, e:
+                print "Message handling failed. Error: %s. Discarded." %(e)
+                self.failed += 1
+            if taken:
+                self.frames.done(*taken)
+
+    '''The getStats method returns the number of frames waiting, queued, handled and failed so far, and the statistics
+       of the priority classes if there are any, in the same format as the getStats method of the ingest pipeline.'''
+    def getStats(self):
+        stats = {"depth": len(self.frames),
+                 "maxDepth": self.maxDepth,
+                 "enqueued": self.enqueued,
+                 "pauses": self.pauses,
+                 "processed": self.processed,
+                 "failed": self.failed}
+        if self.priorityFunction:
+            stats["classes"] = self.frames.getStats()
+        return stats
+
+
+
+'''The asyncDatabase class lets coroutines call the methods of a Pymongo Client (or of the in-memory fakePymongoClient)
+   without blocking the event loop. PyMongo itself is blocking, so each call is run by one of a fixed number of executor
+   threads, which do nothing but wait on the database server while the event loop carries on. Calls waiting for an
+   executor thread take their turn by weighted round robin between the priority classes of uploadScheduler.py, given by
+   the keyword argument "priority" of every method, so that an alert overtakes the bulk uploads and backup replay.'''
+class asyncDatabase(object):
+
+    '''The asyncDatabase properties are as follows:
+       client is the pymongoClient instance whose methods are called.
+       loop is the event loop which the results are delivered to.
+       maxInFlight is the number of database calls which can be in progress at once. Further calls wait their turn.
+       weights maps each priority class to its weight.'''
+    def __init__(self, client, loop, maxInFlight=16, weights=None):
+        self.client = client
+        self.loop = loop
+        self.slots = maxInFlight
+        self.executor = ThreadPoolExecutor(maxInFlight)
+        #waiting holds the future of every call waiting for its turn, in the queue of its priority class.
+        self.waiting = uploadScheduler.priorityQueues(weights)
+        self.inFlight = 0
+        self.maxInFlight = 0
+        self.calls = 0
+
+    '''The coroutine run calls function(*args) on an executor thread once it is its turn in the class given by the
+       keyword argument "priority", and returns its return value.'''
+    @coroutine
+    def run(self, function, *args, **options):
+        self.calls += 1
+        turn = asyncio.Future(loop=self.loop)
+        self.waiting.put(options.get("priority", uploadScheduler.DEFAULT_PRIORITY), turn)
+        self.nextTurns()
+        try:
+            yield From(turn)
+            result = yield From(self.loop.run_in_executor(self.executor, function, *args))
+        finally:
+            #The slot is taken as soon as the turn is given, even if the call is cancelled before it resumes.
+            if turn.done() and not turn.cancelled():
+                self.inFlight -= 1
+                self.waiting.done(*turn.result())
+                self.nextTurns()
+        raise Return(result)
+
+    '''The nextTurns method gives their turn to the waiting calls, by weighted round robin, while fewer than maxInFlight
+       calls are in progress.'''
+    def nextTurns(self):
+        while (self.inFlight < self.slots):
+            taken = self.waiting.take()
+            if taken is None:
+                return
+            (priority, queued, turn) = taken
+            if turn.done():
+                continue
+            self.inFlight += 1
+            if (self.inFlight > self.maxInFlight):
+                self.maxInFlight = self.inFlight
+            turn.set_result((priority, queued))
+
+    '''The coroutine call calls the client method "methodName" with the arguments args, and returns its return value.'''
+    def call(self, methodName, *args, **options):
+        return self.run(getattr(self.client, methodName), *args, **options)
+
+    '''The submit method starts a call of the client method "methodName" with the tuple of arguments args, without
+       waiting for it. Once the call is complete, resultCallback is called with its return value on the event loop, so
+       it can safely update the state of the main client. A call which raises an exception is reported, and its
+       resultCallback is called with None, as by the uploadScheduler.'''
+    def submit(self, methodName, args, resultCallback=None, priority=uploadScheduler.DEFAULT_PRIORITY):
+        task = asyncio.ensure_future(self.call(methodName, *args, priority=priority), loop=self.loop)
+        task.add_done_callback(lambda task: self.deliver(methodName, task, resultCallback))
+        return task
+
+    def deliver(self, methodName, task, resultCallback):
+        result = None
+        if task.cancelled():
+            print "Database call %s cancelled." %(methodName)
+        elif task.exception() is not None:
+            print "Database call %s failed. Error: %s." %(methodName, task.exception())
+        else:
+            result = task.result()
+        if resultCallback:
+            try:
+                resultCallback(result)
+            except Exception, e:
+                print "Database call result handling failed. Error: %s." %(e)
+
+    '''The getStats method returns the number of database calls made so far, the number currently in progress, the
+       largest number that have been in progress at once, and the statistics of every priority class.'''
+    def getStats(self):
+        return {"calls": self.calls, "inFlight": self.inFlight, "maxInFlight": self.maxInFlight,
+                "classes": self.waiting.getStats()}
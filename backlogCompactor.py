@@ -0,0 +1,174 @@
+'''This Python script, backlogCompactor.py, shrinks the backlog of per-minute usage data which builds up during a long
+   outage. The per-minute entries of each water meter falling within the same period (by default, the same hour) are
+   merged into one coarser entry, which keeps the first and last counter and the sum of the usage differences, in the
+   same form as the aggregate entries of rollupEngine.py. Month, day and hour data and error messages are never
+   merged, so the coarse series and the error log are replayed exactly as they were backed up. Neither is a per-minute
+   entry whose upload may have reached the server (after a timeout, or a failed checkpoint), as the merged entry has an
+   _id of its own and would count its usage a second time. Only the entries backed up as [dbStr, post, UNSENT], which
+   never left the Raspberry Pi, are merged.'''
+import time
+import serialProtocol
+import rollupEngine
+
+#The usage collections whose backed up entries are merged.
+COMPACTED_LEVELS = ["min"]
+#The mark of a backed up entry whose upload was refused by the circuit breaker, and so never reached the server.
+UNSENT = "unsent"
+
+
+
+'''The function postOf returns the usage data entry of the backed up entry "entry", which is either [dbStr, post],
+   [dbStr, post, UNSENT] or, as backed up by older versions of the main client, [dbStr, wmid, counter, diff, intTemp,
+   extTemp, timestamp, timestring].'''
+def postOf(entry):
+    if (len(entry) <= 3):
+        return entry[1]
+    return {"wmid": entry[1], "counter": entry[2], "diff": entry[3], "intTemp": entry[4], "extTemp": entry[5],
+            "timestamp": entry[6], "timestring": entry[7]}
+
+
+
+'''The mergedPost class accumulates usage data entries of one water meter within one period into a single entry.'''
+class mergedPost(object):
+    __slots__ = ["post", "samples", "tempSamples", "intTempSum", "extTempSum"]
+
+    def __init__(self, post):
+        self.post = None
+        self.samples = 0
+        self.tempSamples = [0, 0]
+        self.intTempSum = 0.0
+        self.extTempSum = 0.0
+        self.add(post)
+
+    '''The add method merges one usage data entry, raw or already merged, into the entry. Its counter, timestamp and
+       timestring become the latest of both, its first reading the earliest, and its diff, number of readings and number
+       of merged entries the sums of both. The temperatures are averaged over the readings.'''
+    def add(self, post):
+        first = (post.get("firstCounter", post["counter"]), post.get("firstTimestamp", post["timestamp"]),
+                 post.get("firstTimestring", post["timestring"]))
+        if self.post is None:
+            self.post = dict(post)
+            (self.post["firstCounter"], self.post["firstTimestamp"], self.post["firstTimestring"]) = first
+            self.post["diff"] = 0
+            self.post["merged"] = 0
+        else:
+            if (post["timestamp"] >= self.post["timestamp"]):
+                (self.post["counter"], self.post["timestamp"], self.post["timestring"]) = \
+                    (post["counter"], post["timestamp"], post["timestring"])
+            if (first[1] < self.post["firstTimestamp"]):
+                (self.post["firstCounter"], self.post["firstTimestamp"], self.post["firstTimestring"]) = first
+        samples = post.get("samples", 1)
+        self.samples += samples
+        self.post["diff"] += post["diff"]
+        self.post["merged"] += post.get("merged", 1)
+        for (index, name) in enumerate(["intTemp", "extTemp"]):
+            if (post[name] == serialProtocol.INVALID_TEMP):
+                continue
+            self.tempSamples[index] += samples
+            if (index == 0):
+                self.intTempSum += post[name] * samples
+            else:
+                self.extTempSum += post[name] * samples
+            (low, high) = (post.get(name + "Min", post[name]), post.get(name + "Max", post[name]))
+            if (self.tempSamples[index] > samples) and (self.post.get(name + "Min") is not None):
+                (low, high) = (min(low, self.post[name + "Min"]), max(high, self.post[name + "Max"]))
+            (self.post[name + "Min"], self.post[name + "Max"]) = (low, high)
+
+    '''The toPost method returns the merged usage data entry.'''
+    def toPost(self):
+        post = dict(self.post)
+        post["samples"] = self.samples
+        (post["intTemp"], post["extTemp"]) = (serialProtocol.INVALID_TEMP, serialProtocol.INVALID_TEMP)
+        if self.tempSamples[0]:
+            post["intTemp"] = round(self.intTempSum / self.tempSamples[0], 2)
+        if self.tempSamples[1]:
+            post["extTemp"] = round(self.extTempSum / self.tempSamples[1], 2)
+        return post
+
+
+
+'''The backlogCompactor class decides when the backlog is due to be compacted, and merges the per-minute entries of a
+   part of the backlog.'''
+class backlogCompactor(object):
+
+    '''The backlogCompactor properties are as follows:
+       span is the period, out of rollupEngine.WINDOW_LENGTHS, within which the per-minute entries of a water meter are
+       merged, in local time as the timestamp decoder uses.
+       maxEntries and maxAge are the thresholds of compaction: the backlog is due to be compacted once more than
+       maxEntries per-minute entries have been backed up since it was last compacted, or the oldest of them is more
+       than maxAge milliseconds old. Short outages stay below both, so their per-minute data is replayed in full.'''
+    def __init__(self, span="hour", maxEntries=10000, maxAge=3600000):
+        if span not in rollupEngine.WINDOW_LENGTHS:
+            raise ValueError("Unknown compaction span: %s" %(span))
+        self.span = span
+        self.maxEntries = maxEntries
+        self.maxAge = maxAge
+        #The number and oldest timestamp of the per-minute entries backed up since the last compaction.
+        self.uncompacted = 0
+        self.oldest = None
+        self.stats = {"passes": 0, "merged": 0, "written": 0}
+
+    '''The compactable method returns whether the backed up entry "entry" may be merged: a per-minute entry marked as
+       UNSENT.'''
+    def compactable(self, entry):
+        return (entry[0] in COMPACTED_LEVELS) and (len(entry) == 3) and (entry[2] == UNSENT)
+
+    '''The track method counts the backed up entry "entry" towards the thresholds, if it may be merged.'''
+    def track(self, entry):
+        if self.compactable(entry):
+            self.uncompacted += 1
+            timestamp = postOf(entry)["timestamp"]
+            if (self.oldest is None) or (timestamp < self.oldest):
+                self.oldest = timestamp
+
+    '''The due method returns whether the backlog is due to be compacted at the Epoch time timeNow, in milliseconds.'''
+    def due(self, timeNow):
+        if (self.uncompacted > self.maxEntries):
+            return True
+        return (self.oldest is not None) and (timeNow - self.oldest > self.maxAge)
+
+    '''The compact method merges the per-minute entries of the list of (key, entry) pairs "items", and returns the
+       resulting list of (key, entry) pairs, in the order of "items". A merged entry takes the key and the place of the
+       last of its members. An entry which may not be merged, or has nothing to be merged with, is returned as it is.'''
+    def compact(self, items):
+        result = []
+        #groups maps each (dbStr, water meter ID, period) to [last index, last key, members, mergedPost, first entry].
+        groups = {}
+        for (index, (key, entry)) in enumerate(items):
+            if not self.compactable(entry):
+                result.append((index, key, entry))
+                continue
+            post = postOf(entry)
+            group = (entry[0], post["wmid"], self.periodOf(post["timestamp"]))
+            if group in groups:
+                groups[group][3].add(post)
+                groups[group][0:3] = [index, key, groups[group][2] + 1]
+            else:
+                groups[group] = [index, key, 1, mergedPost(post), entry]
+        for ((dbStr, wmid, period), (index, key, members, merged, entry)) in groups.items():
+            if (members > 1):
+                entry = [dbStr, merged.toPost(), UNSENT]
+            result.append((index, key, entry))
+        result.sort(key=lambda item: item[0])
+        self.stats["merged"] += len(items) - len(result)
+        return [(key, entry) for (index, key, entry) in result]
+
+    '''The compacted method resets the thresholds once the whole backlog has been compacted, with "written" merged and
+       unchanged entries written back.'''
+    def compacted(self, written):
+        self.uncompacted = 0
+        self.oldest = None
+        self.stats["passes"] += 1
+        self.stats["written"] += written
+
+    '''The periodOf method returns the tuple of period integers of the span holding the Epoch time "timestamp", in
+       milliseconds.'''
+    def periodOf(self, timestamp):
+        return tuple(time.localtime(timestamp / 1000.0)[:rollupEngine.WINDOW_LENGTHS[self.span]])
+
+    '''The getStats method returns the number of compaction passes, the number of entries they have merged away and
+       written back, and the per-minute entries backed up since the last pass.'''
+    def getStats(self):
+        stats = dict(self.stats)
+        stats["uncompacted"] = self.uncompacted
+        return stats
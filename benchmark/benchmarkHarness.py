@@ -0,0 +1,173 @@
+'''This Python script, benchmarkHarness.py, provides the measuring instruments of the benchmark: timers which add up the
+   time and CPU time spent in each stage of the main client (reading the serial port, handling frames, calling the
+   database), recorders of latency samples and their percentiles, a database stand-in which measures how long each
+   usage data entry took to reach it, and a sampler of the depth of the ingest pipeline.'''
+import os
+import sys
+import time
+import threading
+import resource
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fakeDatabase
+
+#The getrusage argument for the calling thread alone. It is only available on Linux, and not named by Python 2.
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1 if sys.platform.startswith("linux") else None)
+
+
+
+'''The function threadCPU returns the CPU time, in seconds, used so far by the calling thread, or by the whole process
+   where the thread's own CPU time is not available.'''
+def threadCPU():
+    if RUSAGE_THREAD is not None:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    else:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+
+'''The function percentiles returns the values of "samples" at each of the percentiles "points", in a dictionary keyed
+   by "p50", "p90" and so on, or an empty dictionary if there are no samples.'''
+def percentiles(samples, points=(50, 90, 99)):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return dict([("p%s" %(point), round(ordered[min(int(len(ordered) * point / 100.0), len(ordered) - 1)], 6))
+                 for point in points] + [("max", round(ordered[-1], 6))])
+
+
+
+'''The latencyRecorder class collects latency samples, in seconds, from any number of threads.'''
+class latencyRecorder(object):
+    def __init__(self):
+        self.samples = []
+        self.recorderLock = threading.Lock()
+
+    def add(self, sample):
+        self.recorderLock.acquire()
+        self.samples.append(sample)
+        self.recorderLock.release()
+
+    '''The getStats method returns the number of samples, their mean, and their percentiles.'''
+    def getStats(self):
+        self.recorderLock.acquire()
+        samples = list(self.samples)
+        self.recorderLock.release()
+        stats = {"count": len(samples)}
+        if samples:
+            stats["mean"] = round(sum(samples) / len(samples), 6)
+            stats.update(percentiles(samples))
+        return stats
+
+
+
+'''The stageTimer class adds up the number of calls, the elapsed time and the CPU time of the functions it wraps, which
+   together make up one stage of the main client. Stages may nest: the frame handling stage of the classic runtime
+   includes the database calls made by the upload workers. The kernel counts thread CPU time in clock ticks, so the CPU
+   time of a single short call is either zero or a whole tick, but the total over a run of many calls is a fair
+   estimate. The elapsed time of the read stage includes the time spent waiting for input.'''
+class stageTimer(object):
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.timerLock = threading.Lock()
+        self.latency = latencyRecorder()
+
+    '''The wrap method returns a function which calls "function" and counts the call towards this stage.'''
+    def wrap(self, function):
+        def timed(*args, **kwargs):
+            (wallStart, cpuStart) = (time.time(), threadCPU())
+            try:
+                return function(*args, **kwargs)
+            finally:
+                (wall, cpu) = (time.time() - wallStart, threadCPU() - cpuStart)
+                self.timerLock.acquire()
+                self.calls += 1
+                self.wall += wall
+                self.cpu += cpu
+                self.timerLock.release()
+                self.latency.add(wall)
+        return timed
+
+    '''The getStats method returns the number of calls, the elapsed and CPU time in seconds, and the percentiles of the
+       elapsed time per call.'''
+    def getStats(self):
+        return {"calls": self.calls, "wallSeconds": round(self.wall, 3), "cpuSeconds": round(self.cpu, 3),
+                "callLatency": self.latency.getStats()}
+
+
+
+'''The timedClient class wraps a database client so that every call of one of its methods is counted towards a
+   stageTimer, and recorded per method.'''
+class timedClient(object):
+    def __init__(self, client, stage):
+        self.client = client
+        self.stage = stage
+        self.methods = {}
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+        if name not in self.methods:
+            self.methods[name] = stageTimer(name)
+        return self.stage.wrap(self.methods[name].wrap(attribute))
+
+    '''The getStats method returns the statistics of every method called so far, by method name.'''
+    def getStats(self):
+        return dict([(name, timer.getStats()) for (name, timer) in self.methods.items()])
+
+
+
+'''The benchDatabase class is an in-memory fakePymongoClient which also measures the upload latency of the usage data:
+   the time from a usage frame being sent by the fakeMonitorNode to its usage data entry being stored. The emitted
+   dictionary of the fakeMonitorNode gives the sending time of each (node ID, counter, timestring), and nodeIDs maps
+   each water meter ID back to its node ID.'''
+class benchDatabase(fakeDatabase.fakePymongoClient):
+    def __init__(self, latency=0.0, meters=None, emitted=None, health=None):
+        fakeDatabase.fakePymongoClient.__init__(self, latency, meters, health)
+        self.emitted = emitted if (emitted is not None) else {}
+        self.nodeIDs = dict([(entry["wmid"], entry["nodeid"]) for entry in (meters or [])])
+        self.uploadLatency = latencyRecorder()
+
+    def insert(self, name, posts):
+        stored = fakeDatabase.fakePymongoClient.insert(self, name, posts)
+        now = time.time()
+        for post in stored:
+            sent = self.emitted.get((self.nodeIDs.get(post.get("wmid")), post.get("counter"), post.get("timestring")))
+            if sent is not None:
+                self.uploadLatency.add(now - sent)
+        return stored
+
+
+
+'''The depthSampler class is a thread object which samples the depth of the ingest pipeline every "interval" seconds,
+   until stopped.'''
+class depthSampler(threading.Thread):
+    def __init__(self, getDepth, interval=0.1):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.getDepth = getDepth
+        self.interval = interval
+        self.samples = []
+        self.running = True
+
+    def run(self):
+        while self.running:
+            self.samples.append(self.getDepth())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+
+    '''The getStats method returns the number of samples, the mean and greatest depth, and the depth percentiles.'''
+    def getStats(self):
+        samples = list(self.samples)
+        stats = {"samples": len(samples)}
+        if samples:
+            stats["mean"] = round(float(sum(samples)) / len(samples), 2)
+            stats.update(percentiles(samples))
+        return stats
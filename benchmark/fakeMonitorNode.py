@@ -0,0 +1,178 @@
+'''This Python script, fakeMonitorNode.py, emulates a water usage monitor node and the measurement nodes of its network
+   on a pseudo-terminal (pty). The main client opens the pty's device as it would open the Raspberry Pi's UART, and
+   receives usage, error, key_req and time_req frames at the configured rates, with the configured timestamp pattern
+   and share of corrupted frames. The replies written back by the main client are read and counted.'''
+import os
+import tty
+import time
+import random
+import select
+import threading
+from datetime import datetime, timedelta
+
+'''The timestamp patterns of the usage frames. "realtime" stamps every frame with the current time. "accelerated" gives
+   the n-th reading of every meter the time n * timeStep seconds after the start, so the periods (minutes, hours, days)
+   change much faster than in real time. "jitter" shifts the current time by up to timeStep seconds either way, so
+   readings arrive out of order.'''
+TIMESTAMP_PATTERNS = ["realtime", "accelerated", "jitter"]
+'''The kinds of corruption applied to a corrupted frame: an invalid character, a missing field, a field which is not
+   hexadecimal, or a node ID from outside the network.'''
+CORRUPTIONS = ["character", "field", "hex", "node"]
+#The error codes of the error frames: Security Pin Disconnect, No Usage, Leakage and Decrement.
+ERROR_CODES = ["00", "01", "10", "11"]
+
+
+'''The fakeMonitorNode class holds the pty of the emulated monitor node, the state of its emulated water meters, and
+   the counts of the frames sent and replies received.'''
+class fakeMonitorNode(object):
+
+    '''The fakeMonitorNode properties are as follows:
+       nodeIDs is the list of node IDs of the emulated measurement nodes.
+       usageRate is the number of usage frames each measurement node sends per second.
+       errorRate, keyRate and timeRate are the numbers of error, key_req and time_req frames sent per second, across
+       the whole network.
+       pattern is one of the TIMESTAMP_PATTERNS, and timeStep its step in seconds.
+       corruption is the share of frames corrupted, between 0 and 1.
+       seed makes the generated frames repeatable.'''
+    def __init__(self, nodeIDs, usageRate=1.0, errorRate=0.0, keyRate=0.0, timeRate=0.0, pattern="realtime",
+                 timeStep=60, corruption=0.0, seed=None):
+        if pattern not in TIMESTAMP_PATTERNS:
+            raise ValueError("Unknown timestamp pattern: %s" %(pattern))
+        self.nodeIDs = list(nodeIDs)
+        self.rates = [("usage", usageRate * len(self.nodeIDs)), ("error", errorRate), ("key_req", keyRate),
+                      ("time_req", timeRate)]
+        self.totalRate = sum([rate for (frameType, rate) in self.rates])
+        self.pattern = pattern
+        self.timeStep = timeStep
+        self.corruption = corruption
+        self.random = random.Random(seed)
+        (self.master, self.slave) = os.openpty()
+        tty.setraw(self.slave)
+        #device is the path the main client opens as its serial port.
+        self.device = os.ttyname(self.slave)
+        self.counters = dict([(nodeID, self.random.randint(0, 100000)) for nodeID in self.nodeIDs])
+        self.readings = dict([(nodeID, 0) for nodeID in self.nodeIDs])
+        self.nextNode = 0
+        self.startTime = None
+        self.stopTime = None
+        #emitted maps the (node ID, counter, timestring) of every usage frame sent to the time it was sent.
+        self.emitted = {}
+        self.sent = dict([(frameType, 0) for (frameType, rate) in self.rates])
+        self.corrupted = 0
+        self.replies = {}
+        self.running = False
+        self.threads = []
+
+    '''The begin method starts sending frames, and reading the replies of the main client.'''
+    def begin(self):
+        self.running = True
+        self.startTime = time.time()
+        self.threads = [threading.Thread(target=self.sendFrames), threading.Thread(target=self.readReplies)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    '''The stop method stops sending frames, and waits for the sending and reading threads to finish.'''
+    def stop(self):
+        self.running = False
+        self.stopTime = time.time()
+        for thread in self.threads:
+            thread.join()
+
+    '''The timestring method returns the 14-digit timestamp of the next usage frame of the node nodeID.'''
+    def timestring(self, nodeID, now):
+        stamp = datetime.fromtimestamp(now)
+        if (self.pattern == "accelerated"):
+            stamp = datetime.fromtimestamp(self.startTime) + timedelta(seconds=self.readings[nodeID] * self.timeStep)
+        elif (self.pattern == "jitter"):
+            stamp += timedelta(seconds=self.random.randint(-self.timeStep, self.timeStep))
+        return stamp.strftime("%Y%m%d%H%M%S")
+
+    '''The usageFrame method returns the next usage frame of the next measurement node, in turn.'''
+    def usageFrame(self, now):
+        nodeID = self.nodeIDs[self.nextNode]
+        self.nextNode = (self.nextNode + 1) % len(self.nodeIDs)
+        diff = self.random.choice([0, 0, 1, 2, 3])
+        self.counters[nodeID] += diff
+        timestring = self.timestring(nodeID, now)
+        self.readings[nodeID] += 1
+        self.emitted.setdefault((nodeID, self.counters[nodeID], timestring), now)
+        return "usage,%x,%x,%x,%x,%x,%s" %(nodeID, self.counters[nodeID], diff, self.random.randint(15, 25),
+                                           self.random.randint(5, 30), timestring)
+
+    '''The errorFrame method returns an error frame of a random measurement node.'''
+    def errorFrame(self, now):
+        nodeID = self.random.choice(self.nodeIDs)
+        timestring = datetime.fromtimestamp(now).strftime("%Y%m%d%H%M%S")
+        return "error,%x,%x,%x,%s,%s,%s" %(nodeID, self.counters[nodeID], self.counters[nodeID], timestring,
+                                           timestring, self.random.choice(ERROR_CODES))
+
+    '''The corrupt method returns the frame with one of the CORRUPTIONS applied.'''
+    def corrupt(self, frame):
+        kind = self.random.choice(CORRUPTIONS)
+        fields = frame.split(",")
+        if (kind == "character"):
+            position = self.random.randint(0, len(frame) - 1)
+            return frame[:position] + "#" + frame[position + 1:]
+        elif (kind == "field") and (len(fields) > 1):
+            return ",".join(fields[:-1])
+        elif (kind == "hex") and (len(fields) > 2):
+            return ",".join(fields[:2] + ["zz"] + fields[3:])
+        elif (len(fields) > 1):
+            return ",".join(fields[:1] + ["%x" %(max(self.nodeIDs) + 1)] + fields[2:])
+        return frame + "#"
+
+    '''The nextFrame method returns the next frame to send, of a type drawn in proportion to the configured rates.'''
+    def nextFrame(self, now):
+        draw = self.random.uniform(0, self.totalRate)
+        for (frameType, rate) in self.rates:
+            if (draw < rate):
+                break
+            draw -= rate
+        self.sent[frameType] += 1
+        if (frameType == "usage"):
+            frame = self.usageFrame(now)
+        elif (frameType == "error"):
+            frame = self.errorFrame(now)
+        else:
+            frame = frameType
+        if self.corruption and (self.random.random() < self.corruption):
+            self.corrupted += 1
+            frame = self.corrupt(frame)
+        return frame
+
+    '''The sendFrames method sends the frames which have fallen due every 10 milliseconds, until stopped. A write to
+       the pty blocks once the main client falls behind, as the serial port would hold back the monitor node.'''
+    def sendFrames(self):
+        due = 0.0
+        while self.running:
+            now = time.time()
+            due += self.totalRate * 0.01
+            count = int(due)
+            due -= count
+            if count:
+                data = "".join([";%s;\n" %(self.nextFrame(now)) for i in range(count)])
+                while data:
+                    data = data[os.write(self.master, data):]
+            time.sleep(max(0.01 - (time.time() - now), 0))
+
+    '''The readReplies method reads and counts the replies of the main client by type, until stopped.'''
+    def readReplies(self):
+        buffered = ""
+        while self.running:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            buffered += os.read(self.master, 4096)
+            frames = buffered.replace("\n", ";").split(";")
+            buffered = frames.pop()
+            for frame in frames:
+                if frame:
+                    replyType = frame.split(",")[0]
+                    self.replies[replyType] = self.replies.get(replyType, 0) + 1
+
+    '''The getStats method returns the number of frames sent by type, the number corrupted, the frames sent per second,
+       and the number of replies received by type.'''
+    def getStats(self):
+        elapsed = max((self.stopTime or time.time()) - self.startTime, 0.001)
+        return {"sent": dict(self.sent), "corrupted": self.corrupted, "meters": len(self.nodeIDs),
+                "framesPerSecond": round(sum(self.sent.values()) / elapsed, 1), "replies": dict(self.replies)}
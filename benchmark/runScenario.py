@@ -0,0 +1,258 @@
+'''This Python script, runScenario.py, runs the benchmark scenarios of the main client. Each scenario runs the real main
+   client, in a process of its own, against a fakeMonitorNode on a pty and a benchDatabase held in memory, for a given
+   number of seconds. It then appends one line of JSON with the settings and measured results to the results file:
+   frames sent and handled per second, upload latency percentiles, ingest pipeline depth, and the time and CPU time
+   spent reading, handling and uploading. Comparing the lines of successive runs shows any regression.
+
+   Usage: python benchmark/runScenario.py [scenario ...] [--duration SECONDS] [--output PATH]
+   Without scenario names, every scenario is run. --list lists the scenarios.'''
+import os
+import sys
+import json
+import time
+import shutil
+import threading
+import platform
+import tempfile
+import subprocess
+import argparse
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+'''The default settings of a scenario:
+   meters is the number of emulated water meters, each sending usageRate usage frames per second.
+   errorRate, keyRate and timeRate are the error, key_req and time_req frames per second across the network.
+   pattern and timeStep are the timestamp pattern of the usage frames, and corruption the share of corrupted frames.
+   latency is the number of seconds every database call takes.
+   runtime is the runtime of the main client, "classic" or "async".
+   outage is None, or the pair (start, length) in seconds of a database outage during the run.
+   options maps global settings of mainClient.py (such as ROLLUP_ENABLED or UPLOAD_WORKERS) to the values to use. They
+   are set once mainClient.py has been imported, so the settings in IMPORT_TIME_OPTIONS, which are only read while it
+   is imported, are rejected.'''
+DEFAULTS = {"meters": 50, "usageRate": 1.0, "errorRate": 0.0, "keyRate": 0.0, "timeRate": 0.0, "pattern": "realtime",
+            "timeStep": 60, "corruption": 0.0, "latency": 0.005, "runtime": "classic", "outage": None, "options": {}}
+#The settings of mainClient.py which build its module globals (the spool, compactor, heartbeat evaluator, deadband
+#filter, rollup engine, circuit breaker and database client) when it is imported, and the runtime, chosen by "runtime".
+IMPORT_TIME_OPTIONS = ["MONGO_IP", "BUCKET_SPANS", "SECOND_DATA", "SERIAL_PORTS", "SERIAL_RETRY", "SERIAL_MAX_RETRY",
+                       "DB_FAILURE_THRESHOLD", "DB_RETRY", "DB_MAX_RETRY", "SPOOL_MEMORY", "SPOOL_SPILL",
+                       "SPOOL_MEMORY_AGE", "SPOOL_DIR", "SPOOL_MAX_BYTES", "SPOOL_DOWNSAMPLE_AT",
+                       "SPOOL_DOWNSAMPLE_FACTOR", "COMPACT_ENABLED", "COMPACT_SPAN", "COMPACT_ENTRIES", "COMPACT_AGE",
+                       "TIME_THRESHOLD", "OFFLINE_THRESHOLD", "STILL_DOWN_INTERVAL", "HEARTBEAT_THRESHOLDS",
+                       "HEARTBEAT_VECTORIZED", "CONFIG_NAME", "ROLLUP_GRANULARITIES", "ROLLUP_GRACE",
+                       "DEADBAND_TEMP_TOLERANCE", "DEADBAND_MAX_SILENCE", "DEADBAND_BOUNDARY", "RUNTIME_MODE"]
+#The scenarios, each given by the settings which differ from DEFAULTS.
+SCENARIOS = {
+    "baseline": {},
+    "async": {"runtime": "async"},
+    "manyMeters": {"meters": 1000, "usageRate": 0.2},
+    "manyMetersAsync": {"meters": 1000, "usageRate": 0.2, "runtime": "async"},
+    "slowDatabase": {"meters": 200, "latency": 0.05},
+    "slowDatabaseAsync": {"meters": 200, "latency": 0.05, "runtime": "async"},
+    "accelerated": {"meters": 100, "pattern": "accelerated", "timeStep": 60},
+    "mixedTraffic": {"meters": 100, "errorRate": 2.0, "keyRate": 0.5, "timeRate": 0.5, "pattern": "jitter",
+                     "timeStep": 5, "corruption": 0.05},
+    "outage": {"meters": 100, "pattern": "accelerated", "outage": (5, 5)},
+    "deadband": {"options": {"DEADBAND_ENABLED": True}},
+    "rollup": {"options": {"ROLLUP_ENABLED": True}},
+    "rollupAccelerated": {"meters": 100, "pattern": "accelerated", "options": {"ROLLUP_ENABLED": True}},
+    "pipelined": {"meters": 200, "latency": 0.05, "options": {"WRITE_CONCERN": "pipelined", "CHECKPOINT_AGE": 1.0}},
+    "pipelinedAsync": {"meters": 200, "latency": 0.05, "runtime": "async",
+                       "options": {"WRITE_CONCERN": "pipelined", "CHECKPOINT_AGE": 1.0}},
+    "pipelinedOutage": {"meters": 100, "pattern": "accelerated", "outage": (5, 5),
+                        "options": {"WRITE_CONCERN": "pipelined", "CHECKPOINT_AGE": 1.0}},
+    "alertsUnderLoad": {"meters": 200, "latency": 0.05, "errorRate": 5.0, "outage": (5, 5)},
+    "alertsUnderLoadAsync": {"meters": 200, "latency": 0.05, "errorRate": 5.0, "outage": (5, 5), "runtime": "async"},
+}
+#The number of seconds the main client is given to empty its queues and batches once the fake monitor node stops.
+DRAIN_TIME = 5.0
+
+
+
+'''The function settingsOf returns the complete settings of the scenario "name".'''
+def settingsOf(name):
+    settings = dict(DEFAULTS)
+    settings.update(SCENARIOS[name])
+    return settings
+
+
+
+'''The function revision returns the short git revision of the repository, or None if it cannot be found.'''
+def revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                                       stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError), e:
+        return None
+
+
+
+'''The function runScenario runs the scenario "name" in this process for "duration" seconds, and returns its results.
+   The main client runs in a scratch directory, which holds its configuration file, spool and log. It can only be run
+   once per process, as the main client keeps its state in module globals and its threads never stop.'''
+def runScenario(name, duration):
+    settings = settingsOf(name)
+    workDir = tempfile.mkdtemp(prefix="bench-")
+    os.chdir(workDir)
+    import configStore
+    import serialPorts
+    import benchmarkHarness
+    import fakeMonitorNode
+    configStore.writeConfig("config.txt", configStore.configValues(60, 10, 3, "0123456789abcdef", "bench"))
+    import mainClient
+
+    for (option, value) in settings["options"].items():
+        if not hasattr(mainClient, option):
+            raise ValueError("Unknown mainClient option: %s" %(option))
+        if option in IMPORT_TIME_OPTIONS:
+            raise ValueError("mainClient option %s is read at import, and cannot be set by a scenario" %(option))
+        setattr(mainClient, option, value)
+
+    nodeIDs = range(0x1000, 0x1000 + settings["meters"])
+    meterEntries = [{"nodeid": nodeID, "wmid": 1000000 + nodeID, "nwid": "bench", "status": True}
+                    for nodeID in nodeIDs]
+    node = fakeMonitorNode.fakeMonitorNode(nodeIDs, settings["usageRate"], settings["errorRate"], settings["keyRate"],
+                                           settings["timeRate"], settings["pattern"], settings["timeStep"],
+                                           settings["corruption"], seed=1)
+    database = benchmarkHarness.benchDatabase(settings["latency"], meterEntries, node.emitted, mainClient.health)
+    stages = dict([(stage, benchmarkHarness.stageTimer(stage)) for stage in ["read", "handle", "upload"]])
+
+    #Wire the main client to the fake monitor node and the in-memory database, with every stage timed.
+    mainClient.dbClient = benchmarkHarness.timedClient(database, stages["upload"])
+    mainClient.ports = serialPorts.serialPortSet([("bench", node.device)])
+    mainClient.ports.connect()
+    for port in mainClient.ports:
+        port.ser.readFrames = stages["read"].wrap(port.ser.readFrames)
+        port.ser.readWaiting = stages["read"].wrap(port.ser.readWaiting)
+    mainClient.protocol.dispatch = stages["handle"].wrap(mainClient.protocol.dispatch)
+    mainClient.config.load()
+    mainClient.networkID = "bench"
+    timeNow = long(1000*time.time())
+    for entry in meterEntries:
+        mainClient.meters.add(entry["nodeid"], entry["wmid"], entry["status"])
+        mainClient.nodeList.append(entry["nodeid"])
+        mainClient.scheduler.register(entry["nodeid"], None, True, timeNow)
+    mainClient.spool.connect()
+
+    log = open("mainClient.log", "w")
+    (stdout, sys.stdout) = (sys.stdout, log)
+    try:
+        if (settings["runtime"] == "async"):
+            runner = threading.Thread(target=mainClient.runAsync)
+        else:
+            runner = threading.Thread(target=mainClient.runClassic)
+        runner.daemon = True
+        runner.start()
+        while mainClient.pipeline is None:
+            time.sleep(0.01)
+
+        sampler = benchmarkHarness.depthSampler(lambda: mainClient.pipeline.getStats()["depth"])
+        cpuStart = os.times()
+        start = time.time()
+        node.begin()
+        sampler.start()
+        if settings["outage"]:
+            (outageStart, outageLength) = settings["outage"]
+            time.sleep(min(outageStart, duration))
+            database.online = False
+            time.sleep(min(outageLength, max(duration - outageStart, 0)))
+            database.online = True
+            time.sleep(max(duration - outageStart - outageLength, 0))
+        else:
+            time.sleep(duration)
+        node.stop()
+
+        #Let the main client empty its queues and upload its pending batches.
+        drainEnd = time.time() + DRAIN_TIME
+        while (mainClient.pipeline.getStats()["depth"] > 0) and (time.time() < drainEnd):
+            time.sleep(0.05)
+        time.sleep(2 * mainClient.BATCH_AGE)
+        if (mainClient.WRITE_CONCERN == "pipelined"):
+            #Let the last checkpoint confirm the entries sent while draining.
+            time.sleep(mainClient.CHECKPOINT_AGE + mainClient.BATCH_AGE)
+        elapsed = time.time() - start
+        cpuEnd = os.times()
+        sampler.stop()
+    finally:
+        sys.stdout = stdout
+        log.close()
+
+    pipelineStats = mainClient.pipeline.getStats()
+    #Frames handled while draining count towards the sending time, so a client which keeps up handles what was sent.
+    sendTime = node.stopTime - node.startTime
+    cpuSeconds = (cpuEnd[0] - cpuStart[0]) + (cpuEnd[1] - cpuStart[1])
+    results = {"node": node.getStats(),
+               "framesPerSecond": {"sent": node.getStats()["framesPerSecond"],
+                                   "handled": round(pipelineStats["processed"] / sendTime, 1)},
+               "uploadLatency": database.uploadLatency.getStats(),
+               "queueDepth": sampler.getStats(),
+               "pipeline": pipelineStats,
+               "stages": dict([(stage, timer.getStats()) for (stage, timer) in stages.items()]),
+               "databaseCalls": mainClient.dbClient.getStats(),
+               "cpu": {"processSeconds": round(cpuSeconds, 3), "percent": round(100.0 * cpuSeconds / elapsed, 1)},
+               "protocol": mainClient.protocol.getStats(),
+               "ports": mainClient.ports.getStats(),
+               "database": database.getStats(),
+               "spool": mainClient.spool.getStats(),
+               "connection": mainClient.health.getStats(),
+               "writer": mainClient.usageWriter.getStats(),
+               "uploads": mainClient.database.getStats(),
+               "elapsedSeconds": round(elapsed, 3)}
+    os.chdir(REPO_DIR)
+    shutil.rmtree(workDir, ignore_errors=True)
+    return {"scenario": name, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "duration": duration,
+            "revision": revision(), "host": platform.node(), "python": platform.python_version(),
+            "settings": settings, "results": results}
+
+
+
+'''The function summary returns one line summing up the results of a scenario run.'''
+def summary(record):
+    results = record["results"]
+    return "%s: sent %s frames/s, handled %s frames/s, upload latency %s, max queue depth %s, CPU %s%%" \
+           %(record["scenario"], results["framesPerSecond"]["sent"], results["framesPerSecond"]["handled"],
+             results["uploadLatency"].get("p90", "n/a"), results["queueDepth"].get("max", "n/a"),
+             results["cpu"]["percent"])
+
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark scenarios of the main client.")
+    parser.add_argument("scenarios", nargs="*", help="the scenarios to run (default: all)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of traffic per scenario")
+    parser.add_argument("--output", default=os.path.join(BENCHMARK_DIR, "results.jsonl"),
+                        help="the file the results are appended to, one JSON line per scenario run")
+    parser.add_argument("--list", action="store_true", help="list the scenarios and their settings")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.list:
+        for name in sorted(SCENARIOS):
+            print "%s: %s" %(name, json.dumps(SCENARIOS[name], sort_keys=True))
+        sys.exit(0)
+
+    #A single scenario is run in this process, by the process started for it below.
+    if args.run:
+        record = runScenario(args.run, args.duration)
+        resultsFile = open(args.output, "a")
+        resultsFile.write(json.dumps(record, sort_keys=True) + "\n")
+        resultsFile.close()
+        print summary(record)
+        #The threads of the main client never stop, so the process is ended directly.
+        sys.stdout.flush()
+        os._exit(0)
+
+    names = args.scenarios or sorted(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: %s" %(name))
+    failed = 0
+    for name in names:
+        if subprocess.call([sys.executable, os.path.abspath(__file__), "--run", name, "--duration",
+                            str(args.duration), "--output", os.path.abspath(args.output)]) != 0:
+            print "%s: failed" %(name)
+            failed += 1
+    print "Results appended to %s" %(args.output)
+    sys.exit(1 if failed else 0)
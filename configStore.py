@@ -0,0 +1,179 @@
+'''This Python script, configStore.py, keeps the configuration values of this water usage monitoring network in memory.
+   The configuration file (config.txt) is read once, and watched for changes afterwards: whenever it is rewritten, the
+   new values are loaded and handed to every subscriber. The scripts that edit the configuration file write it through
+   writeConfig, which replaces the file atomically, so a reader never sees a half-written file.'''
+import os
+import time
+import threading
+
+
+'''The configValues class holds one complete set of configuration values of the network:
+   noUsage is the No Usage Threshold, in seconds.
+   leakInterval is the Leakage Check Interval, in minutes, and leakStreak the Leakage Continuation Threshold.
+   keyValue is the 16-digit hexadecimal Encryption Key.
+   networkID is the ID of this water usage network, or None if the file does not name it.
+   The values are never changed once created; a change of configuration produces a new configValues object.'''
+class configValues(object):
+    __slots__ = ["noUsage", "leakInterval", "leakStreak", "keyValue", "networkID"]
+
+    def __init__(self, noUsage, leakInterval, leakStreak, keyValue, networkID=None):
+        self.noUsage = noUsage
+        self.leakInterval = leakInterval
+        self.leakStreak = leakStreak
+        self.keyValue = keyValue
+        self.networkID = networkID
+
+    def __eq__(self, other):
+        return isinstance(other, configValues) and all([getattr(self, name) == getattr(other, name)
+                                                        for name in self.__slots__])
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return "configValues(NU=%s, LK=%s,%s, KY=%s, NWID=%s)" %(self.noUsage, self.leakInterval, self.leakStreak,
+                                                                self.keyValue, self.networkID)
+
+    '''The toText method returns the configuration values in the format of the configuration file.'''
+    def toText(self):
+        text = "NU,%s\n" %(str(self.noUsage).zfill(5))
+        text += "LK,%s,%s\n" %(str(self.leakInterval).zfill(2), str(self.leakStreak).zfill(2))
+        text += "KY,%s\n" %(self.keyValue)
+        if self.networkID is not None:
+            text += "NWID,%s\n" %(self.networkID)
+        return text
+
+
+
+'''The function parseConfig turns the text of a configuration file into a configValues object. Each line holds a key
+   (NU, LK, KY or NWID) followed by its values, separated by commas, in any order. A ValueError is raised if a value is
+   missing or malformed.'''
+def parseConfig(text):
+    fields = {}
+    for line in text.splitlines():
+        values = line.strip().split(",")
+        if values[0]:
+            fields[values[0]] = values[1:]
+    try:
+        return configValues(int(fields["NU"][0]), int(fields["LK"][0]), int(fields["LK"][1]), fields["KY"][0],
+                            fields.get("NWID", [None])[0])
+    except (KeyError, IndexError), e:
+        raise ValueError("Incomplete configuration file")
+
+
+
+'''The function readConfig reads the configuration file at "path" and returns its configValues.'''
+def readConfig(path):
+    configFile = open(path, "r")
+    text = configFile.read()
+    configFile.close()
+    return parseConfig(text)
+
+
+
+'''The function atomicWrite replaces the file at "path" with "text". The text is written to a temporary file, forced to
+   disk, and renamed over the old file, so a power cut leaves either the complete old file or the complete new one.'''
+def atomicWrite(path, text):
+    tempPath = path + ".tmp"
+    tempFile = open(tempPath, "w")
+    tempFile.write(text)
+    tempFile.flush()
+    os.fsync(tempFile.fileno())
+    tempFile.close()
+    os.rename(tempPath, path)
+
+
+
+'''The function writeConfig atomically replaces the configuration file at "path" with the configValues "values".'''
+def writeConfig(path, values):
+    atomicWrite(path, values.toText())
+
+
+
+'''The configStore class holds the current configuration values in memory and keeps them up to date with the
+   configuration file. A watcher thread checks the file's modification time and size every pollInterval seconds, and
+   reloads the file when either has changed.'''
+class configStore(object):
+
+    def __init__(self, path, pollInterval=2.0):
+        self.path = path
+        self.pollInterval = pollInterval
+        self.values = None
+        self.fileState = None
+        self.subscribers = []
+        self.storeLock = threading.Lock()
+        self.watcher = None
+
+    '''The load method reads the configuration file and publishes its values. It raises IOError or ValueError if the
+       file cannot be read, in which case the current values are kept.'''
+    def load(self):
+        self.storeLock.acquire()
+        try:
+            fileState = self.statFile()
+            newValues = readConfig(self.path)
+            oldValues = self.values
+            self.fileState = fileState
+            #Replacing the reference is atomic, so readers always see one complete set of values.
+            self.values = newValues
+            subscribers = list(self.subscribers)
+        finally:
+            self.storeLock.release()
+
+        if (oldValues is not None) and (newValues != oldValues):
+            for callback in subscribers:
+                callback(oldValues, newValues)
+        return newValues
+
+    '''The get method returns the current configValues. It does not touch the configuration file.'''
+    def get(self):
+        return self.values
+
+    '''The subscribe method registers "callback" to be called as callback(oldValues, newValues) whenever a reload of
+       the configuration file changes its values.'''
+    def subscribe(self, callback):
+        self.storeLock.acquire()
+        self.subscribers.append(callback)
+        self.storeLock.release()
+
+    '''The update method writes "values" to the configuration file atomically, and publishes them.'''
+    def update(self, values):
+        writeConfig(self.path, values)
+        return self.load()
+
+    '''The checkForChanges method reloads the configuration file if its modification time or size has changed since
+       it was last loaded. A file which cannot be read or parsed is ignored until it changes again.'''
+    def checkForChanges(self):
+        try:
+            fileState = self.statFile()
+        except OSError, e:
+            return
+        if (fileState != self.fileState):
+            try:
+                self.load()
+            except (IOError, ValueError), e:
+                print "Configuration file could not be reloaded. Keeping current values."
+                self.fileState = fileState
+
+    '''The start method launches the watcher thread.'''
+    def start(self):
+        self.watcher = configWatcherThread(self)
+        self.watcher.setDaemon(True)
+        self.watcher.start()
+
+    def statFile(self):
+        status = os.stat(self.path)
+        return (status.st_mtime, status.st_size)
+
+
+
+'''The configWatcherThread class is a thread object which periodically asks its configStore to check the configuration
+   file for changes.'''
+class configWatcherThread(threading.Thread):
+    def __init__(self, store):
+        threading.Thread.__init__(self)
+        self.store = store
+
+    def run(self):
+        while 1:
+            time.sleep(self.store.pollInterval)
+            self.store.checkForChanges()
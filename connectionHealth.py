@@ -0,0 +1,159 @@
+'''This Python script, connectionHealth.py, keeps track of the health of the connection to the database server for
+   every thread of the main client. It is a circuit breaker: after a few connection failures in a row, database calls
+   fail at once instead of each waiting for its own timeout, so new data goes straight to the spool. The server is
+   probed again after a retry delay which doubles with every failure, with some jitter, and a single trial call decides
+   whether the connection is back. Callbacks are told of every change, so the backup replay can start as soon as the
+   connection is restored.'''
+import time
+import random
+import threading
+
+'''The states of the connectionHealth circuit breaker. While CLOSED, the connection is healthy and every database call
+   is made. While OPEN, the connection is down and calls fail at once, without waiting for a timeout. Once the retry
+   delay has passed, the breaker is HALF_OPEN, and a single trial call decides whether it closes or opens again.'''
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+'''The connectionHealth class is the circuit breaker shared by every thread using a database client. The client reports
+   the outcome of every database call to it, and asks it before every call whether the call should be made at all.'''
+class connectionHealth(object):
+
+    '''The connectionHealth properties are as follows:
+       failureThreshold is the number of consecutive connection failures which opens the breaker.
+       baseDelay and maxDelay are the first and the greatest retry delay, in seconds. The delay doubles with every
+       consecutive failure, and jitter is the share of the delay taken off at random, so that many clients do not probe
+       the server at the same moment.
+       trialTimeout is the number of seconds after which a trial call which never reported back is given up.'''
+    def __init__(self, failureThreshold=3, baseDelay=1.0, maxDelay=60.0, jitter=0.5, trialTimeout=30.0):
+        self.failureThreshold = failureThreshold
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.jitter = jitter
+        self.trialTimeout = trialTimeout
+        self.state = CLOSED
+        self.failures = 0
+        self.retryAt = 0
+        self.trialStart = None
+        self.callbacks = []
+        self.healthLock = threading.Lock()
+        self.opens = 0
+        self.fastFails = 0
+        self.trials = 0
+        self.changedAt = time.time()
+
+    '''The subscribe method registers "callback" to be called as callback(oldState, newState) whenever the state of the
+       breaker changes. Callbacks are called by the thread which made the call that changed the state.'''
+    def subscribe(self, callback):
+        self.healthLock.acquire()
+        self.callbacks.append(callback)
+        self.healthLock.release()
+
+    '''The allow method returns whether a database call should be made now. While the breaker is open, it returns
+       False until the retry delay has passed, and then True once, for the trial call, which must report its outcome.'''
+    def allow(self):
+        self.healthLock.acquire()
+        try:
+            if (self.state == CLOSED):
+                return True
+            now = time.time()
+            if (self.state == HALF_OPEN) and (now - self.trialStart < self.trialTimeout):
+                self.fastFails += 1
+                return False
+            if (self.state == OPEN) and (now < self.retryAt):
+                self.fastFails += 1
+                return False
+            change = self.setState(HALF_OPEN)
+            self.trialStart = now
+            self.trials += 1
+        finally:
+            self.healthLock.release()
+        self.notify(change)
+        return True
+
+    '''The success method reports a database call which reached the server. It closes the breaker.'''
+    def success(self):
+        self.healthLock.acquire()
+        try:
+            if (self.state == CLOSED) and (self.failures == 0):
+                return
+            self.failures = 0
+            self.retryAt = 0
+            change = self.setState(CLOSED)
+        finally:
+            self.healthLock.release()
+        self.notify(change)
+
+    '''The failure method reports a database call which failed due to a connection problem. The retry delay grows with
+       every consecutive failure, and the breaker opens after failureThreshold of them, or after a failed trial.'''
+    def failure(self):
+        self.healthLock.acquire()
+        try:
+            self.failures += 1
+            delay = min(self.baseDelay * 2 ** min(self.failures - 1, 30), self.maxDelay)
+            self.retryAt = time.time() + delay * (1 - self.jitter * random.random())
+            change = None
+            if (self.state == HALF_OPEN) or (self.failures >= self.failureThreshold):
+                change = self.setState(OPEN)
+        finally:
+            self.healthLock.release()
+        self.notify(change)
+
+    '''The release method reports a database call whose outcome says nothing about the connection, such as one that
+       failed due to a malformed entry. A trial call ending this way is retried after the current delay.'''
+    def release(self):
+        self.healthLock.acquire()
+        try:
+            change = None
+            if (self.state == HALF_OPEN):
+                change = self.setState(OPEN)
+        finally:
+            self.healthLock.release()
+        self.notify(change)
+
+    '''The setState method changes the state of the breaker, and returns the (oldState, newState) pair to notify, or
+       None if the state is unchanged. It is called with the lock held.'''
+    def setState(self, state):
+        if (state == self.state):
+            return None
+        change = (self.state, state)
+        self.state = state
+        self.changedAt = time.time()
+        if (state == OPEN) and (change[0] == CLOSED):
+            self.opens += 1
+        return change
+
+    def notify(self, change):
+        if change is None:
+            return
+        print "Database connection %s -> %s" %(change[0], change[1])
+        for callback in list(self.callbacks):
+            callback(change[0], change[1])
+
+    '''The healthy method returns whether the breaker is closed.'''
+    def healthy(self):
+        return (self.state == CLOSED)
+
+    '''The ready method returns whether a call made now would be allowed, either because the breaker is closed or
+       because its retry delay has passed, without making that call the trial. It lets a caller with a lot of work, such
+       as the backup replay, hold off until the connection is expected to be back.'''
+    def ready(self):
+        return (self.state == CLOSED) or ((self.state == OPEN) and (time.time() >= self.retryAt))
+
+    '''The retryIn method returns the number of seconds left before the next attempt after a connection failure.'''
+    def retryIn(self):
+        return max(self.retryAt - time.time(), 0)
+
+    '''The wait method sleeps until the retry delay after the latest connection failure has passed, for the loops which
+       keep retrying a call until it succeeds.'''
+    def wait(self):
+        delay = self.retryIn()
+        if (delay > 0):
+            time.sleep(delay)
+
+    '''The getStats method returns the state of the breaker, the number of consecutive failures, the number of seconds
+       left before the next attempt, and the number of times it has opened, failed a call fast and made a trial call.'''
+    def getStats(self):
+        return {"state": self.state, "failures": self.failures, "retryIn": round(self.retryIn(), 1),
+                "opens": self.opens, "fastFails": self.fastFails, "trials": self.trials}
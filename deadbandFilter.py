@@ -0,0 +1,63 @@
+'''This Python script, deadbandFilter.py, suppresses the upload of usage data which carries no news. Most water meters
+   report the same cumulative usage most of the time, overnight especially, and uploading each of those readings costs
+   database writes without telling the user anything. A reading of a water meter is suppressed if its counter is
+   unchanged and its temperatures are within a tolerance of the last uploaded reading. A reading is always uploaded
+   if it starts a new period at a boundary level or coarser, or if the water meter has been silent for too long, so
+   the usage collections keep a recent last record of every water meter.'''
+import threading
+import serialProtocol
+
+#The usage collections, from the coarsest to the finest period, as returned by meterTable.packedRollupLevel.
+BOUNDARY_LEVELS = ["month", "day", "hour", "min", "sec"]
+
+
+'''The deadbandFilter class keeps the last uploaded reading of every water meter, and decides whether each new reading
+   needs to be uploaded.'''
+class deadbandFilter(object):
+
+    '''The deadbandFilter properties are as follows:
+       tempTolerance is the greatest change of either temperature, in the units sent over by the measurement nodes,
+       which still counts as unchanged.
+       maxSilence is the greatest number of milliseconds between two uploaded readings of a water meter.
+       boundaryLevel is the finest period whose start is always uploaded: with "hour", the first reading of every hour,
+       day and month is uploaded.'''
+    def __init__(self, tempTolerance=2, maxSilence=900000, boundaryLevel="hour"):
+        if boundaryLevel not in BOUNDARY_LEVELS:
+            raise ValueError("Unknown boundary level: %s" %(boundaryLevel))
+        self.tempTolerance = tempTolerance
+        self.maxSilence = maxSilence
+        self.boundaryLevels = BOUNDARY_LEVELS[:BOUNDARY_LEVELS.index(boundaryLevel) + 1]
+        #lastPassed maps each water meter ID to the (counter, intTemp, extTemp, timestamp) of its last uploaded reading.
+        self.lastPassed = {}
+        self.filterLock = threading.Lock()
+        self.passed = 0
+        self.suppressed = 0
+
+    '''The check method returns True if the reading of the water meter wmid needs to be uploaded, and False if it is
+       suppressed. level is the coarsest period which has changed since the water meter's previous reading, as returned
+       by meterTable.packedRollupLevel, or "month" for the first reading of the water meter.'''
+    def check(self, wmid, counter, intTemp, extTemp, timestamp, level):
+        self.filterLock.acquire()
+        try:
+            last = self.lastPassed.get(wmid)
+            if (last is None) or (level in self.boundaryLevels) or (counter != last[0]) or \
+               (timestamp - last[3] >= self.maxSilence) or self.tempChanged(intTemp, last[1]) or \
+               self.tempChanged(extTemp, last[2]):
+                self.lastPassed[wmid] = (counter, intTemp, extTemp, timestamp)
+                self.passed += 1
+                return True
+            self.suppressed += 1
+            return False
+        finally:
+            self.filterLock.release()
+
+    '''The tempChanged method returns whether the temperature "temp" differs from the temperature "last" by more than
+       the tolerance. A temperature which has become readable or unreadable counts as changed.'''
+    def tempChanged(self, temp, last):
+        if (temp == serialProtocol.INVALID_TEMP) or (last == serialProtocol.INVALID_TEMP):
+            return (temp != last)
+        return (abs(temp - last) > self.tempTolerance)
+
+    '''The getStats method returns the number of readings uploaded and suppressed so far.'''
+    def getStats(self):
+        return {"passed": self.passed, "suppressed": self.suppressed}
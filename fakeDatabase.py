@@ -0,0 +1,215 @@
+'''This Python script, fakeDatabase.py, provides an in-process stand-in for the Pymongo Client, holding every collection
+   in memory. It answers the same methods with the same return values as pymongoClient, so the main client, or any part
+   of it, can be run and tested without a database server. A simulated latency can be added to every call, and the
+   connection can be switched off to simulate an outage.'''
+import time
+import threading
+from connectionHealth import connectionHealth
+from uploadDocuments import usageID, errorID, unsentResults, withID
+
+
+
+'''The fakePymongoClient class creates an in-memory Pymongo Client object. Its collections are lists of data entries,
+   kept in a dictionary by collection name (data_month, data_error, device_data and so on).'''
+class fakePymongoClient(object):
+
+    '''The fakePymongoClient properties are as follows:
+       latency is the number of seconds every database call takes.
+       meters is the list of device_data entries ({"nodeid", "wmid", "nwid", "status"}) the database starts with.
+       online decides whether calls succeed, or fail as they would upon a connection problem.
+       health is the connectionHealth circuit breaker the outcome of every call is reported to, as in pymongoClient.
+       bucketSpans is accepted for the sake of pymongoClient's signature, but the bucketed write mode is not simulated,
+       so any bucket span is rejected rather than silently written as plain entries.'''
+    def __init__(self, latency=0.0, meters=None, health=None, bucketSpans=None):
+        if bucketSpans:
+            raise ValueError("The bucketed write mode is not simulated: %s" %(bucketSpans))
+        self.latency = latency
+        self.online = True
+        self.health = health or connectionHealth()
+        self.collectionLock = threading.Lock()
+        self.collections = {"device_data": [dict(entry) for entry in (meters or [])]}
+        self.callCount = 0
+        #ids maps each collection name to the set of _id values of its entries, and duplicates counts the entries
+        #which were not stored again as an entry with the same _id existed already.
+        self.ids = {}
+        self.duplicates = 0
+        #sent is the list of (collection name, posts) pipelined bulk inserts waiting for a checkpoint. They are lost if
+        #a pipelined bulk insert fails, which counts as a new connection in pipeGeneration, as in pymongoClient.
+        self.sent = []
+        self.pipeGeneration = 0
+        self.confirmedGeneration = 0
+        self.dbDict = {"month": "data_month", "day": "data_day", "hour": "data_hour", "min": "data_min",
+                       "sec": "data_sec"}
+
+    def connect(self):
+        print "Connected to in-memory database"
+
+    '''The collection method returns the list of entries of the collection "name", creating it if necessary.'''
+    def collection(self, name):
+        return self.collections.setdefault(name, [])
+
+    '''The call method simulates the cost of one database call. It returns False if the circuit breaker fails the call
+       fast, or if the connection is switched off. With "retry", it keeps calling until the connection is back, as the
+       retrying methods of pymongoClient do. With "checked", the caller has already asked the circuit breaker. A call
+       which is not "acknowledged" does not wait for the latency, and does not tell the circuit breaker that the
+       connection is back.'''
+    def call(self, retry=False, acknowledged=True, checked=False):
+        if not (retry or checked) and not self.health.allow():
+            return False
+        while 1:
+            self.collectionLock.acquire()
+            self.callCount += 1
+            self.collectionLock.release()
+            if self.latency and acknowledged:
+                time.sleep(self.latency)
+            if self.online:
+                if acknowledged:
+                    self.health.success()
+                else:
+                    self.health.release()
+                return True
+            self.health.failure()
+            if not retry:
+                return False
+            self.health.wait()
+
+    '''The insert method stores the posts in the collection "name", except for those whose _id is already stored, as
+       the server would reject them, and returns the posts stored.'''
+    def insert(self, name, posts):
+        stored = []
+        self.collectionLock.acquire()
+        ids = self.ids.setdefault(name, set())
+        for post in posts:
+            if ("_id" in post) and (post["_id"] in ids):
+                self.duplicates += 1
+                continue
+            if "_id" in post:
+                ids.add(post["_id"])
+            stored.append(dict(post))
+        self.collection(name).extend(stored)
+        self.collectionLock.release()
+        return stored
+
+    def retrieveLastRecord(self, value):
+        self.call(retry=True)
+        entries = [entry for entry in self.collection("data_min") if (entry["wmid"] == value)]
+        entries.sort(key=lambda entry: entry["timestamp"], reverse=True)
+        return entries[:1]
+
+    def retrieveLastRecords(self, values):
+        if not self.call():
+            return None
+        records = {}
+        for entry in self.collection("data_min"):
+            if (entry["wmid"] in values) and ((entry["wmid"] not in records) or
+                                              (entry["timestamp"] > records[entry["wmid"]]["timestamp"])):
+                records[entry["wmid"]] = entry
+        return dict([(wmid, dict(entry)) for (wmid, entry) in records.items()])
+
+    def attemptUsageInsert(self, dbStr, wmid, counter, diff, intTemp, extTemp, tstamp, tstring):
+        return self.bulkUsageInsert(dbStr, [{"wmid": wmid, "counter": counter, "diff": diff, "intTemp": intTemp,
+                                             "extTemp": extTemp, "timestamp": tstamp, "timestring": tstring}])[0]
+
+    def bulkUsageInsert(self, dbStr, posts):
+        return self.bulkInsert(self.dbDict[dbStr], [withID(post, usageID(dbStr, post)) for post in posts])
+
+    def bulkErrorInsert(self, posts):
+        return self.bulkInsert("data_error", [withID(post, errorID(post)) for post in posts])
+
+    '''The bulkInsert method stores the posts in the collection "name". As in pymongoClient, the results of an upload
+       refused by the circuit breaker are an unsentResults, while those of an upload which failed upon the switched off
+       connection are plain zeros.'''
+    def bulkInsert(self, name, posts):
+        if not posts:
+            return []
+        if not self.health.allow():
+            return unsentResults([0] * len(posts))
+        if not self.call(checked=True):
+            return [0] * len(posts)
+        self.insert(name, posts)
+        return [1] * len(posts)
+
+    '''The pipelinedUsageInsert method holds the posts until the next checkpoint, as the server would only have them in
+       its socket buffer.'''
+    def pipelinedUsageInsert(self, dbStr, posts):
+        if not posts:
+            return []
+        if not self.health.allow():
+            return unsentResults([0] * len(posts))
+        if not self.call(acknowledged=False, checked=True):
+            self.collectionLock.acquire()
+            self.sent = []
+            self.pipeGeneration += 1
+            self.collectionLock.release()
+            return [0] * len(posts)
+        self.collectionLock.acquire()
+        self.sent.append((self.dbDict[dbStr], [withID(post, usageID(dbStr, post)) for post in posts]))
+        self.collectionLock.release()
+        return [1] * len(posts)
+
+    '''The checkpoint method stores the posts of every pipelined bulk insert since the previous checkpoint. If the
+       connection is switched off, or a pipelined bulk insert has failed since the previous checkpoint, they are lost,
+       as they would be with a broken connection.'''
+    def checkpoint(self):
+        confirmed = self.call()
+        self.collectionLock.acquire()
+        (sent, self.sent) = (self.sent, [])
+        if confirmed:
+            confirmed = (self.pipeGeneration == self.confirmedGeneration)
+            self.confirmedGeneration = self.pipeGeneration
+        else:
+            self.pipeGeneration += 1
+        self.collectionLock.release()
+        if confirmed:
+            for (name, posts) in sent:
+                self.insert(name, posts)
+        return confirmed
+
+    def attemptErrorInsert(self, wmid, prevUsage, currUsage, prevTS, currTS, errorNo, errorMsg):
+        return self.bulkErrorInsert([{"wmid": wmid, "prev_usage": prevUsage, "curr_usage": currUsage,
+                                      "prev_ts": prevTS, "curr_ts": currTS, "errorNo": errorNo,
+                                      "errorMsg": errorMsg}])[0]
+
+    def attemptStatusUpdate(self, NodeID, status):
+        return self.bulkStatusUpdate([NodeID], status)
+
+    def bulkStatusUpdate(self, nodeIDs, status):
+        if not nodeIDs:
+            return 1
+        if not self.call():
+            return 0
+        self.collectionLock.acquire()
+        for entry in self.collection("device_data"):
+            if entry["nodeid"] in nodeIDs:
+                entry["status"] = status
+        self.collectionLock.release()
+        return 1
+
+    def piHeartbeatInsert(self, piID, timestamp, IP):
+        return self.bulkInsert("pi_heartbeat", [{"_id": "pi:%s:%s" %(piID, timestamp), "piID": piID,
+                                                 "timestamp": timestamp, "IPAddress": IP}])[0]
+
+    def getMeterID(self, NWID):
+        self.call(retry=True)
+        return [dict(entry) for entry in self.collection("device_data") if (entry.get("nwid") == NWID)]
+
+    def pushIP(self, networkID, IPAddress):
+        if self.call():
+            self.collections["data_ip"] = [{"nwid": networkID, "address": IPAddress}]
+
+    def securityBreach(self, WMID):
+        if self.call():
+            self.collectionLock.acquire()
+            for entry in self.collection("device_data"):
+                if (entry["wmid"] == WMID):
+                    entry["security"] = True
+            self.collectionLock.release()
+
+    '''The getStats method returns the number of database calls made so far, the number of duplicate entries not
+       stored, and the number of entries held in each collection.'''
+    def getStats(self):
+        self.collectionLock.acquire()
+        stats = {"calls": self.callCount, "duplicates": self.duplicates,
+                 "collections": dict([(name, len(entries)) for (name, entries) in self.collections.items()])}
+        self.collectionLock.release()
+        return stats
@@ -0,0 +1,203 @@
+'''This Python script, heartbeatEvaluator.py, works out the heartbeat state of every measurement node of the water usage
+   monitoring network at once. The timestamps of the last records are read straight from the contiguous timestamp
+   column of the meter table, and compared against the heartbeat thresholds of every node in one vectorized operation
+   with NumPy, or in a plain loop where NumPy is not installed. Only the nodes whose state has changed are handed back
+   to the heartbeat check, so its cost stays flat as the network grows to thousands of water meters.'''
+import threading
+from array import array
+from heartbeatScheduler import ONLINE, SUSPECT, OFFLINE, RECOVERED
+
+#NumPy is optional. Without it, the same evaluation is done in a plain loop over the slots.
+try:
+    import numpy
+except ImportError, e:
+    numpy = None
+
+#The numeric codes of the heartbeat states, as kept in the state column.
+STATE_CODES = {ONLINE: 0, SUSPECT: 1, OFFLINE: 2}
+STATE_NAMES = [ONLINE, SUSPECT, OFFLINE]
+
+
+'''The heartbeatEvaluator class holds the heartbeat state of every registered measurement node, in columns indexed by
+   the slots of a meterTable. It offers the same methods as the heartbeatScheduler, so either one can be used by the
+   heartbeat check.'''
+class heartbeatEvaluator(object):
+
+    '''The heartbeatEvaluator properties are as follows:
+       meters is the meterTable whose timestamp column holds the last heartbeat of every node.
+       timeThreshold and offlineThreshold are the default numbers of milliseconds without usage data after which a
+       node becomes suspect and offline. offlineThreshold defaults to timeThreshold. setThresholds gives a node
+       thresholds of its own.
+       stillDownInterval is the time in milliseconds between two reports of a node which stays offline, or zero to
+       never report it again.
+       The columns hold, per slot: whether the node is monitored, its reported state, its thresholds, the earliest
+       time counted as its last heartbeat (floor), and the time of its latest offline report.'''
+    def __init__(self, meters, timeThreshold, offlineThreshold=None, stillDownInterval=0):
+        self.meters = meters
+        self.timeThreshold = timeThreshold
+        if offlineThreshold is None:
+            offlineThreshold = timeThreshold
+        self.offlineThreshold = max(offlineThreshold, timeThreshold)
+        self.stillDownInterval = stillDownInterval
+        self.monitored = array("b")
+        self.state = array("b")
+        self.timeThresholds = array("d")
+        self.offlineThresholds = array("d")
+        self.floor = array("d")
+        self.reported = array("d")
+        self.evaluateLock = threading.Lock()
+
+    '''The register method starts monitoring the node nodeID, which must be in the meter table. lastSeen is the
+       timestamp of the node's latest usage data, or None if there is none, and online is the node's current online
+       status in the database server. As with the heartbeatScheduler, a node marked as online which has no recent usage
+       data is given the time between the two thresholds, counted from now, before it is reported offline, and a node
+       marked as offline which has recent usage data is reported as recovered.'''
+    def register(self, nodeID, lastSeen, online, timeNow):
+        self.evaluateLock.acquire()
+        try:
+            slot = self.meters.slotOf(nodeID)
+            while (len(self.state) <= slot):
+                for column in [self.monitored, self.state]:
+                    column.append(0)
+                for column in [self.floor, self.reported]:
+                    column.append(0.0)
+                self.timeThresholds.append(self.timeThreshold)
+                self.offlineThresholds.append(self.offlineThreshold)
+            self.monitored[slot] = 1
+            if online:
+                self.state[slot] = STATE_CODES[ONLINE]
+                if (lastSeen is None) or (lastSeen + self.timeThresholds[slot] <= timeNow):
+                    self.floor[slot] = timeNow - self.timeThresholds[slot]
+            else:
+                self.state[slot] = STATE_CODES[OFFLINE]
+                self.reported[slot] = timeNow
+        finally:
+            self.evaluateLock.release()
+
+    '''The setThresholds method gives the node nodeID its own suspect and offline thresholds, in milliseconds.'''
+    def setThresholds(self, nodeID, timeThreshold, offlineThreshold=None):
+        if offlineThreshold is None:
+            offlineThreshold = timeThreshold
+        slot = self.meters.slotOf(nodeID)
+        self.timeThresholds[slot] = timeThreshold
+        self.offlineThresholds[slot] = max(offlineThreshold, timeThreshold)
+
+    '''The touch method is called for every usage data message. The meter table already holds the timestamp of the
+       message as the node's last record, so there is nothing left to do.'''
+    def touch(self, nodeID, seen):
+        pass
+
+    '''The tick method evaluates every monitored node against its thresholds, and returns a pair: the list of
+       (nodeID, state) transitions to report, where state is OFFLINE or RECOVERED, and the list of nodes due for a
+       "still down" reminder. A node which has recovered before its offline transition was reported is not reported
+       at all.'''
+    def tick(self, timeNow):
+        self.evaluateLock.acquire()
+        try:
+            if numpy is not None:
+                (changed, newStates, stillDown) = self.evaluateArrays(timeNow)
+            else:
+                (changed, newStates, stillDown) = self.evaluateSlots(timeNow)
+
+            transitions = []
+            for (slot, newState) in zip(changed, newStates):
+                if (newState == STATE_CODES[OFFLINE]):
+                    transitions.append((self.meters.nodeIDs[slot], OFFLINE))
+                    self.reported[slot] = timeNow
+                elif (self.state[slot] == STATE_CODES[OFFLINE]):
+                    transitions.append((self.meters.nodeIDs[slot], RECOVERED))
+                self.state[slot] = newState
+            for slot in stillDown:
+                self.reported[slot] = timeNow
+            return (transitions, [self.meters.nodeIDs[slot] for slot in stillDown])
+        finally:
+            self.evaluateLock.release()
+
+    '''The evaluateArrays method evaluates all slots with NumPy. The columns are viewed in place, without copying. It
+       returns the changed slots, their new state codes, and the slots due for a "still down" reminder.'''
+    def evaluateArrays(self, timeNow):
+        count = len(self.state)
+        if (count == 0):
+            return ([], [], [])
+        seen = numpy.frombuffer(self.meters.timestamp, dtype=numpy.float64, count=count)
+        recorded = numpy.frombuffer(self.meters.recorded, dtype=numpy.int8, count=count)
+        floor = numpy.frombuffer(self.floor, dtype=numpy.float64, count=count)
+        monitored = numpy.frombuffer(self.monitored, dtype=numpy.int8, count=count) != 0
+        state = numpy.frombuffer(self.state, dtype=numpy.int8, count=count)
+
+        age = timeNow - numpy.where(recorded != 0, numpy.maximum(seen, floor), floor)
+        newState = numpy.where(age >= numpy.frombuffer(self.offlineThresholds, dtype=numpy.float64, count=count),
+                               STATE_CODES[OFFLINE],
+                               numpy.where(age >= numpy.frombuffer(self.timeThresholds, dtype=numpy.float64,
+                                                                   count=count),
+                                           STATE_CODES[SUSPECT], STATE_CODES[ONLINE]))
+        changed = numpy.flatnonzero(monitored & (newState != state))
+
+        stillDown = []
+        if self.stillDownInterval:
+            reported = numpy.frombuffer(self.reported, dtype=numpy.float64, count=count)
+            stillDown = numpy.flatnonzero(monitored & (state == STATE_CODES[OFFLINE]) & (newState == state) &
+                                          (timeNow - reported >= self.stillDownInterval)).tolist()
+        return (changed.tolist(), newState[changed].tolist(), stillDown)
+
+    '''The evaluateSlots method performs the same evaluation as evaluateArrays in a plain loop, for when NumPy is not
+       installed.'''
+    def evaluateSlots(self, timeNow):
+        changed = []
+        newStates = []
+        stillDown = []
+        for slot in xrange(len(self.state)):
+            if not self.monitored[slot]:
+                continue
+            last = self.floor[slot]
+            if self.meters.recorded[slot]:
+                last = max(self.meters.timestamp[slot], last)
+            age = timeNow - last
+            if (age >= self.offlineThresholds[slot]):
+                newState = STATE_CODES[OFFLINE]
+            elif (age >= self.timeThresholds[slot]):
+                newState = STATE_CODES[SUSPECT]
+            else:
+                newState = STATE_CODES[ONLINE]
+            if (newState != self.state[slot]):
+                changed.append(slot)
+                newStates.append(newState)
+            elif (newState == STATE_CODES[OFFLINE]) and self.stillDownInterval and \
+                 (timeNow - self.reported[slot] >= self.stillDownInterval):
+                stillDown.append(slot)
+        return (changed, newStates, stillDown)
+
+    '''The requeue method takes back the transitions, as returned by tick, whose report failed to upload. Their nodes
+       return to their previous state, so the transitions are evaluated and reported again at the next heartbeat check,
+       unless the node's state has changed back in the meantime.'''
+    def requeue(self, transitions):
+        self.evaluateLock.acquire()
+        try:
+            for (nodeID, state) in transitions:
+                slot = self.meters.slotOf(nodeID)
+                if (state == OFFLINE):
+                    self.state[slot] = STATE_CODES[ONLINE]
+                else:
+                    self.state[slot] = STATE_CODES[OFFLINE]
+        finally:
+            self.evaluateLock.release()
+
+    '''The offlineCount method returns the number of monitored nodes currently reported as offline.'''
+    def offlineCount(self):
+        return sum([1 for slot in xrange(len(self.state))
+                    if self.monitored[slot] and (self.state[slot] == STATE_CODES[OFFLINE])])
+
+    '''The getStats method returns the number of monitored nodes in each heartbeat state, and the number of monitored
+       nodes which have never sent over usage data. Such nodes are not handed to the heartbeat check as a set of their
+       own: they go offline like any other node once the floor given to them by register has passed, and the heartbeat
+       error message of a node without a last record already says so, with -1 as its usage and timestamp.'''
+    def getStats(self):
+        stats = dict([(name, 0) for name in STATE_NAMES])
+        stats["neverSeen"] = 0
+        for slot in xrange(len(self.state)):
+            if self.monitored[slot]:
+                stats[STATE_NAMES[self.state[slot]]] += 1
+                if not self.meters.recorded[slot]:
+                    stats["neverSeen"] += 1
+        stats["vectorized"] = numpy is not None
+        return stats
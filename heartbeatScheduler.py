@@ -0,0 +1,154 @@
+'''This Python script, heartbeatScheduler.py, keeps track of when each measurement node of the water usage monitoring
+   network is next expected to send over usage data, and of the heartbeat state of every node. Instead of comparing
+   every node against the heartbeat threshold on every heartbeat check, the deadlines are kept in a heap, so each check
+   only examines the nodes whose deadline has actually passed.'''
+import heapq
+import threading
+
+'''The heartbeat states of a measurement node. An "online" node becomes "suspect" once it has not sent over usage data
+   for the heartbeat threshold, and "offline" once it has not done so for the offline threshold. A suspect node which
+   sends over usage data is simply online again, while an offline node which does so is reported as "recovered" before
+   it becomes online again.'''
+ONLINE = "online"
+SUSPECT = "suspect"
+OFFLINE = "offline"
+RECOVERED = "recovered"
+
+
+'''The heartbeatScheduler class holds the heartbeat state of every measurement node, along with the deadline (in
+   milliseconds since Epoch time) at which the node moves to its next state unless it sends over usage data. Each
+   heartbeat check reports only the nodes whose state has changed since the previous check.'''
+class heartbeatScheduler(object):
+
+    '''The heartbeatScheduler properties are as follows:
+       timeThreshold is the time in milliseconds without usage data after which a node becomes suspect.
+       offlineThreshold is the time in milliseconds without usage data after which a node becomes offline, and is
+       reported. It defaults to timeThreshold, in which case a node goes straight from online to offline.
+       stillDownInterval is the time in milliseconds between two reports of the nodes which are still offline, or zero
+       to never report them again.
+       heap holds (deadline, nodeID) pairs. When a node's deadline moves, the old pair is left in the heap and skipped
+       once it reaches the top, since it no longer matches the node's entry in deadlines.
+       changed maps each node whose state has changed since the last heartbeat check to the state to be reported.'''
+    def __init__(self, timeThreshold, offlineThreshold=None, stillDownInterval=0):
+        self.timeThreshold = timeThreshold
+        if offlineThreshold is None:
+            offlineThreshold = timeThreshold
+        self.offlineThreshold = max(offlineThreshold, timeThreshold)
+        self.stillDownInterval = stillDownInterval
+        self.heap = []
+        self.deadlines = {}
+        self.lastSeen = {}
+        self.states = {}
+        self.offline = set()
+        self.changed = {}
+        self.lastStillDown = None
+        self.scheduleLock = threading.Lock()
+
+    '''The register method adds the node nodeID to the scheduler. lastSeen is the timestamp of the node's latest usage
+       data, or None if there is none. online is the node's current online status in the database server. A node marked
+       as online which has no recent usage data becomes suspect at the next heartbeat check, while a node marked as
+       offline which has recent usage data is reported as recovered.'''
+    def register(self, nodeID, lastSeen, online, timeNow):
+        self.scheduleLock.acquire()
+        try:
+            self.lastSeen[nodeID] = lastSeen
+            if (lastSeen is not None) and (lastSeen + self.timeThreshold > timeNow):
+                self.states[nodeID] = ONLINE
+                self.schedule(nodeID, lastSeen + self.timeThreshold)
+                if not online:
+                    self.changed[nodeID] = RECOVERED
+            elif online:
+                #Give the node the time between the two thresholds, counted from now, before it is reported offline.
+                self.states[nodeID] = ONLINE
+                self.lastSeen[nodeID] = timeNow - self.timeThreshold
+                self.schedule(nodeID, timeNow)
+            else:
+                #The node is already recorded as offline, so there is nothing new to report.
+                self.states[nodeID] = OFFLINE
+                self.offline.add(nodeID)
+                self.deadlines[nodeID] = None
+        finally:
+            self.scheduleLock.release()
+
+    '''The touch method records that the node nodeID has sent over usage data with the timestamp "seen", and moves its
+       deadline accordingly. It is called for every usage data message, and takes O(log N) time.'''
+    def touch(self, nodeID, seen):
+        self.scheduleLock.acquire()
+        try:
+            if (seen <= self.lastSeen.get(nodeID)):
+                return
+            self.lastSeen[nodeID] = seen
+            state = self.states.get(nodeID)
+            if (state == OFFLINE) and (self.changed.get(nodeID) == OFFLINE):
+                #The node has come back before it was even reported offline.
+                self.offline.discard(nodeID)
+                del self.changed[nodeID]
+            elif (state == OFFLINE):
+                self.offline.discard(nodeID)
+                self.changed[nodeID] = RECOVERED
+            elif (state == SUSPECT) and (self.changed.get(nodeID) == SUSPECT):
+                #The node has recovered before its suspicion was even reported.
+                del self.changed[nodeID]
+            elif (state == SUSPECT):
+                self.changed[nodeID] = ONLINE
+            self.states[nodeID] = ONLINE
+            self.schedule(nodeID, seen + self.timeThreshold)
+        finally:
+            self.scheduleLock.release()
+
+    '''The tick method performs the scheduling part of a heartbeat check at the time timeNow. It moves every node whose
+       deadline has passed to its next state, and returns a pair: a list of (nodeID, state) pairs for the nodes whose
+       state has changed since the last check, and a list of the nodes which are still offline if stillDownInterval has
+       passed since they were last reported (otherwise an empty list).'''
+    def tick(self, timeNow):
+        self.scheduleLock.acquire()
+        try:
+            while self.heap and (self.heap[0][0] <= timeNow):
+                (deadline, nodeID) = heapq.heappop(self.heap)
+                #Skip pairs left behind by an earlier touch of the node.
+                if (self.deadlines.get(nodeID) != deadline):
+                    continue
+                if (self.states[nodeID] == ONLINE):
+                    self.states[nodeID] = SUSPECT
+                    self.changed[nodeID] = SUSPECT
+                    self.schedule(nodeID, self.lastSeen[nodeID] + self.offlineThreshold)
+                elif (self.states[nodeID] == SUSPECT):
+                    self.states[nodeID] = OFFLINE
+                    self.changed[nodeID] = OFFLINE
+                    self.offline.add(nodeID)
+                    self.deadlines[nodeID] = None
+
+            transitions = self.changed.items()
+            self.changed = {}
+
+            stillDown = []
+            if (self.stillDownInterval > 0):
+                if self.lastStillDown is None:
+                    self.lastStillDown = timeNow
+                elif (timeNow - self.lastStillDown >= self.stillDownInterval):
+                    stillDown = [nodeID for nodeID in self.offline if nodeID not in dict(transitions)]
+                    self.lastStillDown = timeNow
+            return (transitions, stillDown)
+        finally:
+            self.scheduleLock.release()
+
+    '''The requeue method reports the (nodeID, state) pairs "transitions" again at the next heartbeat check, unless the
+       node has changed state in the meantime. This is used when a transition could not be uploaded to the database
+       server.'''
+    def requeue(self, transitions):
+        self.scheduleLock.acquire()
+        try:
+            for (nodeID, state) in transitions:
+                if nodeID not in self.changed:
+                    self.changed[nodeID] = state
+        finally:
+            self.scheduleLock.release()
+
+    '''The offlineCount method returns the number of nodes currently offline.'''
+    def offlineCount(self):
+        return len(self.offline)
+
+    '''The schedule method sets the deadline of nodeID. The caller must hold scheduleLock.'''
+    def schedule(self, nodeID, deadline):
+        self.deadlines[nodeID] = deadline
+        heapq.heappush(self.heap, (deadline, nodeID))
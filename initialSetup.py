@@ -2,6 +2,7 @@
    It does so by initializing the default configuration values for this water usage monitoring network, and determining
    which measurement nodes are part of this particular network, based on its network ID.'''
 import pymongoClient
+import configStore
 import time
 import serial
 
@@ -32,10 +33,6 @@ if __name__ == "__main__":
     nodeFile = open(NODEFILE_NAME, "r+")
     nodeFile.truncate()
 
-    #Open the file storing configuration values for this water usage network, and delete all of its contents.
-    configFile = open(CONFIG_NAME, "r+")
-    configFile.truncate()
-
     ser.flushInput()
     ser.flushOutput()
 
@@ -79,17 +76,10 @@ if __name__ == "__main__":
             print "Failed to connect to database. Retrying..."'''
             
 
-    #Write in the default configuration values to the configuration file.
-    configFile.write("NU,21600\n")
-    configFile.write("LK,60,06\n")
-    configFile.write("KY,z8PUsGeMY10kOBOy\n")
-
-
-
-    '''#Write the network ID to the configuration file and close the file.
-    configFile.write("NWID,%s\n" %(nwid))'''
-    configFile.write("NWID,%s\n" %(hardNetworkID))
-    configFile.close()
+    #Write in the default configuration values and the network ID to the configuration file. The file is replaced
+    #atomically, so it is never left half-written.
+    '''configStore.writeConfig(CONFIG_NAME, configStore.configValues(21600, 60, 6, "z8PUsGeMY10kOBOy", nwid))'''
+    configStore.writeConfig(CONFIG_NAME, configStore.configValues(21600, 60, 6, "z8PUsGeMY10kOBOy", hardNetworkID))
 
     
     while 1:
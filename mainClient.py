@@ -3,47 +3,216 @@
    database server. mainClient.py also monitors the status of measurement nodes belonging to its network. If any node
    ceases to be operational, error data will be uploaded to the database server to notify the user or admin of the
    error.'''
+import os
+import signal
+import atexit
 import threading
 from datetime import datetime
 import time
-import serialConnection
+import serialPorts
 import pymongoClient
-import memcacheClient
-from collections import deque
+import tieredBacklog
+import backlogCompactor
+import uploadPipeline
+import uploadScheduler
+import heartbeatScheduler
+import heartbeatEvaluator
+import timestampDecoder
+import serialProtocol
+import configStore
+import rollupEngine
+import deadbandFilter
+import meterTable
+import asyncRuntime
+import connectionHealth
+import sys
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import netifaces as ni
 
-#connFail is a Boolean parameter which indicates whether the script has lost connection with the database server.
-connFail = False
 nodeList = []
-lastRecord = {}
 
-'''allowedSet is the set of characters allowed in the serial messages sent over by the monitor node. It is a basic
-   check for possible data corruption.'''
-allowedSet = set("_0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ,;")
 NODEFILENAME = "nodelist.txt"
-backupLock = threading.Lock()
 mainReturn = None
 piID = 1
 
 #IP address of the MongoDB database server
 MONGO_IP = "ds033018.mongolab.com"
-meterDict = {}
-#dataQ = deque()
-
-#The Serial Connection client instance
-ser = serialConnection.serialConnection()
+'''The bucketed write mode. Each usage collection in BUCKET_SPANS is written as one bucket document per water meter and
+   span ("hour" or "day"), holding the array of its readings along with summary fields, instead of one document per
+   reading. SECOND_DATA switches on the upload of per-second data (data_sec), which is only practical in bucketed
+   mode, for instance with BUCKET_SPANS = {"min": "day", "sec": "hour"}.'''
+BUCKET_SPANS = {}
+SECOND_DATA = False
+#The number of water meters queried at once for their last record, if the bulk query at startup leaves any out.
+LAST_RECORD_WORKERS = 8
+'''The meter table, holding the water meter ID, online status and last record of every measurement node of this
+   network, in the slot assigned to the node.'''
+meters = meterTable.meterTable()
+
+'''The ingest pipeline settings. UPLOAD_WORKERS is the number of upload worker threads draining the message queues,
+   QUEUE_SIZE is the capacity of each worker's queue, and OVERFLOW_POLICY decides what happens to a message that
+   arrives while the queue is full ("block", "drop_newest" or "drop_oldest").'''
+UPLOAD_WORKERS = multiprocessing.cpu_count()
+QUEUE_SIZE = 1000
+OVERFLOW_POLICY = "block"
+pipeline = None
+
+'''SERIAL_PORTS lists the serial ports of the monitor nodes served by this main client, as (name, device) pairs: the
+   on-board UART, and any USB XBee coordinators covering further buildings. Every port has its own reader, and all of
+   them feed the same ingest pipeline. A port which fails is reopened after SERIAL_RETRY seconds, doubling after every
+   failed attempt up to SERIAL_MAX_RETRY seconds, while the other ports carry on.'''
+SERIAL_PORTS = [("uart", "/dev/ttyAMA0")]
+SERIAL_RETRY = 1.0
+SERIAL_MAX_RETRY = 60.0
+#The serial ports, each with its own Serial Connection client.
+ports = serialPorts.serialPortSet(SERIAL_PORTS, SERIAL_RETRY, SERIAL_MAX_RETRY)
+'''The database connection health settings. After DB_FAILURE_THRESHOLD connection failures in a row, the circuit
+   breaker opens, and database calls fail at once so that new data goes straight to the spool. The server is probed
+   again after DB_RETRY seconds, doubling after every failed probe up to DB_MAX_RETRY seconds.'''
+DB_FAILURE_THRESHOLD = 3
+DB_RETRY = 1.0
+DB_MAX_RETRY = 60.0
+#The circuit breaker shared by every thread using the database connection.
+health = connectionHealth.connectionHealth(DB_FAILURE_THRESHOLD, DB_RETRY, DB_MAX_RETRY)
 #The Pymongo Client instance
-dbClient = pymongoClient.pymongoClient(MONGO_IP)
-#The Python Memcached Client instance
-mem = memcacheClient.memcacheClient()
+dbClient = pymongoClient.pymongoClient(MONGO_IP, bucketSpans=BUCKET_SPANS, health=health)
+'''The backup spool settings. Up to SPOOL_MEMORY backed up entries are held in memory, beyond which the oldest spill to
+   disk, SPOOL_SPILL entries at a time, compressed in blocks. No entry is held in memory for more than SPOOL_MEMORY_AGE
+   seconds before it is spilled and forced to disk, which bounds the backed up data a power cut can lose. SPOOL_DIR is
+   the folder of the disk tier, and SPOOL_MAX_BYTES its budget in bytes. Once SPOOL_DOWNSAMPLE_AT of the budget is in
+   use, per-minute data spilling to disk is thinned out to one entry in SPOOL_DOWNSAMPLE_FACTOR per water meter. Over
+   budget, per-minute data is evicted before any month, day or hour data or error message.'''
+SPOOL_MEMORY = 2000
+SPOOL_SPILL = 500
+SPOOL_MEMORY_AGE = 5.0
+SPOOL_DIR = "spool"
+SPOOL_MAX_BYTES = 268435456
+SPOOL_DOWNSAMPLE_AT = 0.8
+SPOOL_DOWNSAMPLE_FACTOR = 5
+'''The backlog compaction settings. With COMPACT_ENABLED, the backed up per-minute data of each water meter is merged
+   into one entry per COMPACT_SPAN (such as "hour"), once more than COMPACT_ENTRIES per-minute entries have been backed
+   up since the last compaction, or the oldest of them is more than COMPACT_AGE milliseconds old. The backlog is
+   compacted while the database connection is down, and once more before it is replayed. Month, day and hour data and
+   error messages are never merged, and neither is per-minute data which may have reached the server before it was
+   backed up: only the entries refused by the open circuit breaker are.
+   Compaction is off by default, as a merged entry is a document of its own in data_min, covering many minutes, and
+   the readers of the database have to expect such documents first, as with ROLLUP_ENABLED.'''
+COMPACT_ENABLED = False
+COMPACT_SPAN = "hour"
+COMPACT_ENTRIES = 10000
+COMPACT_AGE = 3600000
+compactor = backlogCompactor.backlogCompactor(COMPACT_SPAN, COMPACT_ENTRIES, COMPACT_AGE) if COMPACT_ENABLED else None
+#The tiered backlog instance, which backs up usage data and error messages that failed to upload
+spool = tieredBacklog.tieredBacklog(SPOOL_DIR, SPOOL_MEMORY, SPOOL_SPILL, SPOOL_MAX_BYTES, SPOOL_DOWNSAMPLE_AT,
+                                    SPOOL_DOWNSAMPLE_FACTOR, compactor=compactor, memoryAge=SPOOL_MEMORY_AGE)
+'''The backup replay settings. REPLAY_CHUNK is the number of backed up entries read from the spool at once, REPLAY_RATE
+   is the greatest number of backed up entries uploaded per second, and the replay pauses while more than
+   REPLAY_YIELD_DEPTH messages are waiting in the ingest pipeline. The entries of a chunk are uploaded in bulk inserts
+   of up to REPLAY_BATCH entries, all queued at once in the "backlog" priority class. As every entry has a
+   deterministic _id, an entry which reached the server before it was backed up is not stored twice, so the bulk
+   inserts need no ordering.'''
+REPLAY_CHUNK = 500
+REPLAY_RATE = 200
+REPLAY_YIELD_DEPTH = 100
+REPLAY_BATCH = 100
+#connRestored is set when the circuit breaker closes again, waking the backupThread as soon as connection has resumed.
+connRestored = threading.Event()
+#The number of usage data entries, and the number of seconds, after which a collection's pending entries are uploaded.
+BATCH_SIZE = 50
+BATCH_AGE = 1.0
+'''WRITE_CONCERN decides whether the usage writer waits for the server to acknowledge every bulk insert
+   ("acknowledged"), or sends the bulk inserts without waiting and confirms them with an acknowledged checkpoint write
+   once CHECKPOINT_SIZE entries have been sent, or the oldest was sent CHECKPOINT_AGE seconds ago ("pipelined"). Over a
+   high-latency link, "pipelined" keeps uploading while earlier bulk inserts are still on their way. Entries are held by
+   the usage writer until their checkpoint is confirmed, and backed up to the spool if it fails. The entries backed up
+   after a failed checkpoint may still have reached the server. The collections in BUCKET_SPANS are pipelined as well,
+   which is safe because their upserts skip the readings already in their bucket, so a replayed reading is never
+   appended twice.'''
+WRITE_CONCERN = "acknowledged"
+CHECKPOINT_SIZE = 500
+CHECKPOINT_AGE = 5.0
+usageWriter = None
 configTimer = None
 
+'''RUNTIME_MODE selects how the main client runs. In the "classic" runtime, the serial port is read by a reader thread
+   and the frames are handled by a pool of upload worker threads. In the "async" runtime, a single event loop reads and
+   handles the frames, and up to ASYNC_UPLOADS database calls are kept in flight at once. Starting the script with the
+   --async or --classic argument overrides RUNTIME_MODE.'''
+RUNTIME_MODE = "classic"
+ASYNC_UPLOADS = 16
+
+'''The upload priority settings. Frames waiting in the ingest pipeline, and database calls waiting for the connection,
+   are queued by priority class: replies to key and time requests ("control"), node error messages and security breach
+   updates ("alert"), live usage data ("usage"), heartbeat errors, status updates and Raspberry Pi heartbeats
+   ("status"), and the backup replay ("backlog"). While several classes have work waiting, each is served in proportion
+   to its weight in PRIORITY_WEIGHTS. In the classic runtime, the database calls are made by SCHEDULER_WORKERS
+   scheduler threads, with up to QUEUE_SIZE calls waiting in each class.'''
+PRIORITY_WEIGHTS = dict(uploadScheduler.DEFAULT_WEIGHTS)
+SCHEDULER_WORKERS = 4
+#The database adapter through which database calls are made by priority class: the uploadScheduler of the classic
+#runtime, or the asynchronous database adapter of the async runtime.
+database = None
+
 '''This is the measurement node heartbeat threshold value, in terms of milliseconds. This means if a measurement node
    has not sent over usage data within the past period of this many milliseconds, it is considered non-operational.
    An error message will be uploaded to the database server, informing the user/admin of the node's status.'''
 TIME_THRESHOLD = 120000
+'''A measurement node which has not sent over usage data for OFFLINE_THRESHOLD milliseconds is considered offline,
+   and its "Heartbeat" error message is uploaded. By default this is TIME_THRESHOLD, so the error is uploaded as soon as
+   the heartbeat threshold has passed. Raising OFFLINE_THRESHOLD above TIME_THRESHOLD holds the error back for that much
+   longer. In between, the node is only suspect: this state is internal to the heartbeat scheduler, and is never
+   uploaded. STILL_DOWN_INTERVAL is the number of milliseconds between "still down" reminders for nodes which stay
+   offline, or zero for no reminders.'''
+OFFLINE_THRESHOLD = TIME_THRESHOLD
+STILL_DOWN_INTERVAL = 3600000
+'''HEARTBEAT_THRESHOLDS gives measurement nodes which report less often thresholds of their own: it maps a node ID to
+   the pair (suspect threshold, offline threshold) in milliseconds. Other nodes use TIME_THRESHOLD and
+   OFFLINE_THRESHOLD.'''
+HEARTBEAT_THRESHOLDS = {}
+'''The heartbeat evaluator, which evaluates the heartbeat state of every measurement node at once from the timestamp
+   column of the meter table. Its methods are those of the heartbeat scheduler, which keeps the deadline of each node's
+   next change in a heap instead, and takes its place with HEARTBEAT_VECTORIZED set to False.'''
+HEARTBEAT_VECTORIZED = True
+if HEARTBEAT_VECTORIZED:
+    scheduler = heartbeatEvaluator.heartbeatEvaluator(meters, TIME_THRESHOLD, OFFLINE_THRESHOLD, STILL_DOWN_INTERVAL)
+else:
+    scheduler = heartbeatScheduler.heartbeatScheduler(TIME_THRESHOLD, OFFLINE_THRESHOLD, STILL_DOWN_INTERVAL)
 
 CONFIG_NAME = "config.txt"
+#The configuration store, holding the configuration values of this network in memory.
+config = configStore.configStore(CONFIG_NAME)
+
+#The decoder of the timestamps sent over by the measurement nodes.
+decoder = timestampDecoder.timestampDecoder()
+
+'''The rollup settings. With ROLLUP_ENABLED, each usage collection in ROLLUP_GRANULARITIES receives one aggregate usage
+   data entry per water meter and period, once the period has ended, instead of the first raw reading of the period.
+   A period is closed by the first reading of a later period, or ROLLUP_GRACE milliseconds after its end if no such
+   reading arrives. The open windows are saved to the ROLLUP_STATE file at every heartbeat check, so they survive a
+   restart.
+   Rollups are off by default, as turning them on changes what the usage collections mean, and the readers of the
+   database have to be migrated first. An aggregate entry is only uploaded once its period and ROLLUP_GRACE have
+   passed, and its timestamp is that of the last reading of the period rather than the first, so a reader taking the
+   latest entry of a water meter sees data up to a period (plus the grace) old. The minute collection, for instance,
+   lags by up to two minutes.'''
+ROLLUP_ENABLED = False
+ROLLUP_GRANULARITIES = ["month", "day", "hour", "min"] + (["sec"] if SECOND_DATA else [])
+ROLLUP_GRACE = 60000
+ROLLUP_STATE = "rollup.json"
+rollup = rollupEngine.rollupEngine(ROLLUP_GRANULARITIES, ROLLUP_GRACE)
+
+'''The deadband settings. With DEADBAND_ENABLED, a reading whose counter is unchanged and whose temperatures are within
+   DEADBAND_TEMP_TOLERANCE of the last uploaded reading of its water meter is not uploaded. The first reading of every
+   DEADBAND_BOUNDARY period (and of every coarser period) is always uploaded, as is a reading of a water meter which
+   has had none uploaded for DEADBAND_MAX_SILENCE milliseconds. Suppressed readings still count as heartbeats. The
+   deadband only applies to the upload of raw readings: with ROLLUP_ENABLED, every reading is added to the rollup
+   windows, so that their readings and temperature statistics are complete. It is off by default.'''
+DEADBAND_ENABLED = False
+DEADBAND_TEMP_TOLERANCE = 2
+DEADBAND_MAX_SILENCE = 900000
+DEADBAND_BOUNDARY = "hour"
+deadband = deadbandFilter.deadbandFilter(DEADBAND_TEMP_TOLERANCE, DEADBAND_MAX_SILENCE, DEADBAND_BOUNDARY)
 
 oldNU = None
 oldLeakInterval = None
@@ -61,269 +230,723 @@ acknowledgeCount = 0
 
 
 
-'''The backupThread class is a thread object which is used to constantly monitor the status of cache memory.
-   If backed up data exists in cache memory, and connection to the database server has resumed, then backupThread
-   will attempt to push all the backed up data to the database server.'''
+'''The backupThread class is a thread object which is used to constantly monitor the status of the backup spool.
+   If backed up data exists in the spool, and connection to the database server has resumed, or is due to be probed
+   again, then backupThread will push the backed up data to the database server in chunks of REPLAY_CHUNK entries. The
+   entries of each chunk are grouped by usage collection and uploaded with one bulk insert per collection. The replay
+   is limited to REPLAY_RATE entries per second, and pauses while the ingest pipeline is busy, so that live usage data
+   is not held back.'''
 class backupThread(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
-        '''This backupReturn parameter is to check the return value of the backup data insert attempts.'''
+        '''This backupReturn parameter is to check the return values of the backup data bulk inserts.'''
         self.backupReturn = None
 
     def run(self):
-        global connFail
-        backupLock.acquire()
-        '''Initialization: set the backed up data entry count in cache memory.'''
-        mem.updateCacheCount()
-        backupLock.release()
-
         while 1:
-            '''If there is backed up data in cache memory due to previous connection failure to the database server,
-               and connection has been re-established now, then begin pushing the backed up data back to the server.'''
-            if (mem.getCacheCount() > 0) and (not connFail):
+            #Merge the backed up per-minute data once the backlog is large or old enough, whether offline or not.
+            spool.compact(long(1000*time.time()))
+            '''If there is backed up data in the spool due to previous connection failure to the database server,
+               and connection has been re-established now, then begin pushing the backed up data back to the server.
+               While the circuit breaker is open, the first chunk replayed once the retry delay has passed is the
+               trial call which decides whether the connection is back.'''
+            if (spool.pendingCount() > 0) and health.ready():
                 print "Pushing backup data to server..."
-                while (mem.getCacheCurr() < mem.getCacheCount()) and (not connFail):
-                    toUpload = mem.valueGet(str(mem.getCacheCurr()))
-                    if (toUpload):
-                        self.backupReturn = dbClient.backupUsageInsert(toUpload[0], toUpload[1],
-                                                                       toUpload[2], toUpload[3],
-                                                                       toUpload[4], toUpload[5],
-                                                                       toUpload[6], toUpload[7])
-
-                        '''If the backed up data push for this particular data entry is successful, then we delete that
-                           entry from cache memory, and increment the current counter to the next piece of backed up
-                           data in cache memory.'''
-                        if (self.backupReturn):
-                            connFail = False
-                            mem.valueDelete(str(mem.getCacheCurr()))
-                            mem.cacheCurrIncrement()
-                        else:
-                            connFail = True
-
-                '''If all the backed up data has been pushed back to the database server, then we reset both the cache
-                   count and the current cache index pointer back to zero, indicating that everything has been cleared
-                   in cache memory.'''
-                if (mem.getCacheCurr() >= mem.getCacheCount()):
-                    backupLock.acquire()
-                    mem.cacheCountReset()
-                    backupLock.release()
-                    mem.cacheCurrReset()
+                while (spool.pendingCount() > 0) and health.ready():
+                    if (pipeline.getStats()["depth"] > REPLAY_YIELD_DEPTH):
+                        time.sleep(1)
+                        continue
+                    chunkStart = time.time()
+                    entries = spool.readBatch(REPLAY_CHUNK)
+                    if not entries:
+                        break
+                    self.replayChunk(entries)
+                    #Rate limiting: a chunk of n entries takes at least n / REPLAY_RATE seconds.
+                    timeLeft = float(len(entries)) / REPLAY_RATE - (time.time() - chunkStart)
+                    if (timeLeft > 0):
+                        time.sleep(timeLeft)
             else:
-                time.sleep(60)
+                #Wait until the connection is restored, the next probe of the server is due, or at most 60 seconds.
+                connRestored.wait(min(max(health.retryIn(), 1), 60) if (spool.pendingCount() > 0) else 60)
+                connRestored.clear()
+
+    '''The replayChunk method uploads one chunk of backed up entries, as returned by spool.readBatch, with the bulk
+       inserts of replayBatches made by the upload scheduler, in the "backlog" priority class. Entries which failed to
+       upload due to a connection problem are appended to the spool again, so the whole chunk can be committed without
+       losing or duplicating any entry.'''
+    def replayChunk(self, entries):
+        batches = replayBatches(groupBackupChunk(entries))
+        for ((dbStr, group), results) in zip(batches, database.map(replayBatch, [(batch,) for batch in batches],
+                                                                    priority="backlog")):
+            self.backupReturn = results
+            replayResults(group, results)
+
+        spool.commit(entries[-1][0])
+
+
+
+'''The function groupBackupChunk groups a chunk of backed up entries, as returned by spool.readBatch, by usage
+   collection. It returns a dictionary mapping each collection key (dbStr) to the list of (entry, usage data post)
+   pairs of that collection. Entries are backed up as [dbStr, post] or [dbStr, post, backlogCompactor.UNSENT], or, if
+   they were backed up by an older version of the main client, as [dbStr, wmid, counter, diff, intTemp, extTemp,
+   timestamp, timestring].'''
+def groupBackupChunk(entries):
+    groups = {}
+    for (position, toUpload) in entries:
+        if (len(toUpload) <= 3):
+            post = toUpload[1]
+        else:
+            post = pymongoClient.formUsagePost(toUpload[1], toUpload[2], toUpload[3], toUpload[4],
+                                               toUpload[5], toUpload[6], toUpload[7])
+        groups.setdefault(toUpload[0], []).append((toUpload, post))
+    return groups
+
+
+
+'''The function replayBatches splits the groups of a backed up chunk, as returned by groupBackupChunk, into a list of
+   (dbStr, group) batches of up to REPLAY_BATCH entries, one bulk insert each.'''
+def replayBatches(groups):
+    batches = []
+    for (dbStr, group) in groups.items():
+        for start in range(0, len(group), REPLAY_BATCH):
+            batches.append((dbStr, group[start:start + REPLAY_BATCH]))
+    return batches
+
+
+
+'''The function replayBatch uploads one (dbStr, group) batch of backed up entries with one bulk insert, and returns
+   its per-entry results. Error messages are backed up with the dbStr "error".'''
+def replayBatch(batch):
+    (dbStr, group) = batch
+    if (dbStr == "error"):
+        return dbClient.bulkErrorInsert([post for (toUpload, post) in group])
+    return dbClient.bulkUsageInsert(dbStr, [post for (toUpload, post) in group])
+
+
+
+'''The function replayResults handles the results of the bulk insert of one group of backed up entries. Entries which
+   failed to upload due to a connection problem, or whose bulk insert raised an exception (results is None), are
+   appended to the spool again, marked as unsent only if they still never reached the server.'''
+def replayResults(group, results):
+    results = pymongoClient.resultsOf(results, len(group))
+    for ((toUpload, post), result) in zip(group, results):
+        if (result == 0):
+            spool.append(backupEntry(toUpload[0], post, results))
+        elif (result != 1):
+            print "Corrupt Backup Usage Data. Discarded."
+
+
+
+'''The function backupEntry returns the entry backing up the usage data entry or error message "post" of the
+   collection dbStr, whose upload failed with the per-entry results "results". If the upload was refused by the open
+   circuit breaker, the entry never reached the server, and is marked as unsent, so that the backlog compactor may
+   merge it.'''
+def backupEntry(dbStr, post, results):
+    if isinstance(results, pymongoClient.unsentResults):
+        return [dbStr, post, backlogCompactor.UNSENT]
+    return [dbStr, post]
+
+
+
+'''The function healthChanged is called by the circuit breaker whenever the state of the database connection changes.
+   Once the breaker closes again, it wakes the backupThread to push the backed up data to the server.'''
+def healthChanged(oldState, newState):
+    if (newState == connectionHealth.CLOSED):
+        connRestored.set()
+
+
+
+'''The batchFlushThread class is a thread object which periodically uploads the usage data entries that have been
+   waiting in the usageWriter for longer than BATCH_AGE seconds, so that data of quiet collections is not held back
+   until a batch fills up. It also spills the backed up entries held in memory for SPOOL_MEMORY_AGE seconds to disk.'''
+class batchFlushThread(threading.Thread):
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.interval = BATCH_AGE / 2.0
+
+    def run(self):
+        while 1:
+            time.sleep(self.interval)
+            usageWriter.flushExpired()
+            spool.flushExpired()
 
 
 
 '''The heartbeatThread class is a thread object which is used to monitor the operational status of all measurement nodes
    belonging to the current water usage monitoring network. If any measurement node belonging to this network is deemed
    non-operational, an error message known as a "heartbeat error" for that node is uploaded to the database server to
-   inform the user/admin of its status. In addition, the heartbeatThread also monitors the operational status of the
-   Raspberry Pi unit itself. It does so by sending over a Raspberry Pi heartbeat message to the pi_heartbeat collection
-   once every hour.'''
+   inform the user/admin of its status. Only the nodes whose heartbeat state has changed in the heartbeat scheduler are
+   examined, and one heartbeat error message is uploaded per state change rather than one per check, along with an
+   occasional "still down" reminder for nodes which stay offline. The heartbeat errors and online status changes of
+   each check are uploaded together. In addition, the
+   heartbeatThread also monitors the operational status of the Raspberry Pi unit itself. It does so by sending over a
+   Raspberry Pi heartbeat message to the pi_heartbeat collection once every hour.'''
 class heartbeatThread(threading.Thread):
     def __init__(self):
         threading.Thread.__init__(self)
         self.piID = piID
         self.piTimer = None
         self.IPTimer = None
-        self.timeThreshold = TIME_THRESHOLD
-        self.lastHeartBeat = None
         self.timeNow = None
-        self.timeDiff = None
-        
+        #pendingStatus maps each node whose online status still has to be updated to the status it should be set to.
+        self.pendingStatus = {}
+
         '''The insertReturn parameter is for checking the return values of any heartbeat error inserts or Raspberry Pi
            heartbeat inserts'''
         self.insertReturn = None
-        self.dbPost = None
-        self.status = None
 
     def run(self):
-        global dataQ
-        global connFail
-        global meterDict
-        global networkID
         time.sleep(10)
         self.piTimer = time.time()
         self.IPTimer = time.time()
         while 1:
             time.sleep(15)
-            print "Performing Heartbeat Check"
-            #print "dataQ length is %d" %(len(dataQ))
-            self.timeNow = long(1000*time.time())
-
-            '''A heartbeat is performed for each node ID belong to the current water usage monitoring network.'''
-            for value in nodeList:
-                self.status = meterDict[value]
-                
-                '''Obtain the timestamp when the last usage data record belong to this node was received. Then compare
-                   the time difference between then and the current time. If the time difference exceeds the time
-                   threshold, this indicates a heartbeat error for that particular measurement node, and a corresponding
-                   heartbeat error message is uploaded to the database server.'''
-                if (self.status[0] in lastRecord):
-                    self.lastHeartBeat = lastRecord[self.status[0]]
-                    self.timeDiff = self.timeNow - self.lastHeartBeat[2]
-                    #print "now:", self.timeNow, "last:", self.lastHeartBeat[2]
-                    print self.timeDiff
-                    if (self.timeDiff > self.timeThreshold):
-                        print "Heartbeat error detected 1"
-                        #print "%d", self.timeDiff
-                        self.insertReturn = dbClient.attemptErrorInsert(self.status[0], self.lastHeartBeat[0], -1,
-                                                                        self.lastHeartBeat[2], self.timeNow,
-                                                                        0, "Heartbeat")
-                        if (self.insertReturn):
-                            connFail = False
-                        else:
-                            connFail = True
-
-                        '''The online status of the measurement node also needs to be checked. If a heartbeat error is
-                           detected for the current node, but its status is still set as online, then its status needs
-                           to be flipped offline.'''
-                        if self.status[1]:
-                            self.insertReturn = dbClient.attemptStatusUpdate(value, False)
-                            if (self.insertReturn):
-                                connFail = False
-                                meterDict[value] = (self.status[0], False)
-                            else:
-                                connFail = True
-
-                    #If no heartbeat error is detected for the this measurement node, but its online status is
-                    #currently set as False (offline), then its status needs to be flipped back to online.
-                    else:
-                        if not self.status[1]:
-                            self.insertReturn = dbClient.attemptStatusUpdate(value, True)
-                            if (self.insertReturn):
-                                connFail = False
-                                meterDict[value] = (self.status[0], True)
-                            else:
-                                connFail = True
-                                
-                #If no record exists so far for this measurement node, this means the node has been non-operational
-                #since the mainClient script has begun running. Thus, an error message still needs to be uploaded
-                #for this measurement node.
-                else:
-                    print "Heartbeat error detected 2"
-                    print "NodeID: %d" %(value)
-                    self.insertReturn = dbClient.attemptErrorInsert(self.status[0], -1, -1, -1,
-                                                                    self.timeNow, 0, "Heartbeat")
-                    if (self.insertReturn):
-                        connFail = False
-                    else:
-                        connFail = True
-
-                    '''The online status of the measurement node also needs to be checked. If a heartbeat error is
-                       detected for the current node, but its status is still set as online, then its status needs
-                       to be flipped offline.'''
-                    if self.status[1]:
-                        self.insertReturn = dbClient.attemptStatusUpdate(value, False)
-                        if (self.insertReturn):
-                            connFail = False
-                            meterDict[value] = (self.status[0], False)
-                        else:
-                            connFail = True
-
-            #print meterDict
-            for (k, v) in meterDict.items():
-                print "%d   %s" %(k, v[1])
-
-            '''If one hour has passed since the last time a Raspberry Pi heartbeat message has been uploaded, we upload
-               a new Raspberry Pi heartbeat message to the pi_heartbeat collection of the database server.'''
-            if (time.time() > self.piTimer + 3600):
-                self.insertReturn = dbClient.piHeartbeatInsert(self.piID, long(1000*time.time()),
-                                                               ni.ifaddresses('eth0')[17][0]['addr'])
-                if (self.insertReturn):
-                    connFail = False
-                else:
-                    connFail = True
-                self.piTimer = time.time()
-
-            if (time.time() > self.IPTimer + 21600):
-                if ("eth0" in ni.interfaces()):
-                    dbClient.pushIP(networkID, ni.ifaddresses('eth0')[17][0]['addr'])
-                self.IPTimer = time.time()
-
-
-
-'''The function singleUsageInsert performs a single usage data using the arguments wmid, counter, diff, intTemp,
-   extTemp, timestamp and timesstring. It uploads the data entry to the database server collection corresponding
-   to the dbStr argument.'''
+            (transitions, stillDown) = self.tick()
+            database.run(self.heartbeatCheck, transitions, stillDown, priority="status")
+            database.run(self.piCheck, priority="status")
+
+    '''The tick method reports the statistics of the main client, and returns the heartbeat transitions and "still
+       down" reminders which have become due in the heartbeat scheduler.'''
+    def tick(self):
+        print "Performing Heartbeat Check"
+        print "Pipeline stats: %s" %(pipeline.getStats())
+        print "Spool stats: %s" %(spool.getStats())
+        print "Protocol stats: %s" %(protocol.getStats())
+        print "Serial stats: %s" %(ports.getStats())
+        if database:
+            print "Database stats: %s" %(database.getStats())
+        self.timeNow = long(1000*time.time())
+        if DEADBAND_ENABLED:
+            print "Deadband stats: %s" %(deadband.getStats())
+        if ROLLUP_ENABLED:
+            print "Rollup stats: %s" %(rollup.getStats())
+            closeRollups(self.timeNow)
+        if HEARTBEAT_VECTORIZED:
+            print "Heartbeat stats: %s" %(scheduler.getStats())
+        print "Connection stats: %s" %(health.getStats())
+        print "Writer stats: %s" %(usageWriter.getStats())
+        return scheduler.tick(self.timeNow)
+
+    '''The piCheck method uploads the Raspberry Pi heartbeat message and IP address when they are due.'''
+    def piCheck(self):
+        global networkID
+        '''If one hour has passed since the last time a Raspberry Pi heartbeat message has been uploaded, we upload
+           a new Raspberry Pi heartbeat message to the pi_heartbeat collection of the database server.'''
+        if (time.time() > self.piTimer + 3600):
+            self.insertReturn = dbClient.piHeartbeatInsert(self.piID, long(1000*time.time()),
+                                                           ni.ifaddresses('eth0')[17][0]['addr'])
+            self.piTimer = time.time()
+
+        if (time.time() > self.IPTimer + 21600):
+            if ("eth0" in ni.interfaces()):
+                dbClient.pushIP(networkID, ni.ifaddresses('eth0')[17][0]['addr'])
+            self.IPTimer = time.time()
+
+    '''The heartbeatCheck method handles the (nodeID, state) transitions reported by the heartbeat scheduler. A node which
+       has gone offline gets a "Heartbeat" error message and is flipped offline, and a node which has recovered gets a
+       "Heartbeat Recovered" error message and is flipped back online. Nodes in stillDown get a "Heartbeat Still Down"
+       reminder. The error messages are uploaded with one bulk insert, and each group of status changes with one bulk
+       update. Transitions whose error message failed to upload are reported again at the next check, and status
+       changes which failed are retried at the next check.'''
+    def heartbeatCheck(self, transitions, stillDown):
+        (errorPosts, postTransitions) = self.errorUploads(transitions, stillDown)
+        if errorPosts:
+            self.errorResults(postTransitions, dbClient.bulkErrorInsert(errorPosts))
+        for (nodes, status) in self.statusUploads():
+            self.insertReturn = dbClient.bulkStatusUpdate(nodes, status)
+            self.statusResult(nodes, status, self.insertReturn)
+
+    '''The errorUploads method returns the heartbeat error messages to upload for the given transitions and "still
+       down" reminders, along with the transitions those messages report.'''
+    def errorUploads(self, transitions, stillDown):
+        errorPosts = []
+        postTransitions = []
+        for (value, state) in transitions:
+            if (state == heartbeatScheduler.OFFLINE):
+                errorPosts.append(self.heartbeatPost(value, "Heartbeat"))
+                postTransitions.append((value, state))
+                self.pendingStatus[value] = False
+            elif (state == heartbeatScheduler.RECOVERED):
+                errorPosts.append(self.heartbeatPost(value, "Heartbeat Recovered"))
+                postTransitions.append((value, state))
+                self.pendingStatus[value] = True
+        for value in stillDown:
+            errorPosts.append(self.heartbeatPost(value, "Heartbeat Still Down"))
+        print "Heartbeat transitions: %d, offline nodes: %d" %(len(transitions), scheduler.offlineCount())
+        return (errorPosts, postTransitions)
+
+    '''The errorResults method handles the results of the bulk insert of the heartbeat error messages. Transitions whose
+       message failed to upload are handed back to the heartbeat scheduler.'''
+    def errorResults(self, postTransitions, results):
+        scheduler.requeue([transition for (transition, result) in zip(postTransitions, results) if (result == 0)])
+
+    '''The statusUploads method returns the pending online status changes as a list of (node IDs, status) groups, one
+       bulk update each. Only nodes whose online status in the meter table differs from the wanted status need to be
+       updated.'''
+    def statusUploads(self):
+        for (value, status) in self.pendingStatus.items():
+            if (meters.status[meters.slotOf(value)] == status):
+                del self.pendingStatus[value]
+        groups = []
+        for status in [False, True]:
+            nodes = [value for (value, wanted) in self.pendingStatus.items() if (wanted == status)]
+            if nodes:
+                groups.append((nodes, status))
+        return groups
+
+    '''The statusResult method handles the result of the bulk update setting the online status of "nodes".'''
+    def statusResult(self, nodes, status, result):
+        if (result):
+            for value in nodes:
+                meters.status[meters.slotOf(value)] = int(status)
+                del self.pendingStatus[value]
+
+    '''The heartbeatPost method forms the heartbeat error message with the message errorMsg for the node "value". If a
+       record exists for this node, the message refers to its last usage data. Otherwise the node has been
+       non-operational since the mainClient script has begun running.'''
+    def heartbeatPost(self, value, errorMsg):
+        meter = meters.view(meters.slotOf(value))
+        if meter.hasRecord:
+            return pymongoClient.formErrorPost(meter.wmid, meter.counter, -1, meter.timestamp, self.timeNow, 0,
+                                               errorMsg)
+        return pymongoClient.formErrorPost(meter.wmid, -1, -1, -1, self.timeNow, 0, errorMsg)
+
+
+
+'''The function submitUpload calls the Pymongo Client method "methodName" with the tuple of arguments args, and passes
+   its return value to resultCallback. The call is handed to the database adapter, in the priority class "priority",
+   and resultCallback is called once the call is complete, without holding up the handling of serial frames.'''
+def submitUpload(methodName, args, resultCallback=None, priority=uploadScheduler.DEFAULT_PRIORITY):
+    if database:
+        database.submit(methodName, args, resultCallback, priority)
+    else:
+        result = getattr(dbClient, methodName)(*args)
+        if resultCallback:
+            resultCallback(result)
+
+
+
+'''The function uploadError uploads one error message to the error database, formed from the arguments wmid,
+   prevUsage, currUsage, prevTS, currTS, errorNo and errorMsg, as an alert which overtakes the usage data uploads.'''
+def uploadError(wmid, prevUsage, currUsage, prevTS, currTS, errorNo, errorMsg):
+    post = pymongoClient.formErrorPost(wmid, prevUsage, currUsage, prevTS, currTS, errorNo, errorMsg)
+    submitUpload("attemptErrorInsert", (wmid, prevUsage, currUsage, prevTS, currTS, errorNo, errorMsg),
+                 lambda result: errorUploadResult(result, post), "alert")
+
+
+
+'''The function errorUploadResult handles the return value of the upload of the error message "post". An error
+   message which failed to upload due to a connection problem, or whose upload raised an exception (None), is backed
+   up to the spool.'''
+def errorUploadResult(result, post):
+    if (result == 0) or (result is None):
+        spool.append(["error", post])
+    elif (result == -1):
+        print "Corrupt data. Bypass."
+
+
+
+'''The function singleUsageInsert queues a single usage data entry, formed from the arguments wmid, counter, diff,
+   intTemp, extTemp, timestamp and timesstring, for upload to the database server collection corresponding to the dbStr
+   argument. The entries queued for each collection are uploaded together by the usageWriter, and the outcome of every
+   entry is handled by usageBatchResult.'''
 def singleUsageInsert(dbStr, wmid, counter, diff, intTemp, extTemp, timestamp, timestring):
-    mainReturn = dbClient.attemptUsageInsert(dbStr, wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-    '''If the upload is successful, the Boolean flag connFail is switched to False.'''
-    if (mainReturn == 1):
-        connFail = False
-
-    #If the upload is unsuccessful, we determine whether the data needs to be backed up for future upload when
-    #connection is re-established.
-    elif (mainReturn == 0):
-        connFail = True
-        '''If the usage data is monthly, daily, hourly, or per-minute data, we will need to back up the data to
-           cache memory.'''
-        if (dbStr in ["month", "day", "hour", "min"]):
-            #print "Usage upload failed. Pushing to memcache..."
-            mem.valueSet(str(mem.getCacheCount()),[dbStr, wmid, counter, diff, intTemp, extTemp, timestamp, timestring])
-            backupLock.acquire()
-            mem.cacheCountIncrement()
-            backupLock.release()
-            #print "Memcache push successful"
+    usageWriter.add(dbStr, wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
+
+
+
+'''The function usageBatchResult is called by the usageWriter after each bulk upload to the collection corresponding to
+   dbStr. posts are the uploaded usage data entries and results holds the upload return value of each entry.'''
+def usageBatchResult(dbStr, posts, results):
+    for (post, result) in zip(posts, results):
+        '''If the upload is successful, there is nothing left to do. The outcome of the upload has already been
+           reported to the circuit breaker by the Pymongo Client.'''
+        if (result == 1):
+            continue
+
+        #If the upload is unsuccessful, we determine whether the data needs to be backed up for future upload when
+        #connection is re-established.
+        elif (result == 0):
+            '''If the usage data is monthly, daily, hourly, or per-minute data, we will need to back up the data to
+               the spool.'''
+            if (dbStr in ["month", "day", "hour", "min"]):
+                spool.append(backupEntry(dbStr, post, results))
+
+        else:
+            print "Corrupt Usage Upload Data. Discarded."
+
+
+
+'''The function recordUsage uploads one accepted reading of the water meter wmid. With ROLLUP_ENABLED, the reading is
+   added to the rollup windows of the water meter, and the aggregate entries of the windows it closes are uploaded.
+   Otherwise, the reading itself is uploaded to the collection "level" and every finer collection, as decided by
+   meterTable.packedRollupLevel, or not at all if level is None. With DEADBAND_ENABLED, a raw reading which carries no
+   news is not uploaded.'''
+def recordUsage(level, wmid, counter, diff, intTemp, extTemp, timestamp, timestring, period):
+    if ROLLUP_ENABLED:
+        for (dbStr, post) in rollup.add(wmid, counter, diff, intTemp, extTemp, timestamp, timestring, period):
+            usageWriter.addPost(dbStr, post)
+    elif level is not None:
+        #A reading which is only due for data_sec uploads nothing without SECOND_DATA, so it must not pass the deadband
+        #filter either, or it would become the last passed reading and suppress the next per-minute reading.
+        if (level == "sec") and (not SECOND_DATA):
+            return
+        if DEADBAND_ENABLED and (not deadband.check(wmid, counter, intTemp, extTemp, timestamp, level)):
+            return
+        multipleUsageInsert(level, wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
+
+
+
+'''The function closeRollups uploads the aggregate entries of the rollup windows whose period has ended by timeNow,
+   and saves the windows which are still open.'''
+def closeRollups(timeNow):
+    for (dbStr, post) in rollup.closeExpired(timeNow):
+        usageWriter.addPost(dbStr, post)
+    try:
+        rollup.save(ROLLUP_STATE)
+    except (IOError, OSError), e:
+        print "Rollup windows could not be saved. Error: %s." %(e)
 
-    else:
-        print "Corrupt Usage Upload Data. Discarded."
 
 
+#The usage collections, from the coarsest to the finest period.
+USAGE_LEVELS = ["month", "day", "hour", "min", "sec"]
 
 '''The function multipleUsageInsert determines how many single usage insert uploads needs to be performed for each
    piece of usage data. The possible collection tables a single piece of usage data needs to be uploaded to are the
    monthly table (data_month), the daily table (data_day), the hourly (data_hour), the per-minute (data_min), and the
-   per-second table (data_sec).'''
+   per-second table (data_sec). The usage data is uploaded to the collection belonging to dbStr and to every finer
+   collection, except for data_sec unless SECOND_DATA is set.'''
 def multipleUsageInsert(dbStr, wmid, counter, diff, intTemp, extTemp, timestamp, timestring):
-    if (dbStr == "month"):
-        singleUsageInsert("month", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        singleUsageInsert("day", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        singleUsageInsert("hour", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        singleUsageInsert("min", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        #singleUsageInsert("sec", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-    elif (dbStr == "day"):
-        singleUsageInsert("day", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        singleUsageInsert("hour", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        singleUsageInsert("min", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        #singleUsageInsert("sec", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-    elif (dbStr == "hour"):
-        singleUsageInsert("hour", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        singleUsageInsert("min", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        #singleUsageInsert("sec", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-    elif (dbStr == "min"):
-        singleUsageInsert("min", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-        #singleUsageInsert("sec", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-    #elif (dbStr == "sec"):
-        #singleUsageInsert("sec", wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
-
-
-
-'''The function tempConvert takes in one argument hexStr, which is a hexadecimal string indicating a temperature value.
-   tempConvert will convert hexStr to a decimal integer value indicating the temperature, and return that value.'''
-def tempConvert(hexStr):
+    for level in USAGE_LEVELS[USAGE_LEVELS.index(dbStr):]:
+        if (level != "sec") or SECOND_DATA:
+            singleUsageInsert(level, wmid, counter, diff, intTemp, extTemp, timestamp, timestring)
+
+
+
+'''The function handleKeyRequest replies to an encryption key request from a monitor node by providing the encryption
+   key value of the current network, as held in memory by the configuration store, on the port the request came from.'''
+def handleKeyRequest(fields):
+    ports.reply(";key_update,%s;\n" %(config.get().keyValue))
+
+
+
+'''The function configChanged is called by the configuration store whenever the configuration file has been rewritten
+   with new values, for instance by networkConfig.py.'''
+def configChanged(oldValues, newValues):
+    global networkID
+    print "Configuration changed: %s" %(newValues)
+    if newValues.networkID is not None:
+        networkID = newValues.networkID
+
+
+
+'''The function handleTimeRequest replies to a time request from a monitor node by providing the current time as a
+   timestring, on the port the request came from.'''
+def handleTimeRequest(fields):
+    ports.reply(datetime.now().strftime(';time,%Y,%m,%d,%H,%M,%S;\n'))
+
+
+
+'''The function handleUsage processes a usageRecord decoded from a usage data message sent over by a measurement node,
+   and uploads the data to the usage collections accordingly. The last record of the node's water meter is kept in
+   the node's slot of the meter table.'''
+def handleUsage(record):
+    #tempNode is the node ID, tempSlot its slot in the meter table, and tempID the water meter ID.
+    tempNode = record.nodeID
+    tempSlot = meters.slotOf(tempNode)
+    tempID = meters.wmids[tempSlot]
+    #tempCounter is the cumulative usage of this particular node.
+    tempCounter = record.counter
+    #tempDiff is the difference in water usage between now and the last usage data of this node.
+    tempDiff = record.diff
+    #tempIntTemp is the measured internal temperature of the measurement node device.
+    tempIntTemp = record.intTemp
+    #tempExtTemp is the measured temperature of the measurement node device's surrounding environment.
+    tempExtTemp = record.extTemp
+    #tempTime is the number of milliseconds since Epoch time of the timestamp sent by the measurement node,
+    #and tempPeriod is the tuple of its year, month, day, hour, minute and second.
+    try:
+        (tempTime, tempPeriod) = decoder.decode(record.timestring)
+    except ValueError, e:
+        if not meters.recorded[tempSlot]:
+            print "Timestamp error. Discarded."
+            return
+        print "Timestamp error. Using timestamp of last upload as approximation."
+        tempTime = long(meters.timestamp[tempSlot])
+        tempPeriod = meterTable.unpackPeriod(meters.period[tempSlot])
+    tempPacked = meterTable.packPeriod(tempPeriod)
+
+    '''If the water meter has no last record, this entry is the first usage data being sent over by this
+       particular measurement node.'''
+    if not meters.recorded[tempSlot]:
+        '''If the difference in usage data is negative, the network suspects possible hacking and tampering
+           of usage data. A corresponding error message will be uploaded to inform the user or admin.'''
+        if (tempDiff < 0):
+            uploadError(tempID, 0L, tempCounter, -1, tempTime, 4, "Altered Data")
+
+        #If we do not suspect data tampering, the usage data is uploaded to the usage collections.
+        else:
+            recordUsage("month", tempID, tempCounter, tempDiff,
+                        tempIntTemp, tempExtTemp, tempTime, record.timestring, tempPeriod)
+            '''The last record of this particular measurement node is updated.'''
+            meters.setRecord(tempSlot, tempCounter, tempDiff, tempTime, tempPacked)
+            scheduler.touch(tempNode, tempTime)
+
+    #If the water meter has a last record, we will compare the usage data collected this time around to the last
+    #usage data collected.
+    else:
+        '''If the cumulative usage actually gets decremented, an error message is uploaded to the database
+           server to inform the user or admin of possible tampering of data.'''
+        if (tempCounter < meters.counter[tempSlot]):
+            '''if (tempDiff < 0) or (tempCounter - tempDiff != tempLast[0]):
+               print "difference check error detected. Last record data of this node will be reset"'''
+            uploadError(tempID, long(meters.counter[tempSlot]), tempCounter, long(meters.timestamp[tempSlot]),
+                        tempTime, 1, "Decrement")
+
+        else:
+            '''Compare the timestamps of the current usage data and the last record of this node. Without the
+               rollup, the usage data is uploaded to the collection of the coarsest period which has changed since
+               the last record, and to every finer collection: a new year or month means month, day, hour and
+               minute, a new day means day, hour and minute, and so on. A new second only concerns the second
+               collection.'''
+            level = meterTable.packedRollupLevel(tempPacked, meters.period[tempSlot])
+            recordUsage(level, tempID, tempCounter, tempDiff, tempIntTemp,
+                        tempExtTemp, tempTime, record.timestring, tempPeriod)
+
+        '''Update the last record of this particular measurement node.'''
+        meters.setRecord(tempSlot, tempCounter, tempDiff, tempTime, tempPacked)
+        scheduler.touch(tempNode, tempTime)
+
+
+
+'''ERROR_TYPES maps the error code of an error message to the error number and error message uploaded to the error
+   database: Security Pin Disconnect, No Usage, Leakage and Decrement.'''
+ERROR_TYPES = {"00": (1, "Security Pin Disconnect"),
+               "01": (2, "No Usage"),
+               "10": (3, "Leakage"),
+               "11": (3, "Decrement")}
+
+'''The function handleError processes an errorRecord decoded from an error message sent over by a measurement node, and
+   uploads the corresponding error message to the error database so the user/admin is notified.'''
+def handleError(record):
+    tempID = meters.wmidOf(record.nodeID)
+    if record.errorCode not in ERROR_TYPES:
+        print "Corrupt data. Bypass."
+        return
+    (errorNo, errorMsg) = ERROR_TYPES[record.errorCode]
     try:
-        value = int(hexStr, 16)
-        if (value > 32767):
-            value -= 65536
-        return value
-    #Upon ValueError, the function returns 99999 which is a value out of expressable range by hexStr.
+        prevTime = decoder.decode(record.prevTimestring)[0]
+        currTime = decoder.decode(record.currTimestring)[0]
     except ValueError, e:
-        return 99999
-    
+        print "%s Timestamp Error. Bypass." %(errorMsg)
+        return
+    uploadError(tempID, record.prevUsage, record.currUsage, prevTime, currTime, errorNo, errorMsg)
+    #A Security Pin Disconnect also marks the water meter as breached.
+    if (record.errorCode == "00"):
+        submitUpload("securityBreach", (tempID,), priority="alert")
+
+
+
+'''Boot messages are not handled yet. A handler can be registered for them with protocol.register("boot", ...), along
+   the lines of the following draft:
+
+    result = message.split(",")
+    idValue = long(result[1], 16)
+    if (idValue not in nodeList):
+        nodeList.append(idValue)
+        nodeCount += 1
+        nodeFile = open(NODEFILENAME, "a")
+        nodeFile.write(str(idValue) + '\n')
+        nodeFile.close()
+        #check if idValue exists in onlineStatus
+        if idValue in onlineStatus:
+            #if so, check true or false
+            if not onlineStatus[idValue]:
+                #if false, set it true and update data_stat
+                #onlineStatus[idValue] = True
+                mainReturn = dbClient.attemptStatusUpdate(idValue, True)
+                if (mainReturn):
+                    onlineStatus[idValue] = True
+        #if idValue does not exist in onlineStatus
+        else:
+            #then add to onlineStatus with True setting
+            onlineStatus[idValue] = True
+            #and insert new entry to data_stat
+            mainReturn = dbClient.attemptStatusInsert(idValue, piID, True)'''
+
+#The dispatch table of the serial protocol. Frames from nodes missing from the meter table are quarantined.
+protocol = serialProtocol.frameDispatcher(lambda nodeID: nodeID in meters)
+protocol.register("key_req", serialProtocol.decodeRaw, handleKeyRequest)
+protocol.register("time_req", serialProtocol.decodeRaw, handleTimeRequest)
+protocol.register("usage", serialProtocol.decodeUsage, handleUsage, reuseRecord=True)
+protocol.register("error", serialProtocol.decodeError, handleError, reuseRecord=True)
+
+
+
+'''The coroutine heartbeatTask performs the heartbeat checks of the async runtime, in the same way as the heartbeatThread
+   does in the classic runtime. The heartbeat state is held by a heartbeatThread instance which is never started, and
+   the database calls are made through the asynchronous database adapter, so the heartbeat scheduler is only ever used
+   by the event loop. A check that fails is reported, rather than stopping the runtime, and the next one is made 15
+   seconds later.'''
+@asyncRuntime.coroutine
+def heartbeatTask(heartbeat):
+    yield asyncRuntime.From(asyncRuntime.sleep(10))
+    heartbeat.piTimer = time.time()
+    heartbeat.IPTimer = time.time()
+    while 1:
+        yield asyncRuntime.From(asyncRuntime.sleep(15))
+        try:
+            (transitions, stillDown) = heartbeat.tick()
+            (errorPosts, postTransitions) = heartbeat.errorUploads(transitions, stillDown)
+            if errorPosts:
+                results = yield asyncRuntime.From(database.call("bulkErrorInsert", errorPosts, priority="status"))
+                heartbeat.errorResults(postTransitions, results)
+            for (nodes, status) in heartbeat.statusUploads():
+                result = yield asyncRuntime.From(database.call("bulkStatusUpdate", nodes, status, priority="status"))
+                heartbeat.statusResult(nodes, status, result)
+            yield asyncRuntime.From(database.run(heartbeat.piCheck, priority="status"))
+        except Exception, e:
+            print "Heartbeat check failed. Error: %s." %(e)
+
+
+
+'''The coroutine replayTask pushes the backed up data in the spool to the database server in the async runtime, in
+   the same way as the backupThread does in the classic runtime, except that the bulk inserts of a chunk are all in
+   flight at once, up to ASYNC_UPLOADS of them. The spool is checked once every second, and the backed up entries held
+   in memory for SPOOL_MEMORY_AGE seconds are spilled to disk. A chunk that fails to replay is reported, rather than
+   stopping the runtime, and is read again from the spool a second later, as it has not been committed.'''
+@asyncRuntime.coroutine
+def replayTask():
+    while 1:
+        try:
+            spool.flushExpired()
+            if spool.compactDue(long(1000*time.time())):
+                yield asyncRuntime.From(database.run(spool.compact, long(1000*time.time()), priority="backlog"))
+            if (spool.pendingCount() > 0) and health.ready() and (pipeline.getStats()["depth"] <= REPLAY_YIELD_DEPTH):
+                chunkStart = time.time()
+                entries = spool.readBatch(REPLAY_CHUNK)
+                if entries:
+                    batches = replayBatches(groupBackupChunk(entries))
+                    results = yield asyncRuntime.From(asyncRuntime.gather(
+                        [database.run(replayBatch, batch, priority="backlog") for batch in batches]))
+                    for ((dbStr, group), groupResults) in zip(batches, results):
+                        replayResults(group, groupResults)
+                    spool.commit(entries[-1][0])
+                    #Rate limiting: a chunk of n entries takes at least n / REPLAY_RATE seconds.
+                    timeLeft = float(len(entries)) / REPLAY_RATE - (time.time() - chunkStart)
+                    yield asyncRuntime.From(asyncRuntime.sleep(max(timeLeft, 0)))
+                    continue
+        except Exception, e:
+            print "Backup replay failed. Error: %s." %(e)
+        yield asyncRuntime.From(asyncRuntime.sleep(1))
+
+
+
+'''The function runAsync runs the main client in the async runtime. A single event loop reads the serial port, handles
+   every frame, flushes the usage batches and performs the heartbeat checks and backup replay, while up to
+   ASYNC_UPLOADS database calls are in flight at once. It never returns.'''
+def runAsync():
+    global database
+    global usageWriter
+    global pipeline
+    loop = asyncRuntime.newLoop()
+    database = asyncRuntime.asyncDatabase(dbClient, loop, ASYNC_UPLOADS, PRIORITY_WEIGHTS)
+    usageWriter = pymongoClient.scheduledBatchWriter(database, BATCH_SIZE, BATCH_AGE, usageBatchResult, WRITE_CONCERN,
+                                                     CHECKPOINT_SIZE, CHECKPOINT_AGE)
+    #The serial source takes the place of the ingest pipeline, and reports the same statistics.
+    pipeline = asyncRuntime.asyncSerialSource(ports, loop, QUEUE_SIZE, serialProtocol.framePriority, PRIORITY_WEIGHTS)
+    pipeline.start()
+
+    #Send over a serial message to the monitor nodes to signal the main script is ready to operate.
+    ports.broadcast(";main;")
+
+    loop.run_until_complete(asyncRuntime.gather([pipeline.serve(serialPorts.handle(protocol.dispatch)),
+                                                 heartbeatTask(heartbeatThread()),
+                                                 replayTask(),
+                                                 asyncRuntime.periodic(BATCH_AGE / 2.0, usageWriter.flushExpired)]))
+
+
+
+'''The function runClassic runs the main client in the classic runtime, with a reader thread per serial port, a pool of
+   upload worker threads, and the backupThread, heartbeatThread and batchFlushThread. It returns once the reader
+   threads have stopped.'''
+def runClassic():
+    global database
+    global usageWriter
+    global pipeline
+    #Start the upload scheduler, which makes the database calls by priority class.
+    database = uploadScheduler.uploadScheduler(dbClient, SCHEDULER_WORKERS, PRIORITY_WEIGHTS, QUEUE_SIZE)
+    database.start()
+    #Establish the usage writer, which uploads usage data entries in batches per collection, through the scheduler.
+    usageWriter = pymongoClient.scheduledBatchWriter(database, BATCH_SIZE, BATCH_AGE, usageBatchResult, WRITE_CONCERN,
+                                                     CHECKPOINT_SIZE, CHECKPOINT_AGE)
+
+    #Start the ingest pipeline, with one bounded queue per upload worker. Messages are routed to the workers by node
+    #ID, so the messages of each measurement node are still processed in the order they were received. The messages
+    #are (port name, frame) pairs, so that replies go back to the port the frame came from. Within each queue, key and
+    #time requests and error messages overtake the usage data.
+    pipeline = uploadPipeline.ingestPipeline(serialPorts.handle(protocol.dispatch), UPLOAD_WORKERS, QUEUE_SIZE,
+                                             OVERFLOW_POLICY, serialPorts.itemFunction(serialProtocol.frameKey),
+                                             serialPorts.itemFunction(serialProtocol.framePriority), PRIORITY_WEIGHTS)
+    pipeline.start()
+
+    #Send over a serial message to the monitor nodes to signal the main script is ready to operate.
+    ports.broadcast(";main;")
+
+    #Start the backupThread, heartbeatThread and batchFlushThread instances. The backupThread is woken up whenever the
+    #database connection is restored.
+    health.subscribe(healthChanged)
+    myBackupThread = backupThread()
+    myHeartbeatThread = heartbeatThread()
+    myBatchFlushThread = batchFlushThread()
+    myBackupThread.start()
+    myHeartbeatThread.start()
+    myBatchFlushThread.start()
+
+    #The reader threads read messages from the serial ports and hand them to the pipeline. They are joined with a
+    #timeout, as a join without one would keep the main thread from ever running the signal handler of shutdown.
+    readerThreads = [serialPorts.portReaderThread(port, pipeline) for port in ports]
+    for readerThread in readerThreads:
+        readerThread.start()
+    for readerThread in readerThreads:
+        while readerThread.isAlive():
+            readerThread.join(1.0)
+
+
+
+'''The function saveBacklog backs up the usage data entries still waiting in the usage writer, whether in a batch or
+   for a checkpoint, and then spills the backed up entries held in memory to disk and closes the spools, so that they
+   are all replayed after the restart. It is called when the main client stops, and may be called more than once.'''
+def saveBacklog():
+    if usageWriter:
+        usageWriter.failAll()
+    spool.close()
+
+
+
+'''The function shutdown stops the main client when it receives SIGTERM (as sent by the init system) or SIGINT. The
+   pending usage data and backlog are saved with saveBacklog, and the process ends at once, as the scheduler and worker
+   threads never stop of their own accord.'''
+def shutdown(signalNumber, frame):
+    print "Signal %d received. Saving the backup spool and stopping the main client..." %(signalNumber)
+    try:
+        saveBacklog()
+        ports.close()
+    finally:
+        os._exit(0)
+
 
 
 if __name__ == "__main__":
 
-    #Establish connection of the Serial Connection client.
-    ser.connect()
+    #Open the serial ports, flushing their input and output. A port which cannot be opened is retried by its reader.
+    if (ports.connect() < len(ports)):
+        print "Not every serial port could be opened: %s" %(ports.getStats())
 
     #Establish connection of the Pymongo Client.
     dbClient.connect()
 
-    #Flush serial input and output.
-    ser.flushInput()
-    ser.flushOutput()
-
     #Populate the nodeList.
     nodeFile = open(NODEFILENAME, "r")
     for line in nodeFile:
@@ -334,24 +957,25 @@ if __name__ == "__main__":
     print "Here is the node list:\n"
     print nodeList
 
-    #Read the config file to obtain configuration values and the network ID
-    configFile = open(CONFIG_NAME, "r")
-    oldNU = int(configFile.readline().strip('\n').split(',')[1])
-    leakResult = configFile.readline().strip('\n').split(',')
-    oldLeakInterval = int(leakResult[1])
-    oldLeakStreak = int(leakResult[2])
-    oldKeyValue = configFile.readline().strip('\n').split(',')[1]
-    networkID = configFile.readline().strip('\n').split(',')[1]
-    configFile.close()
+    #Read the config file to obtain configuration values and the network ID. The configuration store keeps them in
+    #memory from now on, and reloads them whenever the file is rewritten.
+    configValues = config.load()
+    oldNU = configValues.noUsage
+    oldLeakInterval = configValues.leakInterval
+    oldLeakStreak = configValues.leakStreak
+    oldKeyValue = configValues.keyValue
+    networkID = configValues.networkID
+    config.subscribe(configChanged)
+    config.start()
 
     #Send over a serial message to the monitor node to signal the main script is ready to operate.
     #ser.write(";main;")
 
-    #Populate the meterDict
+    #Populate the meter table, with one slot per measurement node.
     meterList = dbClient.getMeterID(networkID)
     if (meterList):
         for entry in meterList:
-            meterDict[entry["nodeid"]] = (entry["wmid"], entry["status"])
+            meters.add(entry["nodeid"], entry["wmid"], entry["status"])
     elif (meterList == []):
         print "No water meter ID to node device ID associations have been established yet."
         time.sleep(1)
@@ -359,253 +983,71 @@ if __name__ == "__main__":
         time.sleep(1)
         print "Please make sure you follow the manual instructions."
         time.sleep(10)
-    print "Here is the meterDict: \n"
-    print meterDict
-
-    #Populate the lastRecord
-    #lastRecord keys should now be meterIDs rather than nodeIDs
-    for value in nodeList:
-        result = dbClient.retrieveLastRecord(meterDict[value][0])
-        if (result):
-            lastRecord[result[0]["wmid"]] = [result[0]["counter"], result[0]["diff"], result[0]["timestamp"], result[0]["timestring"]]
+    print "Here is the meter table: \n"
+    print meters.getStats()
+
+    #Populate the last records of the meter table.
+    #The latest records of all water meters are fetched with one query. Only the water meters missing from its result
+    #are queried individually, several at a time.
+    meterIDs = [meters.wmidOf(value) for value in nodeList]
+    records = dbClient.retrieveLastRecords(meterIDs)
+    if records is None:
+        records = {}
+    missing = [wmid for wmid in meterIDs if wmid not in records]
+    if missing:
+        lastRecordPool = ThreadPool(LAST_RECORD_WORKERS)
+        for result in lastRecordPool.map(dbClient.retrieveLastRecord, missing):
+            if (result):
+                records[result[0]["wmid"]] = result[0]
+        lastRecordPool.close()
+    for (wmid, entry) in records.items():
+        #A last record with an unreadable timestring gets an empty period, so the next usage data starts a new month.
+        try:
+            period = decoder.period(str(entry["timestring"]))
+        except ValueError, e:
+            period = (0, 0, 0, 0, 0, 0)
+        meters.setRecord(meters.slotOfMeter(wmid), entry["counter"], entry["diff"], entry["timestamp"],
+                         meterTable.packPeriod(period))
     print "Here is the last record:\n"
-    print lastRecord
-
-    #Establish the Python Memcached client.
-    mem.connect()
+    for meter in meters.views():
+        print meter
 
-    #Send over a serial message to the monitor node to signal the main script is ready to operate.
-    ser.write(";main;")
+    #Register every node with the heartbeat scheduler, with the timestamp of its last record as its last heartbeat.
+    timeNow = long(1000*time.time())
+    for value in nodeList:
+        meter = meters.view(meters.slotOf(value))
+        if meter.hasRecord:
+            scheduler.register(value, meter.timestamp, meter.online, timeNow)
+        else:
+            scheduler.register(value, None, meter.online, timeNow)
+        if HEARTBEAT_VECTORIZED and (value in HEARTBEAT_THRESHOLDS):
+            scheduler.setThresholds(value, *HEARTBEAT_THRESHOLDS[value])
+
+    #Open the backup spool. It is closed, with the pending usage data backed up to it, when the main client stops.
+    spool.connect()
+    atexit.register(saveBacklog)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    #Restore the rollup windows which were open when the main client last stopped.
+    if ROLLUP_ENABLED:
+        try:
+            rollup.load(ROLLUP_STATE)
+        except (IOError, ValueError), e:
+            print "No saved rollup windows. Starting with empty windows."
 
-    #Start both the backupThread and heartbeatThread instances.
-    myBackupThread = backupThread()
-    myHeartbeatThread = heartbeatThread()
-    myBackupThread.start()
-    myHeartbeatThread.start()
-    
     #configTimer = time.time()
 
-    while 1:
-        #Read the next message sent via the serial port
-        message = ser.read()
-        #print "Received message: "
-        #print message
-
-        message = message.strip("\n").strip(";")
-
-        #Check the message received is not corrupt.
-        if (set(message).issubset(allowedSet)):
-
-            '''If the message is an encryption key request from the monitor node, reply by providing the encryption
-               key value of the current network.'''
-            if (message.startswith('key_req')):
-                configFile = open(CONFIG_NAME, "r")
-                configFile.readline()
-                configFile.readline()
-                keyValue = configFile.readline().strip('\n').split(',')[1]
-                configFile.close()
-                ser.write(";key_update,%s;\n" %(keyValue))
-
-            '''If the message is a time request from the monitor node, reply by providing the current time as a
-               timestring.'''
-            if (message.startswith('time_req')):
-                ser.write(datetime.now().strftime(';time,%Y,%m,%d,%H,%M,%S;\n'))
-
-            
-            '''if (message.startswith('boot')):
-                result = message.split(",")
-                idValue = long(result[1], 16)
-                if (idValue not in nodeList):
-                    nodeList.append(idValue)
-                    nodeCount += 1
-                    nodeFile = open(NODEFILENAME, "a")
-                    nodeFile.write(str(idValue) + '\n')       
-                    nodeFile.close()
-                    #check if idValue exists in onlineStatus
-                    if idValue in onlineStatus:
-                        #if so, check true or false
-                        if not onlineStatus[idValue]: 
-                            #if false, set it true and update data_stat
-                            #onlineStatus[idValue] = True
-                            mainReturn = dbClient.attemptStatusUpdate(idValue, True)
-                            if (mainReturn):
-                                connFail = False
-                                onlineStatus[idValue] = True
-                            else:
-                                connFail = True
-                    #if idValue does not exist in onlineStatus
-                    else:
-                        #then add to onlineStatus with True setting
-                        onlineStatus[idValue] = True
-                        #and insert new entry to data_stat
-                        mainReturn = dbClient.attemptStatusInsert(idValue, piID, True)
-                        if (mainReturn):
-                            connFail = False
-                        else:
-                            connFail = True'''
-            
-
-            #Caution: tempID is now meterID, rather than nodeID. Thus, lastRecord keys should now be meterIDs as well.
-            '''If the message is usage data from a measurement node, then process the data accordingly.'''
-            if (message.startswith('usage')):
-                result = message.split(",")
-                #print result
-
-                #tempID is the water meter ID.
-                tempID = meterDict[long(result[1], 16)][0]
-                #tempCounter is the cumulative usage of this particular node.
-                tempCounter = long(result[2], 16)
-                #tempDiff is the difference in water usage between now and the last usage data of this node.
-                tempDiff = long(result[3], 16)
-                #tempIntTemp is the measured internal temperature of the measurement node device.
-                tempIntTemp = tempConvert(result[4])
-                #tempExtTemp is the measured temperature of the measurement node device's surrounding environment.
-                tempExtTemp = tempConvert(result[5])
-                #tempTime is the number of milliseconds since Epoch time of the timestamp sent by the measurement node.
-                try:
-                    tempTime = long(1000*time.mktime(time.strptime(result[6], "%Y%m%d%H%M%S")))
-                except:
-                    print "Timestamp error. Using timestamp of last upload as approximation."
-                    
-
-                '''If tempID is not in lastRecord, it means this entry is the first usage data being sent over by this
-                   particular measurement node.'''
-                if (tempID not in lastRecord):
-                    '''If the difference in usage data is negative, the network suspects possible hacking and tampering
-                       of usage data. A corresponding error message will be uploaded to inform the user or admin.'''
-                    if (tempDiff < 0):
-                        mainReturn = dbClient.attemptErrorInsert(tempID, 0L, tempCounter, -1,
-                                                                 tempTime, 4, "Altered Data")
-                        if (mainReturn):
-                            connFail = False
-                        else:
-                            connFail = True
-
-                    #If we do not suspect data tampering, the usage data is uploaded to the usage collections.
-                    else:
-                        multipleUsageInsert("month", tempID, tempCounter, tempDiff,
-                                            tempIntTemp, tempExtTemp, tempTime, result[6])
-                        '''The last record of this particular measurement node is updated.'''
-                        lastRecord[tempID] = [tempCounter, tempDiff, tempTime, result[6]]
-
-                #If tempID is in lastRecord, we will compare the usage data collected this time around to the last
-                #usage data collected.
-                else:
-                    tempLast = lastRecord[tempID]
-
-                    '''If the cumulative usage actually gets decremented, an error message is uploaded to the database
-                       server to inform the user or admin of possible tampering of data.'''
-                    if (tempCounter < tempLast[0]):
-                        '''if (tempDiff < 0) or (tempCounter - tempDiff != tempLast[0]):
-                           print "difference check error detected. Last record data of this node will be reset"'''
-                        mainReturn = dbClient.attemptErrorInsert(tempID, tempLast[0], tempCounter,
-                                                                 tempLast[2], tempTime, 1, "Decrement")
-                        if (mainReturn):
-                            connFail = False
-                        else:
-                            connFail = True
-
-                    else:
-                        '''Compare the timestamps of the current usage data and the last record of this node.'''
-                        '''If the year is not equal, this means we have entered a new year. Thus, we need to upload
-                           this usage data to all the usage collections (month, day, hour, minute and second).'''
-                        if (result[6][0:4] != tempLast[3][0:4]):
-                            #push into data_month, day, hour, min and sec
-                            multipleUsageInsert("month", tempID, tempCounter, tempDiff, tempIntTemp,
-                                                tempExtTemp, tempTime, result[6])
-
-                        #If year is equal but not the month, this means we have entered a new month. Thus, we need
-                        #to upload this usage data to all the usage collections (month, day, hour, minute and
-                        #second).
-                        elif (result[6][4:6] != tempLast[3][4:6]):
-                            #push into data_month, day, hour, min and sec
-                            multipleUsageInsert("month", tempID, tempCounter, tempDiff, tempIntTemp,
-                                                tempExtTemp, tempTime, result[6])
-
-                        #If year and month are equal, but not the day, this means we have entered a new day. Thus,
-                        #we need to upload this usage data to the day, hour, minute and second collections.
-                        elif (result[6][6:8] != tempLast[3][6:8]):
-                            #push into data_day, hour, min and sec
-                            multipleUsageInsert("day", tempID, tempCounter, tempDiff, tempIntTemp,
-                                                tempExtTemp, tempTime, result[6])
-
-                        #If year, month and day are equal, but not the hour, this means we have entered a new hour.
-                        #Thus, we need to upload this usage data to the hour, minute and second collections.
-                        elif (result[6][8:10] != tempLast[3][8:10]):
-                            #push into data_hour, min and sec
-                            multipleUsageInsert("hour", tempID, tempCounter, tempDiff, tempIntTemp,
-                                                tempExtTemp, tempTime, result[6])
-
-                        #If year, month, hour and day are equal, but not the minute, this means we have entered a new
-                        #minute. Thus, we need to upload this usage data to the minute and second collections.
-                        elif (result[6][10:12] != tempLast[3][10:12]):
-                            #push into data_min and sec
-                            multipleUsageInsert("min", tempID, tempCounter, tempDiff, tempIntTemp,
-                                                tempExtTemp, tempTime, result[6])
-
-                        #If year, month, hour, day and minute are equal, but not the second, this means we have
-                        #entered a new minute. Thus, we need to upload this usage data to the second collection.
-                        elif (result[6][12:14] != tempLast[3][12:14]):
-                            #push into data_sec
-                            multipleUsageInsert("sec", tempID, tempCounter, tempDiff, tempIntTemp,
-                                                tempExtTemp, tempTime, result[6])
-
-                    '''Update the last record of this particular measurement node.'''
-                    lastRecord[tempID] = [tempCounter, tempDiff, tempTime, result[6]]                 
-
-
-            '''If the message is an error message from a measurement node, we process the data and upload the
-               corresponding error message to the error database so the user/admin is notified.'''
-            if (message.startswith('error')):
-                result = message.split(",")
-                tempID = meterDict[long(result[1], 16)][0]
-
-                #This is a Security Pin Disconnect error message.
-                if ("00" == result[6]):
-                    try:
-                        mainReturn = dbClient.attemptErrorInsert(tempID, long(result[2], 16), long(result[3], 16),
-                                                                 long(1000*time.mktime(time.strptime(result[4], "%Y%m%d%H%M%S"))),
-                                                                 long(1000*time.mktime(time.strptime(result[5], "%Y%m%d%H%M%S"))),
-                                                                 1, "Security Pin Disconnect")
-                        dbClient.securityBreach(tempID)
-                    except ValueError, e:
-                        print "Security Pin Timestamp Error. Bypass."
-
-                #This is a No Usage error message.
-                elif ("01" == result[6]):
-                    try:
-                        mainReturn = dbClient.attemptErrorInsert(tempID, long(result[2], 16), long(result[3], 16),
-                                                                 long(1000*time.mktime(time.strptime(result[4], "%Y%m%d%H%M%S"))),
-                                                                 long(1000*time.mktime(time.strptime(result[5], "%Y%m%d%H%M%S"))),
-                                                                 2, "No Usage")
-                    except ValueError, e:
-                        print "No Usage Timestamp Error. Bypass."
-
-                #This is a Leakage error message.
-                elif ("10" == result[6]):
-                    try:
-                        mainReturn = dbClient.attemptErrorInsert(tempID, long(result[2], 16), long(result[3], 16),
-                                                                 long(1000*time.mktime(time.strptime(result[4], "%Y%m%d%H%M%S"))),
-                                                                 long(1000*time.mktime(time.strptime(result[5], "%Y%m%d%H%M%S"))),
-                                                                 3, "Leakage")
-                    except ValueError, e:
-                        print "Leakage Timestamp Error. Bypass."
-
-                #This is a Decrement error message.
-                elif ("11" == result[6]):
-                    try:
-                        mainReturn = dbClient.attemptErrorInsert(tempID, long(result[2], 16), long(result[3], 16),
-                                                                 long(1000*time.mktime(time.strptime(result[4], "%Y%m%d%H%M%S"))),
-                                                                 long(1000*time.mktime(time.strptime(result[5], "%Y%m%d%H%M%S"))),
-                                                                 3, "Decrement")
-                    except valueError, e:
-                        print "Decrement Timestamp Error. Bypass."
-                if (mainReturn == 1):
-                    connFail = False
-                elif (mainReturn == 0):
-                    connFail = True
-                else:
-                    print "Corrupt data. Bypass."
-
-                    
-    ser.close()
+    #Run the main client in the runtime selected by RUNTIME_MODE, or by the --async or --classic argument.
+    if ("--async" in sys.argv):
+        RUNTIME_MODE = "async"
+    elif ("--classic" in sys.argv):
+        RUNTIME_MODE = "classic"
+    print "Runtime mode: %s" %(RUNTIME_MODE)
+    if (RUNTIME_MODE == "async"):
+        runAsync()
+    else:
+        runClassic()
+
+    ports.close()
+    saveBacklog()
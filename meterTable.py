@@ -0,0 +1,173 @@
+'''This Python script, meterTable.py, holds the state of every water meter of this water usage monitoring network in one
+   table. Each measurement node is given a dense integer slot when it is added, and the state of its water meter (the
+   online status and the last record: counter, usage difference, timestamp and period) is kept in typed arrays, one
+   array per field. Recording a reading only overwrites the fields of its slot, so no lists, tuples or strings are
+   created per message, and the whole network's timestamps lie in one contiguous array.'''
+from array import array
+
+'''The period of a timestamp is packed into one number with the digits YYYYMMDDHHMMSS. PACKED_LEVELS lists, from the
+   coarsest to the finest period, the divisor which leaves the digits of that period, and the usage collection that a
+   change of the period concerns, as returned by packedRollupLevel.'''
+PACKED_LEVELS = [(100000000, "month"), (1000000, "day"), (10000, "hour"), (100, "min"), (1, "sec")]
+
+
+'''The function packPeriod packs the tuple of period integers (year, month, day, hour, minute, second) into one
+   number.'''
+def packPeriod(period):
+    return ((((period[0]*100 + period[1])*100 + period[2])*100 + period[3])*100 + period[4])*100 + period[5]
+
+
+
+'''The function unpackPeriod returns the tuple of period integers of the packed period "packed".'''
+def unpackPeriod(packed):
+    packed = long(packed)
+    return (int(packed / 10000000000), int(packed / 100000000 % 100), int(packed / 1000000 % 100),
+            int(packed / 10000 % 100), int(packed / 100 % 100), int(packed % 100))
+
+
+
+'''The function packedRollupLevel compares the packed periods of the current reading "curr" and of the last reading
+   "last" of a water meter, and returns the coarsest usage collection whose period has changed, or None if both
+   readings fall within the same second.'''
+def packedRollupLevel(curr, last):
+    curr = long(curr)
+    last = long(last)
+    for (divisor, level) in PACKED_LEVELS:
+        if (curr / divisor != last / divisor):
+            return level
+    return None
+
+
+
+'''The meterView class is a view of one slot of a meterTable, giving access to the fields of one water meter by name.
+   It holds no state of its own.'''
+class meterView(object):
+    __slots__ = ["table", "slot"]
+
+    def __init__(self, table, slot):
+        self.table = table
+        self.slot = slot
+
+    @property
+    def nodeID(self):
+        return self.table.nodeIDs[self.slot]
+
+    @property
+    def wmid(self):
+        return self.table.wmids[self.slot]
+
+    @property
+    def online(self):
+        return bool(self.table.status[self.slot])
+
+    @property
+    def hasRecord(self):
+        return bool(self.table.recorded[self.slot])
+
+    @property
+    def counter(self):
+        return long(self.table.counter[self.slot])
+
+    @property
+    def diff(self):
+        return long(self.table.diff[self.slot])
+
+    @property
+    def timestamp(self):
+        return long(self.table.timestamp[self.slot])
+
+    @property
+    def period(self):
+        return unpackPeriod(self.table.period[self.slot])
+
+    @property
+    def timestring(self):
+        return "%014d" %(self.table.period[self.slot])
+
+    def __repr__(self):
+        if self.hasRecord:
+            return "meter(node=%s, wmid=%s, online=%s, counter=%s, diff=%s, timestamp=%s, timestring=%s)" \
+                   %(self.nodeID, self.wmid, self.online, self.counter, self.diff, self.timestamp, self.timestring)
+        return "meter(node=%s, wmid=%s, online=%s, no record)" %(self.nodeID, self.wmid, self.online)
+
+
+
+'''The meterTable class assigns a slot to each measurement node, and keeps the state of its water meter in columns
+   indexed by slot. The counter, usage difference, timestamp (milliseconds since Epoch time) and packed period columns
+   are arrays of doubles, which hold integers exactly up to 2**53 on every platform, including 32-bit Raspberry Pi
+   systems where a C long has 32 bits. The status and recorded columns are arrays of bytes.'''
+class meterTable(object):
+
+    def __init__(self):
+        #slots maps each node ID to its slot, and meterSlots each water meter ID to its slot.
+        self.slots = {}
+        self.meterSlots = {}
+        self.nodeIDs = []
+        self.wmids = []
+        self.status = array("b")
+        self.recorded = array("b")
+        self.counter = array("d")
+        self.diff = array("d")
+        self.timestamp = array("d")
+        self.period = array("d")
+
+    '''The add method adds the measurement node nodeID, attached to the water meter wmid with the online status
+       "online", and returns its slot. A node which is already in the table keeps its slot, and gets the new water
+       meter ID and status.'''
+    def add(self, nodeID, wmid, online):
+        slot = self.slots.get(nodeID)
+        if slot is None:
+            slot = len(self.nodeIDs)
+            self.slots[nodeID] = slot
+            self.nodeIDs.append(nodeID)
+            self.wmids.append(wmid)
+            for column in [self.status, self.recorded]:
+                column.append(0)
+            for column in [self.counter, self.diff, self.timestamp, self.period]:
+                column.append(0.0)
+        else:
+            del self.meterSlots[self.wmids[slot]]
+            self.wmids[slot] = wmid
+        self.meterSlots[wmid] = slot
+        self.status[slot] = int(bool(online))
+        return slot
+
+    def __contains__(self, nodeID):
+        return nodeID in self.slots
+
+    def __len__(self):
+        return len(self.nodeIDs)
+
+    '''The slotOf method returns the slot of the measurement node nodeID, or None if it is not in the table.'''
+    def slotOf(self, nodeID):
+        return self.slots.get(nodeID)
+
+    '''The slotOfMeter method returns the slot of the water meter wmid, or None if it is not in the table.'''
+    def slotOfMeter(self, wmid):
+        return self.meterSlots.get(wmid)
+
+    '''The wmidOf method returns the water meter ID of the measurement node nodeID.'''
+    def wmidOf(self, nodeID):
+        return self.wmids[self.slots[nodeID]]
+
+    '''The setRecord method records the last reading of the water meter in "slot": its counter, usage difference,
+       timestamp, and packed period.'''
+    def setRecord(self, slot, counter, diff, timestamp, packedPeriod):
+        self.counter[slot] = counter
+        self.diff[slot] = diff
+        self.timestamp[slot] = timestamp
+        self.period[slot] = packedPeriod
+        self.recorded[slot] = 1
+
+    '''The view method returns a meterView of "slot".'''
+    def view(self, slot):
+        return meterView(self, slot)
+
+    '''The views method returns the meterViews of all slots, in slot order.'''
+    def views(self):
+        return [meterView(self, slot) for slot in range(len(self.nodeIDs))]
+
+    '''The getStats method returns the number of meters in the table, the number online, and the number with a last
+       record.'''
+    def getStats(self):
+        return {"meters": len(self.nodeIDs), "online": sum(self.status), "recorded": sum(self.recorded)}
@@ -4,6 +4,7 @@ along the way towards completing the desired configuration changes.'''
 import serial
 import time
 import pymongoClient
+import configStore
 
 #The IP address of the MongoDB database server
 MONGO_IP = "ds033018.mongolab.com"
@@ -111,14 +112,12 @@ if __name__ == "__main__":
     ser.flushInput()
     ser.flushOutput()
 
-    configFile = open(CONFIG_NAME, "r")
-    oldNU = configFile.readline().strip('\n').split(',')[1]
-    leakResult = configFile.readline().strip('\n').split(',')
-    oldLeakInterval = leakResult[1]
-    oldLeakStreak = leakResult[2]
-    oldKeyValue = configFile.readline().strip('\n').split(',')[1]
-    networkID = configFile.readline().strip('\n').split(',')[1]
-    configFile.close()
+    currentConfig = configStore.readConfig(CONFIG_NAME)
+    oldNU = str(currentConfig.noUsage).zfill(5)
+    oldLeakInterval = str(currentConfig.leakInterval).zfill(2)
+    oldLeakStreak = str(currentConfig.leakStreak).zfill(2)
+    oldKeyValue = currentConfig.keyValue
+    networkID = currentConfig.networkID
 
     nodeFile = open(NODEFILE_NAME, "r")
     for line in nodeFile:
@@ -184,12 +183,9 @@ if __name__ == "__main__":
         else:
             print "Incorrect response. Try again."
 
-    configFile = open(CONFIG_NAME, "r+")
-    configFile.truncate()
-    configFile.write('NU,' + finalNU + '\n')
-    configFile.write('LK,' + oldLeakInterval + ',' + oldLeakStreak + '\n')
-    configFile.write('KY,' + oldKeyValue + '\n')
-    configFile.close()
+    #Atomically rewrite the config file, so the main client never reads a half-written file.
+    configStore.writeConfig(CONFIG_NAME, configStore.configValues(int(finalNU), int(oldLeakInterval),
+                                                                  int(oldLeakStreak), oldKeyValue, networkID))
 
     while 1:
         print "Would you like to change the leakage check interval and continuation threshold values? (Y/N)"
@@ -249,12 +245,8 @@ if __name__ == "__main__":
         else:
             print "Incorrect response. Try again."
 
-    configFile = open(CONFIG_NAME, "r+")
-    configFile.truncate()
-    configFile.write('NU,' + finalNU + '\n')
-    configFile.write('LK,' + finalLeakInterval + ',' + finalLeakStreak + '\n')
-    configFile.write('KY,' + oldKeyValue + '\n')
-    configFile.close()
+    configStore.writeConfig(CONFIG_NAME, configStore.configValues(int(finalNU), int(finalLeakInterval),
+                                                                  int(finalLeakStreak), oldKeyValue, networkID))
 
     while 1:
         print "Would you like to change the encryption key value? (Y/N)"
@@ -309,13 +301,8 @@ if __name__ == "__main__":
             print "Incorrect response. Try again."
 
     #Update config.txt
-    configFile = open(CONFIG_NAME, "r+")
-    configFile.truncate()
-    configFile.write('NU,' + finalNU + '\n')
-    configFile.write('LK,' + finalLeakInterval + ',' + finalLeakStreak + '\n')
-    configFile.write('KY,' + finalKeyValue + '\n')
-    configFile.write('NWID,' + networkID + '\n')
-    configFile.close()
+    configStore.writeConfig(CONFIG_NAME, configStore.configValues(int(finalNU), int(finalLeakInterval),
+                                                                  int(finalLeakStreak), finalKeyValue, networkID))
 
     #Need to update database as well
     dbClient.manualConfigUpdate(networkID, int(finalNU), int(finalLeakInterval),
@@ -3,6 +3,7 @@
 import serial
 import time
 import pymongoClient
+import configStore
 
 #The IP address of the MongoDB database server
 MONGO_IP = "ds033018.mongolab.com"
@@ -103,14 +104,12 @@ if __name__ == "__main__":
     for node in nodeList:
         print '00' + hex(node)[2:-1]
 
-    #Open the configuration file and obtain the current configuration values.
-    configFile = open(CONFIG_NAME, "r")
-    noUsageValue = configFile.readline().strip('\n').split(',')[1]
-    leakResult = configFile.readline().strip('\n').split(',')
-    leakInterval = leakResult[1]
-    leakStreak = leakResult[2]
-    keyValue = configFile.readline().strip('\n').split(',')[1]
-    configFile.close()
+    #Read the configuration file and obtain the current configuration values.
+    currentConfig = configStore.readConfig(CONFIG_NAME)
+    noUsageValue = str(currentConfig.noUsage).zfill(5)
+    leakInterval = str(currentConfig.leakInterval).zfill(2)
+    leakStreak = str(currentConfig.leakStreak).zfill(2)
+    keyValue = currentConfig.keyValue
 
     #Using the function oldIDCheck, request for the ID of the malfunctioning node and remove it from the nodeList.
     oldID = oldIDCheck(nodeList)
@@ -351,11 +350,8 @@ if __name__ == "__main__":
                     print "New node acknowledged."
 
     #Update node list file to include the new replacement node ID in the file along with the other existing nodes.
-    nodeFile = open(NODEFILE_NAME, "r+")
-    nodeFile.truncate()
-    for idValue in nodeList:
-        nodeFile.write(str(idValue) + '\n')
-    nodeFile.close()
+    #The file is replaced atomically, so it is never left half-written.
+    configStore.atomicWrite(NODEFILE_NAME, "".join([str(idValue) + '\n' for idValue in nodeList]))
 
     #Update the corresponding table in the database server,
     #to associate the meter ID to the new replacement node,
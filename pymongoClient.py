@@ -2,8 +2,102 @@
    This allows retrieval and uploading of water usage data from and to the database server.'''
 import pymongo
 import time
+import socket
+import threading
 from pymongo.errors import AutoReconnect
 from pymongo.errors import ConnectionFailure
+from pymongo.errors import BulkWriteError
+from pymongo.errors import DuplicateKeyError
+from bson.son import SON
+import serialProtocol
+from connectionHealth import connectionHealth
+#The document _ids and the per-entry upload results are defined in uploadDocuments.py, and available from here too.
+from uploadDocuments import usageID, errorID, unsentResults, resultsOf, withID
+
+#The length, in milliseconds, of the period covered by one bucket document of each bucket span.
+BUCKET_LENGTHS = {"hour": 3600000, "day": 86400000}
+'''The write concerns of the usageBatchWriter. With "acknowledged", every bulk insert waits for the acknowledgement of
+   the server. With "pipelined", bulk inserts are sent without waiting, and confirmed together by an acknowledged
+   checkpoint write sent after them on the same connection.'''
+WRITE_CONCERNS = ["acknowledged", "pipelined"]
+#The write concern of the pipelined bulk inserts, which are not acknowledged by the server.
+UNACKNOWLEDGED = {"w": 0}
+'''The socket timeout, in milliseconds, of the pipelined connection. A checkpoint is only acknowledged once the server
+   has applied every write sent before it, which takes longer than a single write.'''
+PIPELINE_TIMEOUT_MS = 5000
+'''The socket timeout, in milliseconds, of the one-off connection used by retrieveLastRecords at startup. The
+   aggregation covers every water meter of the network, and takes far longer than any single upload.'''
+STARTUP_TIMEOUT_MS = 60000
+
+'''The function formUsagePost forms one usage data entry (JSON) from the parameters wmid, counter, diff, intTemp, extTemp,
+   tstamp and tstring.'''
+def formUsagePost(wmid, counter, diff, intTemp, extTemp, tstamp, tstring):
+    return {"wmid": wmid, "counter": counter, "diff": diff, "intTemp": intTemp,
+            "extTemp": extTemp, "timestamp": tstamp, "timestring": tstring}
+
+
+
+'''The error codes of a write rejected because a document with the same _id exists already. As every usage, error and
+   heartbeat document has a deterministic _id, such a write was already uploaded by an earlier attempt.'''
+DUPLICATE_KEY_CODES = (11000, 11001, 12582)
+
+
+
+'''The function formErrorPost forms one error data entry (JSON) from the parameters wmid, prevUsage, currUsage, prevTS,
+   currTS, errorNo and errorMsg.'''
+def formErrorPost(wmid, prevUsage, currUsage, prevTS, currTS, errorNo, errorMsg):
+    return {"wmid": wmid, "prev_usage": prevUsage, "curr_usage": currUsage,
+            "prev_ts": prevTS, "curr_ts": currTS, "errorNo": errorNo, "errorMsg": errorMsg}
+
+
+
+'''The function compactReading forms the entry of the usage data entry "post" within the readings array of a bucket
+   document starting at bucketStart: t is the number of milliseconds since the start of the bucket, c the counter, d
+   the usage difference, i and e the internal and external temperatures, and n the number of readings of an aggregate
+   entry.'''
+def compactReading(post, bucketStart):
+    reading = {"t": post["timestamp"] - bucketStart, "c": post["counter"], "d": post["diff"],
+               "i": post["intTemp"], "e": post["extTemp"]}
+    if "samples" in post:
+        reading["n"] = post["samples"]
+    return reading
+
+
+
+'''The function bucketUpdate forms the upsert appending the usage data entries "posts", all of the same water meter
+   and bucket, to that bucket document. Besides the readings array, a bucket document holds summary fields: the
+   number of readings, the summed usage difference, the temperature ranges, and the first and last readings. first
+   and last are maintained with $min and $max, which compare embedded documents field by field, so the reading with
+   the earliest or latest timestamp wins even if entries arrive out of order.'''
+def bucketUpdate(posts, bucketStart, span):
+    readings = [compactReading(post, bucketStart) for post in posts]
+    first = min(posts, key=lambda post: post["timestamp"])
+    last = max(posts, key=lambda post: post["timestamp"])
+    update = {"$push": {"readings": {"$each": readings}},
+              "$inc": {"samples": len(posts), "diff": sum([post["diff"] for post in posts])},
+              "$min": {"first": SON([("timestamp", first["timestamp"]), ("counter", first["counter"]),
+                                     ("diff", first["diff"]), ("timestring", first["timestring"])])},
+              "$max": {"last": SON([("timestamp", last["timestamp"]), ("counter", last["counter"]),
+                                    ("diff", last["diff"]), ("timestring", last["timestring"])])},
+              "$setOnInsert": {"span": span}}
+    #Aggregate entries carry their own temperature ranges. Unreadable temperatures are left out of the ranges.
+    for name in ["intTemp", "extTemp"]:
+        temps = [post.get(name + "Min", post[name]) for post in posts] + \
+                [post.get(name + "Max", post[name]) for post in posts]
+        temps = [temp for temp in temps if (temp is not None) and (temp != serialProtocol.INVALID_TEMP)]
+        if temps:
+            update["$min"][name + "Min"] = min(temps)
+            update["$max"][name + "Max"] = max(temps)
+    return update
+
+
+
+'''The function lastFromBucket returns the last reading of a bucket document as a raw usage data entry, with the
+   fields wmid, counter, diff, timestamp and timestring.'''
+def lastFromBucket(bucket):
+    last = bucket["last"]
+    return {"wmid": bucket["wmid"], "counter": last["counter"], "diff": last["diff"],
+            "timestamp": last["timestamp"], "timestring": last["timestring"]}
 
 
 
@@ -13,16 +107,40 @@ class pymongoClient(object):
 
     '''The following are properties needed to establish the pymongoClient instance:
        IP address and port of the database server
-       Username and Password authentication'''
-    def __init__(self, IP, port=33018, username="kherani", password="stevey"):
+       Username and Password authentication
+       bucketSpans maps the usage collections written in bucketed mode (for instance "min" and "sec") to the span of
+       their bucket documents, "hour" or "day". In bucketed mode, a collection holds one document per water meter and
+       bucket span, and every usage data entry is appended to the readings array of its bucket document, instead of
+       being inserted as a document of its own.
+       health is the connectionHealth circuit breaker shared by every thread using this client. While it is open,
+       uploads fail at once with the same return value as a connection failure, so the caller backs up the data
+       without waiting for a timeout.'''
+    def __init__(self, IP, port=33018, username="kherani", password="stevey", bucketSpans=None, health=None):
         #IP is a string, port is an int
         self.hostname = IP
         self.port = port
         self.username = username
         self.password = password
+        for span in (bucketSpans or {}).values():
+            if span not in BUCKET_LENGTHS:
+                raise ValueError("Unknown bucket span: %s" %(span))
+        self.bucketSpans = dict(bucketSpans or {})
+        self.health = health or connectionHealth()
         self.dbDict = None
         self.conn = None
         self.db = None
+        '''The pipelined connection is opened on first use, with a single socket, so the server applies the pipelined
+           writes and the checkpoints in the order they were sent. pipeLock keeps that order across threads.'''
+        self.pipeConn = None
+        self.pipeDB = None
+        self.pipeLock = threading.Lock()
+        '''pipeGeneration counts the pipelined connections dropped after a failure, and confirmedGeneration is the
+           pipeGeneration of the connection the last checkpoint went through. A checkpoint only confirms the writes
+           before it if both are the same, as a new connection knows nothing of the writes lost with the old one.'''
+        self.pipeGeneration = 0
+        self.confirmedGeneration = 0
+        #The _id of the checkpoint document of this client in the upload_checkpoints collection.
+        self.checkpointID = socket.gethostname()
         '''self.data_month = None
         self.data_day = None
         self.data_hour = None
@@ -35,21 +153,24 @@ class pymongoClient(object):
     '''The method connect makes the official connection to the MongoDB database server based on the parameters
        provided in the init method. In addition, it sets the timeout for each upload and data retrieval method
        to 400 milliseconds. This method will attempt to connect to the database server continuously until a
-       connection is successfully established.'''
+       connection is successfully established, waiting longer after every failed attempt.'''
     def connect(self):
         while 1:
+            self.health.wait()
             try:
                 self.conn = pymongo.MongoClient(self.hostname, self.port, socketTimeoutMS=400, connectTimeoutMS=400)
+                self.health.success()
                 print "Successfully connected to server"
                 break
             except AutoReconnect, e:
-                print "Connection to server failed. Retrying in 3 seconds..."
-                time.sleep(3)
+                self.health.failure()
+                print "Connection to server failed. Retrying in %.1f seconds..." %(self.health.retryIn())
             except ConnectionFailure, e:
-                print "Connection Failure. Retrying in 3 seconds..."
-                time.sleep(3)
-            except:
-                pass
+                self.health.failure()
+                print "Connection Failure. Retrying in %.1f seconds..." %(self.health.retryIn())
+            except pymongo.errors.PyMongoError, e:
+                self.health.failure()
+                print "Connection error: %s. Retrying in %.1f seconds..." %(e, self.health.retryIn())
         self.db = self.conn.heroku_app16536491
         self.db.authenticate(self.username, self.password)
         '''self.data_month = self.db.data_month
@@ -63,64 +184,371 @@ class pymongoClient(object):
         #initialize the dbDict
         self.dbDict = {"month":self.db.data_month, "day":self.db.data_day, "hour":self.db.data_hour,
                        "min":self.db.data_min, "sec":self.db.data_sec}
+        '''Bucket documents are looked up by water meter ID and bucket start, for every upsert and last record query.
+           The index is unique, so an upsert whose reading is already in its bucket is rejected as a duplicate key
+           instead of creating a second bucket document.'''
+        for dbStr in self.bucketSpans:
+            try:
+                self.dbDict[dbStr].ensure_index([("wmid", pymongo.ASCENDING), ("bucket", pymongo.DESCENDING)],
+                                                unique=True)
+            except (AutoReconnect, ConnectionFailure), e:
+                print "Bucket index of data_%s could not be ensured." %(dbStr)
+        '''The last record queries look up the latest entries of data_min by water meter ID and timestamp. The index is
+           built in the background, as data_min may already be large.'''
+        if "min" not in self.bucketSpans:
+            try:
+                self.db.data_min.ensure_index([("wmid", pymongo.ASCENDING), ("timestamp", pymongo.DESCENDING)],
+                                              background=True)
+            except (AutoReconnect, ConnectionFailure), e:
+                print "Last record index of data_min could not be ensured."
 
 
     '''The method retrieveLastRecord queries the database server collection data_min, to obtain the latest usage data
        uploaded to the database, which belongs to the measurement node with the water meter ID "value". It returns the
        data in the format of a list with one data entry. This method will attempt to query continuously until a result
-       is returned. If connection to the server fails, it will retry again after 3 seconds.'''
+       is returned. If connection to the server fails, it will retry again once the retry delay of the circuit breaker
+       has passed. If data_min is written in bucketed mode, the last reading of the latest bucket document of the water
+       meter is returned instead.'''
     def retrieveLastRecord(self, value):
         while 1:
+            self.health.wait()
             try:
-                return list(self.db.data_min.find({"wmid": value}).sort("timestamp", pymongo.DESCENDING).limit(1))
+                if "min" in self.bucketSpans:
+                    buckets = self.db.data_min.find({"wmid": value}).sort("bucket", pymongo.DESCENDING).limit(1)
+                    result = [lastFromBucket(bucket) for bucket in buckets]
+                else:
+                    records = self.db.data_min.find({"wmid": value}).sort("timestamp", pymongo.DESCENDING).limit(1)
+                    result = list(records)
+                self.health.success()
+                return result
             except AutoReconnect, e:
-                print "Connection to server failed. Retrying in 3 seconds..."
-                time.sleep(3)
+                self.health.failure()
+                print "Connection to server failed. Retrying in %.1f seconds..." %(self.health.retryIn())
             except ConnectionFailure, e:
-                print "Connection Failure. Retrying in 3 seconds..."
-                time.sleep(3)
-            except:
-                pass
+                self.health.failure()
+                print "Connection Failure. Retrying in %.1f seconds..." %(self.health.retryIn())
+
+
+    '''The method retrieveLastRecords takes a list of water meter IDs "values", and queries the database server
+       collection data_min with a single aggregation, to obtain the latest usage data uploaded for every one of those
+       water meters. It returns a dictionary mapping each water meter ID to its latest data entry. Water meters without
+       any usage data are left out of the dictionary. If connection to the server fails, None is returned. If data_min
+       is written in bucketed mode, the last readings of the latest bucket documents are returned instead. The
+       aggregation is a one-off query at startup, so it is made over a connection of its own, with a socket timeout of
+       STARTUP_TIMEOUT_MS rather than the 400 milliseconds of the uploads, and may sort on disk.'''
+    def retrieveLastRecords(self, values):
+        if not self.health.allow():
+            return None
+        if "min" in self.bucketSpans:
+            (sortKey, prefix) = ("bucket", "$last.")
+        else:
+            (sortKey, prefix) = ("timestamp", "$")
+        pipeline = [{"$match": {"wmid": {"$in": list(values)}}},
+                    {"$sort": SON([("wmid", pymongo.ASCENDING), (sortKey, pymongo.DESCENDING)])},
+                    {"$group": {"_id": "$wmid", "counter": {"$first": prefix + "counter"},
+                                "diff": {"$first": prefix + "diff"}, "timestamp": {"$first": prefix + "timestamp"},
+                                "timestring": {"$first": prefix + "timestring"}}}]
+        startupConn = None
+        try:
+            startupConn = pymongo.MongoClient(self.hostname, self.port, socketTimeoutMS=STARTUP_TIMEOUT_MS,
+                                              connectTimeoutMS=400)
+            startupDB = startupConn.heroku_app16536491
+            startupDB.authenticate(self.username, self.password)
+            result = startupDB.data_min.aggregate(pipeline, allowDiskUse=True)
+            #Older versions of PyMongo return the aggregation result as a dictionary rather than as a cursor.
+            if isinstance(result, dict):
+                result = result["result"]
+            records = {}
+            for entry in result:
+                entry["wmid"] = entry.pop("_id")
+                records[entry["wmid"]] = entry
+            self.health.success()
+            return records
+        except AutoReconnect, e:
+            self.health.failure()
+            print "Last record aggregation unsuccessful. Error: AutoReconnect."
+            return None
+        except ConnectionFailure, e:
+            self.health.failure()
+            print "Last record aggregation unsuccessful. Error: ConnectionFailure."
+            return None
+        except:
+            self.health.release()
+            return None
+        finally:
+            if startupConn is not None:
+                startupConn.close()
 
 
     '''The method attemptUsageInsert takes the parameters wmid, counter, diff, intTemp, extTemp, tstamp and tstring,
        forms one usage data entry (JSON), and attempts to upload the entry to the usage collection belonging to dbStr.
        Upon successful uploading, the method returns one. Otherwise, a corresponding error message is printed and zero
-       is returned.'''
+       is returned. The entry is inserted with its usageID, so an entry which has been uploaded before counts as
+       uploaded.'''
     def attemptUsageInsert(self, dbStr, wmid, counter, diff, intTemp, extTemp, tstamp, tstring):
+        if dbStr in self.bucketSpans:
+            post = formUsagePost(wmid, counter, diff, intTemp, extTemp, tstamp, tstring)
+            return self.bulkUsageInsert(dbStr, [post])[0]
+        if not self.health.allow():
+            return 0
         try:
             tempPost = {"wmid": wmid, "counter": counter, "diff": diff, "intTemp": intTemp,
                         "extTemp": extTemp, "timestamp": tstamp, "timestring": tstring}
+            tempPost["_id"] = usageID(dbStr, tempPost)
             #Find the corresponding database collection from the database dictionary, with dbStr as the key.
             self.dbDict[dbStr].insert(tempPost)
+            self.health.success()
+            return 1
+        except DuplicateKeyError, e:
+            self.health.success()
             return 1
         except AutoReconnect, e:
+            self.health.failure()
             print "Usage upload unsuccessful. Error: AutoReconnect."
             return 0
         except ConnectionFailure, e:
+            self.health.failure()
             print "Usage upload unsuccessful. Error: ConnectionFailure."
             return 0
         except:
+            self.health.release()
             return -1
 
 
+    '''The method bulkUsageInsert takes the parameter dbStr and a list of usage data entries (JSON) "posts", and attempts
+       to upload all of the entries to the usage collection belonging to dbStr in a single unordered bulk insert. It
+       returns a list holding one value per entry, in the same order as "posts": one if the entry was uploaded, zero if
+       the upload failed due to a connection problem, and negative one if the entry was rejected by the server. If the
+       circuit breaker refused the upload, the list is an unsentResults, as no entry was sent. Every
+       entry is inserted with its usageID, and an entry which has been uploaded before counts as uploaded. Collections
+       written in bucketed mode are uploaded with bucketUsageInsert instead.'''
+    def bulkUsageInsert(self, dbStr, posts):
+        if dbStr in self.bucketSpans:
+            return self.bucketUsageInsert(dbStr, posts)
+        return self.bulkInsert(self.dbDict[dbStr], [withID(post, usageID(dbStr, post)) for post in posts],
+                               "Bulk usage")
+
+
+    '''The method bucketUsageInsert appends the usage data entries "posts" to the bucket documents of the collection
+       belonging to dbStr, with one upsert per entry, all sent in a single unordered bulk operation. It returns one
+       value per entry, in the same way as bulkUsageInsert. Each upsert only matches its bucket document while the
+       entry's reading is not yet in it, so an entry which has been uploaded before is neither appended nor counted
+       again: its upsert is rejected as a duplicate bucket, and it counts as uploaded. With "pipelined", the upserts
+       are sent over the pipelined connection without waiting for the server, as by pipelinedUsageInsert.'''
+    def bucketUsageInsert(self, dbStr, posts, pipelined=False):
+        if not posts:
+            return []
+        if not self.health.allow():
+            return unsentResults([0] * len(posts))
+        span = self.bucketSpans[dbStr]
+        length = BUCKET_LENGTHS[span]
+        results = [1] * len(posts)
+        #pending holds the indices in posts of the entries whose upsert is to be sent.
+        pending = range(len(posts))
+        try:
+            '''An upsert rejected as a duplicate key has either found its reading already in the bucket, or raced
+               another upsert creating the same bucket. Those upserts are sent once more, as by then the bucket exists
+               and a second rejection can only mean the reading is already there.'''
+            for attempt in range(2):
+                if pipelined:
+                    bulk = self.pipeDatabase()["data_" + dbStr].initialize_unordered_bulk_op()
+                else:
+                    bulk = self.dbDict[dbStr].initialize_unordered_bulk_op()
+                for index in pending:
+                    post = posts[index]
+                    bucketStart = post["timestamp"] - post["timestamp"] % length
+                    bulk.find({"wmid": post["wmid"], "bucket": bucketStart,
+                               "readings.t": {"$ne": post["timestamp"] - bucketStart}}).upsert() \
+                        .update_one(bucketUpdate([post], bucketStart, span))
+                try:
+                    bulk.execute(UNACKNOWLEDGED if pipelined else None)
+                    break
+                except BulkWriteError, e:
+                    #The index of a write error is the index of the rejected upsert within pending.
+                    duplicates = []
+                    for writeError in e.details.get("writeErrors", []):
+                        if writeError.get("code") in DUPLICATE_KEY_CODES:
+                            duplicates.append(pending[writeError["index"]])
+                        else:
+                            results[pending[writeError["index"]]] = -1
+                    pending = duplicates
+                    if not pending:
+                        break
+            self.sendSucceeded(pipelined)
+            return results
+        except AutoReconnect, e:
+            self.sendFailed(pipelined)
+            print "Bucket usage upload unsuccessful. Error: AutoReconnect."
+            return [0] * len(posts)
+        except ConnectionFailure, e:
+            self.sendFailed(pipelined)
+            print "Bucket usage upload unsuccessful. Error: ConnectionFailure."
+            return [0] * len(posts)
+        except:
+            self.health.release()
+            return [-1] * len(posts)
+
+
+    '''The method bulkErrorInsert takes a list of error data entries (JSON) "posts", and attempts to upload all of the
+       entries to the error message collection in a single unordered bulk insert, each with its errorID. It returns one
+       value per entry, in the same way as bulkUsageInsert.'''
+    def bulkErrorInsert(self, posts):
+        return self.bulkInsert(self.db.data_error, [withID(post, errorID(post)) for post in posts], "Bulk error")
+
+
+    '''The method bulkInsert uploads the entries "posts" to "collection" in a single unordered bulk insert, and returns
+       the list of per-entry results for bulkUsageInsert and bulkErrorInsert. label names the upload in error
+       messages. With "pipelined", the bulk insert is not acknowledged, and one only means the entry has been sent.'''
+    def bulkInsert(self, collection, posts, label, pipelined=False):
+        if not posts:
+            return []
+        if not self.health.allow():
+            return unsentResults([0] * len(posts))
+        try:
+            bulk = collection.initialize_unordered_bulk_op()
+            for post in posts:
+                bulk.insert(post)
+            bulk.execute(UNACKNOWLEDGED if pipelined else None)
+            self.sendSucceeded(pipelined)
+            return [1] * len(posts)
+        except BulkWriteError, e:
+            self.health.success()
+            #Only the entries listed in writeErrors were rejected, every other entry of the batch has been uploaded.
+            #An entry rejected for its duplicate _id was uploaded by an earlier attempt.
+            results = [1] * len(posts)
+            for writeError in e.details.get("writeErrors", []):
+                if writeError.get("code") not in DUPLICATE_KEY_CODES:
+                    results[writeError["index"]] = -1
+            return results
+        except AutoReconnect, e:
+            self.sendFailed(pipelined)
+            print "%s upload unsuccessful. Error: AutoReconnect." %(label)
+            return [0] * len(posts)
+        except ConnectionFailure, e:
+            self.sendFailed(pipelined)
+            print "%s upload unsuccessful. Error: ConnectionFailure." %(label)
+            return [0] * len(posts)
+        except:
+            self.health.release()
+            return [-1] * len(posts)
+
+
+    '''The method pipelinedUsageInsert sends the usage data entries "posts" to the usage collection belonging to dbStr
+       in a single unordered bulk insert over the pipelined connection, without waiting for the server. It returns one
+       value per entry, in the same way as bulkUsageInsert, except that one only means the entry has been sent. The
+       entries are uploaded once a later checkpoint is confirmed.'''
+    def pipelinedUsageInsert(self, dbStr, posts):
+        self.pipeLock.acquire()
+        try:
+            if dbStr in self.bucketSpans:
+                return self.bucketUsageInsert(dbStr, posts, pipelined=True)
+            try:
+                collection = self.pipeDatabase()["data_" + dbStr]
+            except (AutoReconnect, ConnectionFailure), e:
+                self.sendFailed(True)
+                print "Pipelined usage upload unsuccessful. Error: %s." %(e.__class__.__name__)
+                return [0] * len(posts)
+            return self.bulkInsert(collection, [withID(post, usageID(dbStr, post)) for post in posts],
+                                   "Pipelined usage", pipelined=True)
+        finally:
+            self.pipeLock.release()
+
+
+    '''The method checkpoint writes the checkpoint document of this client over the pipelined connection, and waits
+       for the server to acknowledge it. As the server applies the writes of a connection in order, the acknowledgement
+       confirms every pipelined insert sent before it over the same connection. It returns True if the checkpoint is
+       confirmed, and False if the pipelined inserts since the previous checkpoint may have been lost, which is also
+       the case if the pipelined connection has been dropped and opened again since then.'''
+    def checkpoint(self):
+        if not self.health.allow():
+            return False
+        self.pipeLock.acquire()
+        try:
+            self.pipeDatabase().upload_checkpoints.update({"_id": self.checkpointID},
+                                                          {"$set": {"timestamp": long(1000*time.time())},
+                                                           "$inc": {"count": 1}}, upsert=True)
+            self.health.success()
+            confirmed = (self.pipeGeneration == self.confirmedGeneration)
+            self.confirmedGeneration = self.pipeGeneration
+            return confirmed
+        except AutoReconnect, e:
+            self.sendFailed(True)
+            print "Checkpoint unsuccessful. Error: AutoReconnect."
+            return False
+        except ConnectionFailure, e:
+            self.sendFailed(True)
+            print "Checkpoint unsuccessful. Error: ConnectionFailure."
+            return False
+        except:
+            self.health.release()
+            return False
+        finally:
+            self.pipeLock.release()
+
+
+    '''The method pipeDatabase returns the database of the pipelined connection, opening the connection on first use.
+       The connection has a single socket, so every pipelined write and checkpoint goes through the same one. The
+       caller must hold pipeLock.'''
+    def pipeDatabase(self):
+        if self.pipeDB is None:
+            self.pipeConn = pymongo.MongoClient(self.hostname, self.port, max_pool_size=1,
+                                                socketTimeoutMS=PIPELINE_TIMEOUT_MS, connectTimeoutMS=400)
+            pipeDB = self.pipeConn.heroku_app16536491
+            pipeDB.authenticate(self.username, self.password)
+            self.pipeDB = pipeDB
+        return self.pipeDB
+
+
+    '''The method sendSucceeded reports a bulk operation which went through to the circuit breaker. A pipelined bulk
+       operation is not acknowledged, so it only frees the trial call of a half open breaker: the connection is known
+       to be back once a checkpoint has been acknowledged.'''
+    def sendSucceeded(self, pipelined):
+        if pipelined:
+            self.health.release()
+        else:
+            self.health.success()
+
+
+    '''The method sendFailed reports a connection failure to the circuit breaker. If the failure was on the pipelined
+       connection, the connection is dropped, so the next pipelined write opens a new one, and every pipelined insert
+       since the last confirmed checkpoint counts as lost. The caller must hold pipeLock in that case.'''
+    def sendFailed(self, pipelined):
+        self.health.failure()
+        if pipelined and (self.pipeDB is not None):
+            try:
+                self.pipeConn.close()
+            except Exception, e:
+                pass
+            (self.pipeConn, self.pipeDB) = (None, None)
+            self.pipeGeneration += 1
+
+
     '''The method attemptErrorInsert takes the parameters wmid, prevUsage, currUsage, prevTS, currTS, errorNo and
        errorMsg, forms one error data entry (JSON), and attempts to upload the entry to the error message collection
        in the database server. Upon successful uploading, the method returns one. Otherwise, a corresponding error
        message is printed and zero is returned.'''
     def attemptErrorInsert(self, wmid, prevUsage, currUsage, prevTS, currTS, errorNo, errorMsg):
+        if not self.health.allow():
+            return 0
         try:
-            tempPost = {"wmid": wmid, "prev_usage": prevUsage, "curr_usage": currUsage,
-                        "prev_ts": prevTS, "curr_ts": currTS, "errorNo": errorNo, "errorMsg": errorMsg}
+            tempPost = formErrorPost(wmid, prevUsage, currUsage, prevTS, currTS, errorNo, errorMsg)
+            tempPost["_id"] = errorID(tempPost)
             self.db.data_error.insert(tempPost)
+            self.health.success()
+            return 1
+        except DuplicateKeyError, e:
+            self.health.success()
             return 1
         except AutoReconnect, e:
+            self.health.failure()
             print "Error upload unsuccessful. Error: AutoReconnect."
             return 0
         except ConnectionFailure, e:
+            self.health.failure()
             print "Error upload unsuccessful. Error: ConnectionFailure."
             return 0
         except:
+            self.health.release()
             return -1
 
 
@@ -129,15 +557,49 @@ class pymongoClient(object):
        with the value "wmid" will have its online status "Online" switches to "status". Upon successful uploading,
        the method returns one. Otherwise, a corresponding error message is printed and zero is returned.'''
     def attemptStatusUpdate(self, NodeID, status):
+        if not self.health.allow():
+            return 0
         try:
             self.db.device_data.update({"nodeid": NodeID}, {"$set": {"status": status}})
+            self.health.success()
             return 1
         except AutoReconnect, e:
+            self.health.failure()
             print "Status update unsuccessful. Error: AutoReconnect."
             return 0
         except ConnectionFailure, e:
+            self.health.failure()
             print "Status update unsuccessful. Error: ConnectionFailure."
             return 0
+        except:
+            self.health.release()
+            return 0
+
+
+    '''The method bulkStatusUpdate takes a list of node IDs "nodeIDs" and a boolean value "status", and attempts to set
+       the online status of every one of those nodes in the device_data collection to "status" with a single update.
+       Upon successful updating, the method returns one. Otherwise, a corresponding error message is printed and zero
+       is returned.'''
+    def bulkStatusUpdate(self, nodeIDs, status):
+        if not nodeIDs:
+            return 1
+        if not self.health.allow():
+            return 0
+        try:
+            self.db.device_data.update({"nodeid": {"$in": list(nodeIDs)}}, {"$set": {"status": status}}, multi=True)
+            self.health.success()
+            return 1
+        except AutoReconnect, e:
+            self.health.failure()
+            print "Bulk status update unsuccessful. Error: AutoReconnect."
+            return 0
+        except ConnectionFailure, e:
+            self.health.failure()
+            print "Bulk status update unsuccessful. Error: ConnectionFailure."
+            return 0
+        except:
+            self.health.release()
+            return 0
 
 
     '''The method backupUsageInsert takes the parameters wmid, counter, diff, intTemp, extTemp, tstamp and tstring,
@@ -145,18 +607,28 @@ class pymongoClient(object):
        upload the entry to the usage collection belonging to dbStr. Upon successful uploading, the method returns
        one. Otherwise, a corresponding error message is printed and zero is returned.'''
     def backupUsageInsert(self, dbStr, wmid, counter, diff, intTemp, extTemp, tstamp, tstring):
+        if not self.health.allow():
+            return 0
         try:
             tempPost = {"wmid": wmid, "counter": counter, "diff": diff, "intTemp": intTemp,
                         "extTemp": extTemp, "timestamp": tstamp, "timestring": tstring}
+            tempPost["_id"] = usageID(dbStr, tempPost)
             self.dbDict[dbStr].insert(tempPost)
+            self.health.success()
+            return 1
+        except DuplicateKeyError, e:
+            self.health.success()
             return 1
         except AutoReconnect, e:
+            self.health.failure()
             print "Backup Usage upload unsuccessful. Error: AutoReconnect."
             return 0
         except ConnectionFailure, e:
+            self.health.failure()
             print "Backup Usage upload unsuccessful. Error: ConnectionFailure."
             return 0
         except:
+            self.health.release()
             return -1
 
 
@@ -165,15 +637,24 @@ class pymongoClient(object):
        monitoring the online status of a Raspberry Pi device that manages a water usage network. Upon successful
        uploading, the method returns one. Otherwise, zero is returned.'''
     def piHeartbeatInsert(self, piID, timestamp, IP):
+        if not self.health.allow():
+            return 0
         try:
-            tempPost = {"piID": piID, "timestamp": timestamp, "IPAddress": IP}
+            tempPost = {"_id": "pi:%s:%s" %(piID, timestamp), "piID": piID, "timestamp": timestamp, "IPAddress": IP}
             self.db.pi_heartbeat.insert(tempPost)
+            self.health.success()
+            return 1
+        except DuplicateKeyError, e:
+            self.health.success()
             return 1
         except AutoReconnect, e:
+            self.health.failure()
             return 0
         except ConnectionFailure, e:
+            self.health.failure()
             return 0
         except:
+            self.health.release()
             return -1
 
 
@@ -183,13 +664,15 @@ class pymongoClient(object):
        is successful.'''
     def meterIDUpdate(self, oldID, newID):
         while 1:
+            self.health.wait()
             try:
                 self.db.device_data.update({"nodeid": oldID}, {"$set": {"nodeid": newID}})
+                self.health.success()
                 break
             except AutoReconnect, e:
-                pass
+                self.health.failure()
             except ConnectionFailure, e:
-                pass
+                self.health.failure()
 
 
     '''The method manualConfigUpdate takes in four arguments, the new No Usage Threshold value "noUsage", the new
@@ -200,17 +683,19 @@ class pymongoClient(object):
        it is successful.'''
     def manualConfigUpdate(self, NWID, noUsage, leakInterval, leakStreak, keyValue):
         while 1:
+            self.health.wait()
             try:
                 self.db.data_config.remove({"nwid": NWID})
                 tempPost = {"nwid": NWID, "NoUsage": noUsage,
                             "LeakInterval": leakInterval, "LeakStreak": leakStreak,
                             "EncryptionKey": keyValue, "Updated": True}
                 self.db.data_config.insert(tempPost)
+                self.health.success()
                 break
             except AutoReconnect, e:
-                pass
+                self.health.failure()
             except ConnectionFailure, e:
-                pass
+                self.health.failure()
 
 
     '''The method autoConfigUpdate is for acknowledging the configuration value updates have been made successfully
@@ -218,12 +703,20 @@ class pymongoClient(object):
        by flipping the "Updated" value from False to True. Upon successful updating, the method returns one.
        Otherwise, zero is returned.'''
     def autoConfigUpdate(self):
+        if not self.health.allow():
+            return 0
         try:
             self.db.data_config.update({"Updated": False}, {"$set": {"Updated": True}})
+            self.health.success()
             return 1
         except AutoReconnect, e:
+            self.health.failure()
             return 0
         except ConnectionFailure, e:
+            self.health.failure()
+            return 0
+        except:
+            self.health.release()
             return 0
 
         
@@ -233,50 +726,293 @@ class pymongoClient(object):
        returns the entry containing the values. If the configuration have been updated, the method return an empty data
        entry. If the query is unsuccessful due to connection issue, None is returned.'''
     def retrieveConfig(self, NWID, needFalseFlag):
+        if not self.health.allow():
+            return None
         try:
             if (needFalseFlag):
                 result = list(self.db.data_config.find({"nwid": NWID, "Updated": False}).limit(1))
             else:
                 result = list(self.db.data_config.find({"nwid": NWID}).limit(1))
+            self.health.success()
                 
             if result:
                 return result[0]
             else:
                 return {}
         except AutoReconnect, e:
+            self.health.failure()
             return None
         except ConnectionFailure, e:
+            self.health.failure()
+            return None
+        except:
+            self.health.release()
             return None
 
 
     '''The method getMeterID returns all the data entries from the data_meterID collection of the database server which
        belong to the water usage network represented by the ID of NWID. The data entries are returned in the form of a
-       list of all the entries. This method will attempt the query continuously until it is successful.'''
+       list of all the entries. This method will attempt the query continuously until it is successful, waiting longer
+       after every failed attempt.'''
     def getMeterID(self, NWID):
         while 1:
+            self.health.wait()
             try:
-                return list(self.db.device_data.find({"nwid": NWID}))
+                result = list(self.db.device_data.find({"nwid": NWID}))
+                self.health.success()
+                return result
             except AutoReconnect, e:
-                time.sleep(1)
+                self.health.failure()
             except ConnectionFailure, e:
-                time.sleep(1)
+                self.health.failure()
 
 
     def pushIP(self, networkID, IPAddress):
+        if not self.health.allow():
+            return
         try:
             for i in range(5):
                 self.db.data_ip.remove()
-                self.db.data_ip.insert({nwid: networkID, "address": IPAddress})
+                self.db.data_ip.insert({"nwid": networkID, "address": IPAddress})
+            self.health.success()
         except AutoReconnect, e:
-            pass
+            self.health.failure()
         except ConnectionFailure, e:
-            pass
+            self.health.failure()
+        except:
+            self.health.release()
 
 
     def securityBreach(self, WMID):
+        if not self.health.allow():
+            return
         try:
             self.db.device_data.update({"wmid": WMID}, {"$set": {"security": True}})
+            self.health.success()
         except AutoReconnect, e:
-            pass
+            self.health.failure()
         except ConnectionFailure, e:
-            pass
+            self.health.failure()
+        except:
+            self.health.release()
+
+
+
+'''The usageBatchWriter class buffers usage data entries per usage collection (data_month, data_day, data_hour, data_min
+   and data_sec), and uploads each buffer with one bulk insert once it holds maxBatchSize entries, or once its oldest
+   entry has waited maxBatchAge seconds. The per-entry results of every bulk insert are handed to resultCallback, so the
+   caller can back up exactly the entries which failed to upload. With the "pipelined" write concern, the bulk inserts
+   are sent without waiting for the server, and the entries sent are held until a checkpoint confirms them, once
+   checkpointSize entries are waiting for one or the oldest has waited checkpointAge seconds. Only then are their
+   results handed to resultCallback: all one if the checkpoint is confirmed, and all zero if it failed.'''
+class usageBatchWriter(object):
+
+    '''The usageBatchWriter properties are as follows:
+       client is the pymongoClient instance used for the bulk inserts.
+       maxBatchSize is the number of entries which triggers an immediate upload of a collection buffer.
+       maxBatchAge is the number of seconds an entry may wait in a buffer before flushExpired uploads it.
+       resultCallback is called as resultCallback(dbStr, posts, results) after every bulk insert, where results holds
+       the bulkUsageInsert return value of each entry in posts.
+       writeConcern is one of the WRITE_CONCERNS, and checkpointSize and checkpointAge decide when the entries sent
+       with the "pipelined" write concern are confirmed.'''
+    def __init__(self, client, maxBatchSize=50, maxBatchAge=1.0, resultCallback=None, writeConcern="acknowledged",
+                 checkpointSize=500, checkpointAge=5.0):
+        if writeConcern not in WRITE_CONCERNS:
+            raise ValueError("Unknown write concern: %s" %(writeConcern))
+        self.client = client
+        self.maxBatchSize = maxBatchSize
+        self.maxBatchAge = maxBatchAge
+        self.resultCallback = resultCallback
+        self.batchLock = threading.Lock()
+        #batches maps each collection key (dbStr) to the list of entries waiting to be uploaded to that collection.
+        self.batches = {}
+        #batchTimes maps each collection key to the time at which the oldest waiting entry was buffered.
+        self.batchTimes = {}
+        self.writeConcern = writeConcern
+        self.checkpointSize = checkpointSize
+        self.checkpointAge = checkpointAge
+        #unconfirmed is the list of (dbStr, post) entries sent since the last checkpoint, and unconfirmedTime the time
+        #at which the oldest of them was sent.
+        self.unconfirmed = []
+        self.unconfirmedTime = None
+        self.checkpoints = 0
+        self.failedCheckpoints = 0
+
+    '''The add method forms one usage data entry (JSON) from its arguments and buffers it for the collection belonging
+       to dbStr. If the buffer is now full, it is uploaded straight away in the calling thread.'''
+    def add(self, dbStr, wmid, counter, diff, intTemp, extTemp, tstamp, tstring):
+        self.addPost(dbStr, formUsagePost(wmid, counter, diff, intTemp, extTemp, tstamp, tstring))
+
+    '''The addPost method buffers the usage data entry (JSON) "post", already formed, for the collection belonging to
+       dbStr, in the same way as the add method.'''
+    def addPost(self, dbStr, post):
+        toFlush = None
+        self.batchLock.acquire()
+        if dbStr not in self.batches:
+            self.batches[dbStr] = []
+            self.batchTimes[dbStr] = time.time()
+        self.batches[dbStr].append(post)
+        if (len(self.batches[dbStr]) >= self.maxBatchSize):
+            toFlush = self.takeBatch(dbStr)
+        self.batchLock.release()
+
+        if toFlush:
+            self.flushBatch(dbStr, toFlush)
+
+    '''The flushExpired method uploads every buffer whose oldest entry has waited at least maxBatchAge seconds. It is
+       meant to be called periodically, so that entries of quiet collections do not wait indefinitely.'''
+    def flushExpired(self):
+        timeNow = time.time()
+        expired = []
+        self.batchLock.acquire()
+        for dbStr in self.batches.keys():
+            if (timeNow - self.batchTimes[dbStr] >= self.maxBatchAge):
+                expired.append((dbStr, self.takeBatch(dbStr)))
+        self.batchLock.release()
+
+        for (dbStr, posts) in expired:
+            self.flushBatch(dbStr, posts)
+        if self.unconfirmed and (timeNow - self.unconfirmedTime >= self.checkpointAge):
+            self.checkpoint()
+
+    '''The failAll method empties every buffer, along with the entries sent since the last checkpoint, and reports
+       them to resultCallback as failed (zero), without any upload. It is called when the main client stops, so that
+       the caller backs up the entries which would otherwise be lost. The entries of the buffers have never been sent,
+       and are reported with an unsentResults.'''
+    def failAll(self):
+        groups = {}
+        for (dbStr, post) in self.takeUnconfirmed():
+            groups.setdefault(dbStr, []).append(post)
+        self.batchLock.acquire()
+        pending = [(dbStr, self.takeBatch(dbStr)) for dbStr in self.batches.keys()]
+        self.batchLock.release()
+
+        if self.resultCallback:
+            for (dbStr, posts) in groups.items():
+                self.resultCallback(dbStr, posts, [0] * len(posts))
+            for (dbStr, posts) in pending:
+                self.resultCallback(dbStr, posts, unsentResults([0] * len(posts)))
+
+    '''The pendingCount method returns the number of entries currently waiting in all buffers.'''
+    def pendingCount(self):
+        self.batchLock.acquire()
+        count = sum([len(posts) for posts in self.batches.values()])
+        self.batchLock.release()
+        return count
+
+    '''The takeBatch method removes and returns the buffer belonging to dbStr. The caller must hold batchLock.'''
+    def takeBatch(self, dbStr):
+        del self.batchTimes[dbStr]
+        return self.batches.pop(dbStr)
+
+    '''The flushBatch method uploads the entries "posts" to the collection belonging to dbStr with one bulk insert, and
+       reports the per-entry results to resultCallback. With the "pipelined" write concern, the entries are sent, and
+       their results are reported by the checkpoint which confirms them.'''
+    def flushBatch(self, dbStr, posts):
+        if (self.writeConcern == "pipelined"):
+            results = self.client.pipelinedUsageInsert(dbStr, posts)
+            self.batchSent(dbStr, posts, results)
+            return results
+        results = self.client.bulkUsageInsert(dbStr, posts)
+        if self.resultCallback:
+            self.resultCallback(dbStr, posts, results)
+        return results
+
+    '''The batchSent method handles the results of a pipelined bulk insert. The entries which could not be sent are
+       reported to resultCallback straight away, and the entries sent are held until the next checkpoint, which is
+       made now if checkpointSize entries are waiting for it. A connection failure also calls for a checkpoint straight
+       away, which fails to confirm the entries sent over the lost connection, so that they are backed up.'''
+    def batchSent(self, dbStr, posts, results):
+        failed = [(post, result) for (post, result) in zip(posts, results) if (result != 1)]
+        if failed and self.resultCallback:
+            failedResults = [result for (post, result) in failed]
+            if isinstance(results, unsentResults):
+                failedResults = unsentResults(failedResults)
+            self.resultCallback(dbStr, [post for (post, result) in failed], failedResults)
+        self.batchLock.acquire()
+        if not self.unconfirmed:
+            self.unconfirmedTime = time.time()
+        self.unconfirmed.extend([(dbStr, post) for (post, result) in zip(posts, results) if (result == 1)])
+        due = (len(self.unconfirmed) >= self.checkpointSize) or (self.unconfirmed and (0 in results))
+        self.batchLock.release()
+        if due:
+            self.checkpoint()
+
+    '''The checkpoint method confirms the entries sent since the last checkpoint with an acknowledged checkpoint write,
+       and reports their results to resultCallback.'''
+    def checkpoint(self):
+        pending = self.takeUnconfirmed()
+        if pending:
+            self.checkpointResult(pending, self.client.checkpoint())
+
+    '''The takeUnconfirmed method removes and returns the entries sent since the last checkpoint.'''
+    def takeUnconfirmed(self):
+        self.batchLock.acquire()
+        pending = self.unconfirmed
+        self.unconfirmed = []
+        self.unconfirmedTime = None
+        self.batchLock.release()
+        return pending
+
+    '''The checkpointResult method reports the results of the entries "pending", as returned by takeUnconfirmed, to
+       resultCallback, grouped by collection: one for each entry if the checkpoint is confirmed, and zero otherwise, so
+       that the entries are backed up for upload once the connection is back.'''
+    def checkpointResult(self, pending, confirmed):
+        self.batchLock.acquire()
+        if confirmed:
+            self.checkpoints += 1
+        else:
+            self.failedCheckpoints += 1
+        self.batchLock.release()
+        groups = {}
+        for (dbStr, post) in pending:
+            groups.setdefault(dbStr, []).append(post)
+        if self.resultCallback:
+            for (dbStr, posts) in groups.items():
+                self.resultCallback(dbStr, posts, [1 if confirmed else 0] * len(posts))
+
+    '''The getStats method returns the write concern, the number of entries waiting in the buffers and waiting for a
+       checkpoint, and the number of checkpoints confirmed and failed.'''
+    def getStats(self):
+        self.batchLock.acquire()
+        stats = {"writeConcern": self.writeConcern, "unconfirmed": len(self.unconfirmed),
+                 "checkpoints": self.checkpoints, "failedCheckpoints": self.failedCheckpoints}
+        self.batchLock.release()
+        stats["pending"] = self.pendingCount()
+        return stats
+
+
+
+'''The scheduledBatchWriter class is a usageBatchWriter whose bulk inserts are submitted to a database scheduler, the
+   uploadScheduler of the classic runtime or the asyncDatabase of the async runtime, instead of being performed by the
+   calling thread. The handling of a frame which fills a batch therefore no longer waits for the upload. The per-entry
+   results are reported to resultCallback once the call is done, on a scheduler thread or on the event loop, as zero
+   for every entry if the call raised an exception. Pipelined
+   bulk inserts and checkpoints are submitted in the same way, and a checkpoint only covers the entries whose bulk
+   insert has completed by the time it is submitted.'''
+class scheduledBatchWriter(usageBatchWriter):
+
+    '''The scheduledBatchWriter properties are those of the usageBatchWriter, with the client of the scheduler
+       "database", whose submit method is used for every call.'''
+    def __init__(self, database, maxBatchSize=50, maxBatchAge=1.0, resultCallback=None, writeConcern="acknowledged",
+                 checkpointSize=500, checkpointAge=5.0):
+        usageBatchWriter.__init__(self, database.client, maxBatchSize, maxBatchAge, resultCallback, writeConcern,
+                                  checkpointSize, checkpointAge)
+        self.database = database
+
+    def flushBatch(self, dbStr, posts):
+        if (self.writeConcern == "pipelined"):
+            self.database.submit("pipelinedUsageInsert", (dbStr, posts),
+                                 lambda results: self.batchSent(dbStr, posts, resultsOf(results, len(posts))))
+            return
+        self.database.submit("bulkUsageInsert", (dbStr, posts),
+                             lambda results: self.batchResult(dbStr, posts, resultsOf(results, len(posts))))
+
+    def checkpoint(self):
+        pending = self.takeUnconfirmed()
+        if pending:
+            self.database.submit("checkpoint", (), lambda confirmed: self.checkpointResult(pending, confirmed))
+
+    def batchResult(self, dbStr, posts, results):
+        if self.resultCallback:
+            self.resultCallback(dbStr, posts, results)
@@ -0,0 +1,196 @@
+'''This Python script, rollupEngine.py, aggregates the usage data of each water meter on the Raspberry Pi. For every
+   granularity (month, day, hour, minute, and optionally second), it keeps one open window per water meter, which
+   collects the readings falling within the same period. Once a reading of a later period arrives, or the period has
+   ended some time ago, the window is closed and one aggregate usage data entry is emitted for it, in place of the raw
+   readings the usage collections used to receive.'''
+import time
+import json
+import threading
+from datetime import datetime, timedelta
+import serialProtocol
+import configStore
+
+#The number of period integers (year, month, day, hour, minute, second) identifying a window of each granularity.
+WINDOW_LENGTHS = {"month": 2, "day": 3, "hour": 4, "min": 5, "sec": 6}
+#The granularities aggregated by default, from the coarsest to the finest.
+DEFAULT_GRANULARITIES = ["month", "day", "hour", "min"]
+
+
+'''The rollupWindow class holds the aggregate of the readings of one water meter within one period. The key of the
+   window is the tuple of period integers of that period, such as (year, month, day) for a day window.'''
+class rollupWindow(object):
+    __slots__ = ["key", "samples", "firstCounter", "firstTimestamp", "firstTimestring", "counter", "timestamp",
+                 "timestring", "diff", "tempSamples", "intTempSum", "intTempMin", "intTempMax", "extTempSum",
+                 "extTempMin", "extTempMax"]
+
+    def __init__(self, key, counter, timestamp, timestring):
+        self.key = key
+        self.samples = 0
+        self.firstCounter = counter
+        self.firstTimestamp = timestamp
+        self.firstTimestring = timestring
+        self.counter = counter
+        self.timestamp = timestamp
+        self.timestring = timestring
+        self.diff = 0
+        #Readings with an unreadable temperature (INVALID_TEMP) are left out of the temperature aggregates.
+        self.tempSamples = [0, 0]
+        self.intTempSum = 0
+        self.intTempMin = None
+        self.intTempMax = None
+        self.extTempSum = 0
+        self.extTempMin = None
+        self.extTempMax = None
+
+    '''The add method adds one reading to the window. A reading older than the last one is only counted in the sums.'''
+    def add(self, counter, diff, intTemp, extTemp, timestamp, timestring):
+        self.samples += 1
+        if (timestamp >= self.timestamp):
+            self.counter = counter
+            self.timestamp = timestamp
+            self.timestring = timestring
+        self.diff += diff
+        if (intTemp != serialProtocol.INVALID_TEMP):
+            self.tempSamples[0] += 1
+            self.intTempSum += intTemp
+            self.intTempMin = intTemp if (self.intTempMin is None) else min(self.intTempMin, intTemp)
+            self.intTempMax = intTemp if (self.intTempMax is None) else max(self.intTempMax, intTemp)
+        if (extTemp != serialProtocol.INVALID_TEMP):
+            self.tempSamples[1] += 1
+            self.extTempSum += extTemp
+            self.extTempMin = extTemp if (self.extTempMin is None) else min(self.extTempMin, extTemp)
+            self.extTempMax = extTemp if (self.extTempMax is None) else max(self.extTempMax, extTemp)
+
+    '''The toPost method forms the aggregate usage data entry (JSON) of the window for the water meter wmid. The fields
+       of a raw usage data entry are kept, so existing readers of the usage collections keep working: counter,
+       timestamp and timestring are those of the last reading, diff is the sum of the usage differences, and intTemp
+       and extTemp are the average temperatures. The first reading, the temperature ranges and the number of readings
+       are added.'''
+    def toPost(self, wmid):
+        (intTemp, extTemp) = (serialProtocol.INVALID_TEMP, serialProtocol.INVALID_TEMP)
+        if self.tempSamples[0]:
+            intTemp = round(float(self.intTempSum) / self.tempSamples[0], 2)
+        if self.tempSamples[1]:
+            extTemp = round(float(self.extTempSum) / self.tempSamples[1], 2)
+        return {"wmid": wmid, "counter": self.counter, "diff": self.diff, "intTemp": intTemp, "extTemp": extTemp,
+                "timestamp": self.timestamp, "timestring": self.timestring,
+                "firstCounter": self.firstCounter, "firstTimestamp": self.firstTimestamp,
+                "firstTimestring": self.firstTimestring,
+                "intTempMin": self.intTempMin, "intTempMax": self.intTempMax,
+                "extTempMin": self.extTempMin, "extTempMax": self.extTempMax,
+                "samples": self.samples}
+
+    '''The toState method returns the window as a list of plain values, which can be saved as JSON.'''
+    def toState(self):
+        return [getattr(self, name) for name in self.__slots__]
+
+    @staticmethod
+    def fromState(state):
+        window = rollupWindow(None, None, None, None)
+        for (name, value) in zip(rollupWindow.__slots__, state):
+            setattr(window, name, value)
+        window.key = tuple(window.key)
+        return window
+
+
+
+'''The function windowEnd returns the Epoch time, in milliseconds, at which the window of the granularity "granularity"
+   with the key "key" ends, in local time as the timestamp decoder uses.'''
+def windowEnd(granularity, key):
+    if (granularity == "month"):
+        (year, month) = key
+        end = datetime(year + month / 12, month % 12 + 1, 1)
+    else:
+        length = {"day": timedelta(days=1), "hour": timedelta(hours=1), "min": timedelta(minutes=1),
+                  "sec": timedelta(seconds=1)}[granularity]
+        end = datetime(*key) + length
+    return long(1000*time.mktime(end.timetuple()))
+
+
+
+'''The rollupEngine class keeps the open windows of every water meter for each of its granularities, and returns the
+   aggregate usage data entries of the windows it closes.'''
+class rollupEngine(object):
+
+    '''The rollupEngine properties are as follows:
+       granularities is the list of granularities to aggregate, out of WINDOW_LENGTHS.
+       graceTime is the number of milliseconds after the end of its period at which closeExpired closes a window which
+       has not been closed by a later reading, leaving time for late readings to arrive.'''
+    def __init__(self, granularities=DEFAULT_GRANULARITIES, graceTime=60000):
+        for granularity in granularities:
+            if granularity not in WINDOW_LENGTHS:
+                raise ValueError("Unknown rollup granularity: %s" %(granularity))
+        self.granularities = list(granularities)
+        self.graceTime = graceTime
+        #windows maps each (water meter ID, granularity) pair to its open rollupWindow.
+        self.windows = {}
+        self.rollupLock = threading.Lock()
+        self.readings = 0
+        self.emitted = 0
+
+    '''The add method adds one reading of the water meter wmid, whose timestamp has the period tuple "period", to the
+       open windows of that water meter. It returns the list of (dbStr, aggregate usage data entry) pairs of the
+       windows which the reading has closed. A reading of an earlier period than the open window, which arrived late,
+       is counted in the open window.'''
+    def add(self, wmid, counter, diff, intTemp, extTemp, timestamp, timestring, period):
+        closed = []
+        self.rollupLock.acquire()
+        try:
+            self.readings += 1
+            for granularity in self.granularities:
+                key = tuple(period[:WINDOW_LENGTHS[granularity]])
+                window = self.windows.get((wmid, granularity))
+                if (window is None) or (key > window.key):
+                    if window is not None:
+                        closed.append((granularity, window.toPost(wmid)))
+                    window = rollupWindow(key, counter, timestamp, timestring)
+                    self.windows[(wmid, granularity)] = window
+                window.add(counter, diff, intTemp, extTemp, timestamp, timestring)
+            self.emitted += len(closed)
+        finally:
+            self.rollupLock.release()
+        return closed
+
+    '''The closeExpired method closes every window whose period ended at least graceTime milliseconds before timeNow,
+       and returns their (dbStr, aggregate usage data entry) pairs, so that the data of water meters which have stopped
+       sending is not held back.'''
+    def closeExpired(self, timeNow):
+        closed = []
+        self.rollupLock.acquire()
+        try:
+            for ((wmid, granularity), window) in self.windows.items():
+                if (windowEnd(granularity, window.key) + self.graceTime <= timeNow):
+                    closed.append((granularity, window.toPost(wmid)))
+                    del self.windows[(wmid, granularity)]
+            self.emitted += len(closed)
+        finally:
+            self.rollupLock.release()
+        return closed
+
+    '''The save method writes the open windows to the file at "path", replacing it atomically, so the windows survive
+       a restart of the main client.'''
+    def save(self, path):
+        self.rollupLock.acquire()
+        try:
+            state = [[wmid, granularity, window.toState()] for ((wmid, granularity), window) in self.windows.items()]
+        finally:
+            self.rollupLock.release()
+        configStore.atomicWrite(path, json.dumps(state))
+
+    '''The load method restores the open windows saved by the save method. Windows of granularities which are no longer
+       aggregated are left out. It raises IOError or ValueError if the file cannot be read.'''
+    def load(self, path):
+        stateFile = open(path, "r")
+        state = json.load(stateFile)
+        stateFile.close()
+        self.rollupLock.acquire()
+        try:
+            for (wmid, granularity, windowState) in state:
+                if granularity in self.granularities:
+                    self.windows[(wmid, str(granularity))] = rollupWindow.fromState(windowState)
+        finally:
+            self.rollupLock.release()
+
+    '''The getStats method returns the number of readings added, aggregate entries emitted, and windows open.'''
+    def getStats(self):
+        return {"readings": self.readings, "emitted": self.emitted, "open": len(self.windows)}
@@ -2,6 +2,13 @@
    the Raspberry Pi and the water usage monitor node, to allow transmission of data and communication across
    the two platforms.'''
 import serial
+import re
+
+'''FRAME_TOKEN matches one frame between the delimiters of the serial protocol. The monitor node wraps every message in
+   semicolons and ends it with a newline, as in ";usage,...;\n".'''
+FRAME_TOKEN = re.compile(r"[^;\n]+")
+#The greatest number of bytes a frame may span. A longer run of bytes without any delimiter is discarded.
+MAX_FRAME_SIZE = 4096
 
 '''The serialConnection class creates a Serial Connection Client object, which provides access to the serial port
    of the Raspberry Pi for communicating with the water usage monitor node.'''
@@ -25,6 +32,11 @@ class serialConnection(object):
         self.timeout = readTimeout
         self.writeTimeout = writeTimeout
         self.connection = None
+        #buffer holds the bytes read so far which do not form a complete frame yet.
+        self.buffer = bytearray()
+        self.bytesRead = 0
+        self.framesRead = 0
+        self.partialFrames = 0
 
     '''The connect method switches on the connection of the Serial Connection Client with the aforementioned
        properties.'''
@@ -41,16 +53,77 @@ class serialConnection(object):
     def write(self, toWrite):
         self.connection.write(toWrite)
 
-    '''The read method reads the next line sent over from the water usage monitor node via the serial port.
-       It will read until an end of line character is reached. The read will stall for 0.5 seconds before
-       timing out if there is nothing available for reading.'''
-    def read(self):
-        return self.connection.readline()
+    '''The readFrames method reads everything currently waiting in the serial input buffer with a single read, and
+       returns the list of complete frames it contains, without their delimiters. Bytes of an incomplete frame are kept
+       for the next call. If nothing is waiting, the method waits up to 0.5 seconds for the first byte to arrive. If
+       nothing arrives while an incomplete frame is pending, the rest of that frame has been lost, and it is
+       discarded.'''
+    def readFrames(self):
+        waiting = self.waitingCount()
+        if (waiting > 0):
+            data = self.connection.read(waiting)
+        else:
+            data = self.connection.read(1)
+            if data:
+                data += self.connection.read(self.waitingCount())
+            else:
+                self.discardPartial()
+                return []
+        return self.splitFrames(data)
+
+    '''The readWaiting method reads only what is already waiting in the serial input buffer, and returns the complete
+       frames it contains along with those left over from earlier reads. It never waits, so it can be called by an event
+       loop whenever the serial port becomes readable.'''
+    def readWaiting(self):
+        waiting = self.waitingCount()
+        if (waiting == 0):
+            return []
+        return self.splitFrames(self.connection.read(waiting))
+
+    '''The splitFrames method adds the bytes "data" to the buffer, and removes and returns the complete frames the buffer
+       now holds.'''
+    def splitFrames(self, data):
+        self.bytesRead += len(data)
+        self.buffer.extend(data)
+
+        end = max(self.buffer.rfind(";"), self.buffer.rfind("\n")) + 1
+        if (end == 0):
+            if (len(self.buffer) > MAX_FRAME_SIZE):
+                self.discardPartial()
+            return []
+        frames = [str(token.group()) for token in FRAME_TOKEN.finditer(self.buffer, 0, end)]
+        del self.buffer[:end]
+        self.framesRead += len(frames)
+        return frames
+
+    '''The discardPartial method empties the buffer, and counts the incomplete frame it held, if any, as a partial
+       frame. Each partial frame is counted once, when it is discarded.'''
+    def discardPartial(self):
+        if self.buffer:
+            self.partialFrames += 1
+            del self.buffer[:]
+
+    '''The fileno method returns the file descriptor of the serial port, which an event loop can watch for input.'''
+    def fileno(self):
+        return self.connection.fileno()
+
+    '''The waitingCount method returns the number of bytes waiting in the serial input buffer.'''
+    def waitingCount(self):
+        #Newer versions of PySerial replace the inWaiting method with the in_waiting property.
+        if hasattr(self.connection, "in_waiting"):
+            return self.connection.in_waiting
+        return self.connection.inWaiting()
+
+    '''The getStats method returns the number of bytes and complete frames read by readFrames, along with the number
+       of partial frames discarded.'''
+    def getStats(self):
+        return {"bytes": self.bytesRead, "frames": self.framesRead, "partial": self.partialFrames}
 
     '''The flushInput method empties the input that has been stored in the buffer that the Raspberry Pi has yet
-       to read.'''
+       to read, along with any incomplete frame read so far.'''
     def flushInput(self):
         self.connection.flushInput()
+        self.discardPartial()
 
     '''The flushOutput method empties the output that has been stored in the buffer that the water usage monitor
        node has yet to read.'''
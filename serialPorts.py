@@ -0,0 +1,222 @@
+'''This Python script, serialPorts.py, lets a single main client serve several monitor nodes, each attached to the
+   Raspberry Pi through a serial port of its own (the on-board UART, or a USB XBee coordinator). Every port has its own
+   reader, which tags the frames it reads with the name of the port, and all of them feed the same ingest pipeline.
+   A port that fails is closed and reopened on its own, with a growing delay between attempts, while the other ports
+   carry on. Replies to a frame (encryption keys, time) are written back to the port the frame came from.'''
+import threading
+import time
+import serial
+import serialConnection
+
+#The errors raised by a serial port which has gone away, such as an unplugged USB coordinator.
+PORT_ERRORS = (serial.SerialException, OSError, IOError)
+
+#The name of the port the frame being handled by the current thread came from.
+origin = threading.local()
+
+
+'''The serialPort class wraps the Serial Connection client of one port. It keeps the port's state ("closed", "open" or
+   "down"), and reopens a port which has gone down no sooner than its retry delay, which doubles after every failed
+   attempt up to maxRetryDelay seconds.'''
+class serialPort(object):
+
+    '''The serialPort properties are as follows:
+       name is the name of the port, as tagged onto its frames.
+       device is the path of the serial device, such as /dev/ttyAMA0 or /dev/ttyUSB0.
+       retryDelay and maxRetryDelay are the first and the greatest delay, in seconds, before reopening the port.
+       writeLock is held by every write, and while the port is opened or closed, as replies are written by several
+       upload worker threads at once and the reader thread reopens the port after a failure.'''
+    def __init__(self, name, device, retryDelay=1.0, maxRetryDelay=60.0):
+        self.name = name
+        self.device = device
+        self.ser = serialConnection.serialConnection(device)
+        self.state = "closed"
+        self.firstRetryDelay = retryDelay
+        self.retryDelay = retryDelay
+        self.maxRetryDelay = maxRetryDelay
+        self.retryAt = 0
+        self.failures = 0
+        self.reconnects = 0
+        self.writes = 0
+        self.droppedWrites = 0
+        self.lastError = None
+        self.writeLock = threading.RLock()
+
+    '''The open method opens the port, and empties its input and output buffers. It returns True if the port is open,
+       and False if it has failed and been marked down.'''
+    def open(self):
+        self.writeLock.acquire()
+        try:
+            try:
+                self.ser.connect()
+                self.ser.flushInput()
+                self.ser.flushOutput()
+            except PORT_ERRORS, e:
+                self.failed(e)
+                return False
+            if (self.state == "down"):
+                self.reconnects += 1
+            self.state = "open"
+            self.retryDelay = self.firstRetryDelay
+            return True
+        finally:
+            self.writeLock.release()
+
+    '''The failed method closes the port after the error e, and marks it down until its retry delay has passed.'''
+    def failed(self, e):
+        print "Serial port %s (%s) failed. Error: %s. Retrying in %s seconds." %(self.name, self.device, e,
+                                                                                self.retryDelay)
+        self.writeLock.acquire()
+        try:
+            try:
+                if self.ser.connection is not None:
+                    self.ser.close()
+            except PORT_ERRORS:
+                pass
+            self.state = "down"
+            self.failures += 1
+            self.lastError = str(e)
+            self.retryAt = time.time() + self.retryDelay
+            self.retryDelay = min(2 * self.retryDelay, self.maxRetryDelay)
+        finally:
+            self.writeLock.release()
+
+    '''The close method closes the port if it is open.'''
+    def close(self):
+        self.writeLock.acquire()
+        try:
+            if (self.state == "open"):
+                self.ser.close()
+                self.state = "closed"
+        finally:
+            self.writeLock.release()
+
+    '''The retryIn method returns the number of seconds left before the port may be reopened.'''
+    def retryIn(self):
+        return max(self.retryAt - time.time(), 0)
+
+    '''The write method writes the string message to the port. A message for a port which is not open is dropped, and
+       an error while writing marks the port down. It returns whether the message has been written. The whole message
+       is written with writeLock held, so messages written by several threads at once never interleave.'''
+    def write(self, message):
+        self.writeLock.acquire()
+        try:
+            if (self.state != "open"):
+                self.droppedWrites += 1
+                return False
+            try:
+                self.ser.write(message)
+            except PORT_ERRORS, e:
+                self.failed(e)
+                self.droppedWrites += 1
+                return False
+            self.writes += 1
+            return True
+        finally:
+            self.writeLock.release()
+
+    '''The frames method is an iterator over the frames read from the port, read in bulk with readFrames. A port which
+       is down is reopened once its retry delay has passed. It never ends.'''
+    def frames(self):
+        while 1:
+            if (self.state != "open"):
+                time.sleep(self.retryIn())
+                self.open()
+                continue
+            try:
+                frames = self.ser.readFrames()
+            except PORT_ERRORS, e:
+                self.failed(e)
+                continue
+            for frame in frames:
+                yield frame
+
+    '''The getStats method returns the state of the port, its failures and reconnections, the messages written to it
+       and dropped, and the byte and frame counts of its Serial Connection client.'''
+    def getStats(self):
+        stats = self.ser.getStats()
+        stats.update({"device": self.device, "state": self.state, "failures": self.failures,
+                      "reconnects": self.reconnects, "writes": self.writes, "droppedWrites": self.droppedWrites,
+                      "lastError": self.lastError})
+        return stats
+
+
+
+'''The serialPortSet class holds the serial ports of the main client, by name.'''
+class serialPortSet(object):
+
+    '''endpoints is the list of (name, device) pairs of the serial ports.'''
+    def __init__(self, endpoints, retryDelay=1.0, maxRetryDelay=60.0):
+        self.order = []
+        self.ports = {}
+        for (name, device) in endpoints:
+            if name in self.ports:
+                raise ValueError("Duplicate serial port name: %s" %(name))
+            self.order.append(name)
+            self.ports[name] = serialPort(name, device, retryDelay, maxRetryDelay)
+
+    '''The connect method opens every port, and returns the number of ports opened. A port which cannot be opened is
+       marked down, and reopened later by its reader.'''
+    def connect(self):
+        return len([name for name in self.order if self.ports[name].open()])
+
+    def __iter__(self):
+        return iter([self.ports[name] for name in self.order])
+
+    def __len__(self):
+        return len(self.order)
+
+    '''The write method writes the string message to the port "name".'''
+    def write(self, name, message):
+        return self.ports[name].write(message)
+
+    '''The broadcast method writes the string message to every open port.'''
+    def broadcast(self, message):
+        for port in self:
+            port.write(message)
+
+    '''The reply method writes the string message to the port which the frame being handled by the calling thread came
+       from, as set by the handle function.'''
+    def reply(self, message):
+        return self.write(origin.port, message)
+
+    '''The close method closes every open port.'''
+    def close(self):
+        for port in self:
+            port.close()
+
+    '''The getStats method returns the statistics of every port, by name.'''
+    def getStats(self):
+        return dict([(name, self.ports[name].getStats()) for name in self.order])
+
+
+
+'''The function handle returns a handler of the (port name, frame) pairs read by the port readers, which records the
+   port the frame came from for the reply method and passes the frame to frameHandler.'''
+def handle(frameHandler):
+    def handleFrom(item):
+        (origin.port, frame) = item
+        return frameHandler(frame)
+    return handleFrom
+
+
+
+'''The function itemFunction returns a function of (port name, frame) pairs which applies frameFunction to the frame,
+   so that the routing key and priority class functions of the frames apply to the messages of the ingest pipeline.
+   The messages of each measurement node thus keep going to the same upload worker whatever port they came through.'''
+def itemFunction(frameFunction):
+    return lambda item: frameFunction(item[1])
+
+
+
+'''The portReaderThread class is a thread object which does nothing but read the frames of one serial port and hand
+   them to the ingest pipeline, tagged with the name of the port.'''
+class portReaderThread(threading.Thread):
+    def __init__(self, port, pipeline):
+        threading.Thread.__init__(self)
+        self.port = port
+        self.pipeline = pipeline
+
+    def run(self):
+        for message in self.port.frames():
+            self.pipeline.put((self.port.name, message))
@@ -0,0 +1,217 @@
+'''This Python script, serialProtocol.py, decodes the serial messages (frames) sent over by the water usage monitor node.
+   Every frame is checked against a precompiled pattern, split into its fields, and passed to the handler registered for
+   its frame type, such as "usage" or "error". Frames which are malformed, or which come from a measurement node that
+   does not belong to this network, are counted and quarantined instead of being handled.'''
+import re
+import time
+import threading
+from collections import deque
+
+'''FRAME_PATTERN matches the characters allowed in the serial messages sent over by the monitor node. It is a basic
+   check for possible data corruption.'''
+FRAME_PATTERN = re.compile(r"^[_0-9a-zA-Z,;]*$")
+#The number of rejected frames kept in the quarantine for inspection.
+QUARANTINE_SIZE = 100
+#The temperature value given to a temperature field which cannot be read, out of the range a sensor can report.
+INVALID_TEMP = 99999
+
+
+'''The usageRecord class holds one decoded usage data frame:
+   usage,<node ID>,<cumulative usage>,<usage difference>,<internal temperature>,<external temperature>,<timestamp>
+   The node ID, usage values and temperatures are sent as hexadecimal strings.'''
+class usageRecord(object):
+    __slots__ = ["nodeID", "counter", "diff", "intTemp", "extTemp", "timestring"]
+
+    def __init__(self, nodeID, counter, diff, intTemp, extTemp, timestring):
+        self.fill(nodeID, counter, diff, intTemp, extTemp, timestring)
+
+    '''The fill method sets every field of the record, so that one record can be reused for frame after frame.'''
+    def fill(self, nodeID, counter, diff, intTemp, extTemp, timestring):
+        self.nodeID = nodeID
+        self.counter = counter
+        self.diff = diff
+        self.intTemp = intTemp
+        self.extTemp = extTemp
+        self.timestring = timestring
+
+
+
+'''The errorRecord class holds one decoded error frame:
+   error,<node ID>,<previous usage>,<current usage>,<previous timestamp>,<current timestamp>,<error code>
+   The node ID and usage values are sent as hexadecimal strings, and the error code as a two-digit binary string.'''
+class errorRecord(object):
+    __slots__ = ["nodeID", "prevUsage", "currUsage", "prevTimestring", "currTimestring", "errorCode"]
+
+    def __init__(self, nodeID, prevUsage, currUsage, prevTimestring, currTimestring, errorCode):
+        self.fill(nodeID, prevUsage, currUsage, prevTimestring, currTimestring, errorCode)
+
+    '''The fill method sets every field of the record, in the same way as usageRecord.fill.'''
+    def fill(self, nodeID, prevUsage, currUsage, prevTimestring, currTimestring, errorCode):
+        self.nodeID = nodeID
+        self.prevUsage = prevUsage
+        self.currUsage = currUsage
+        self.prevTimestring = prevTimestring
+        self.currTimestring = currTimestring
+        self.errorCode = errorCode
+
+
+
+'''The function tempConvert takes in one argument hexStr, which is a hexadecimal string indicating a temperature value.
+   tempConvert will convert hexStr to a decimal integer value indicating the temperature, and return that value.'''
+def tempConvert(hexStr):
+    try:
+        value = int(hexStr, 16)
+        if (value > 32767):
+            value -= 65536
+        return value
+    #Upon ValueError, the function returns INVALID_TEMP which is a value out of expressable range by hexStr.
+    except ValueError, e:
+        return INVALID_TEMP
+
+
+
+'''The function decodeUsage turns the fields of a usage frame into a usageRecord. The node ID, cumulative usage and usage
+   difference are converted from hexadecimal in one pass. If "record" is given, it is refilled and returned instead of
+   a new usageRecord. A ValueError is raised if the frame is malformed, before the record is changed.'''
+def decodeUsage(fields, record=None):
+    if (len(fields) != 7):
+        raise ValueError("usage frame has %d fields" %(len(fields)))
+    (nodeID, counter, diff) = map(long, fields[1:4], (16, 16, 16))
+    if record is None:
+        return usageRecord(nodeID, counter, diff, tempConvert(fields[4]), tempConvert(fields[5]), fields[6])
+    record.fill(nodeID, counter, diff, tempConvert(fields[4]), tempConvert(fields[5]), fields[6])
+    return record
+
+
+
+'''The function decodeError turns the fields of an error frame into an errorRecord, or refills "record" if it is given,
+   in the same way as decodeUsage. A ValueError is raised if the frame is malformed.'''
+def decodeError(fields, record=None):
+    if (len(fields) != 7):
+        raise ValueError("error frame has %d fields" %(len(fields)))
+    (nodeID, prevUsage, currUsage) = map(long, fields[1:4], (16, 16, 16))
+    if record is None:
+        return errorRecord(nodeID, prevUsage, currUsage, fields[4], fields[5], fields[6])
+    record.fill(nodeID, prevUsage, currUsage, fields[4], fields[5], fields[6])
+    return record
+
+
+
+'''The function decodeRaw passes the fields of a frame on unchanged, for frame types without a dedicated decoder.'''
+def decodeRaw(fields):
+    return fields
+
+
+
+'''The function frameKey returns the node ID field of a frame, which the ingest pipeline uses to route all frames of
+   one measurement node to the same upload worker. Frames without a node ID have no key.'''
+def frameKey(message):
+    fields = message.split(",", 2)
+    if (len(fields) > 1):
+        return fields[1]
+    return None
+
+
+
+#The priority class of each frame type, as used by the ingest pipeline. Frames of any other type are "usage" frames.
+FRAME_PRIORITIES = {"key_req": "control", "time_req": "control", "error": "alert"}
+
+'''The function framePriority returns the priority class of a frame, out of uploadScheduler.PRIORITY_CLASSES, so that
+   replies to key and time requests and error messages overtake the usage data waiting to be handled.'''
+def framePriority(message):
+    return FRAME_PRIORITIES.get(message.strip("\n").strip(";").split(",", 1)[0], "usage")
+
+
+
+'''The frameDispatcher class holds the dispatch table of the serial protocol: for each frame type, the function that
+   decodes the frame's fields and the function that handles the decoded frame. New frame types can be registered
+   without changing how frames are read.'''
+class frameDispatcher(object):
+
+    '''The frameDispatcher properties are as follows:
+       isKnownNode is a function returning whether a node ID belongs to this network. Decoded frames with a nodeID
+       attribute from any other node are quarantined.
+       handlers maps each frame type to its (decode function, handler function, reuse) triple.
+       records holds, for each thread dispatching frames, the record of each frame type which is refilled frame after
+       frame, so that decoding a frame does not allocate a new record.
+       quarantine holds the latest rejected frames as (time, reason, frame) entries.'''
+    def __init__(self, isKnownNode=None):
+        self.isKnownNode = isKnownNode
+        self.handlers = {}
+        self.records = threading.local()
+        self.quarantine = deque(maxlen=QUARANTINE_SIZE)
+        self.statsLock = threading.Lock()
+        self.frameCounts = {}
+        self.malformedCount = 0
+        self.unknownNodeCount = 0
+        self.unhandledCount = 0
+
+    '''The register method sets the decode function and handler function of the frame type frameType. The decode
+       function receives the list of fields of the frame, and the handler receives whatever the decode function
+       returns. If reuseRecord is True, the decode function also receives the record it returned for the previous frame
+       of this type on the same thread, or None, to be refilled in place, as decodeUsage and decodeError do. The handler
+       must then not keep the record once it returns.'''
+    def register(self, frameType, decodeFunction, handlerFunction, reuseRecord=False):
+        self.handlers[frameType] = (decodeFunction, handlerFunction, reuseRecord)
+
+    '''The dispatch method checks, decodes and handles one frame as read from the serial port. It returns True if the
+       frame has been handled.'''
+    def dispatch(self, message):
+        message = message.strip("\n").strip(";")
+        if not FRAME_PATTERN.match(message):
+            self.reject("invalid characters", message)
+            return False
+
+        fields = message.split(",")
+        entry = self.handlers.get(fields[0])
+        if entry is None:
+            self.count("unhandled")
+            return False
+
+        try:
+            if entry[2]:
+                records = self.records.__dict__
+                record = records[fields[0]] = entry[0](fields, records.get(fields[0]))
+            else:
+                record = entry[0](fields)
+        except (ValueError, IndexError), e:
+            self.reject("malformed: %s" %(e), message)
+            return False
+
+        nodeID = getattr(record, "nodeID", None)
+        if (nodeID is not None) and self.isKnownNode and (not self.isKnownNode(nodeID)):
+            self.reject("unknown node", message)
+            return False
+
+        self.count(fields[0])
+        entry[1](record)
+        return True
+
+    '''The reject method counts and quarantines the frame "message", rejected for the given reason.'''
+    def reject(self, reason, message):
+        self.statsLock.acquire()
+        if (reason == "unknown node"):
+            self.unknownNodeCount += 1
+        else:
+            self.malformedCount += 1
+        self.quarantine.append((time.time(), reason, message))
+        self.statsLock.release()
+        print "Frame quarantined (%s): %s" %(reason, message)
+
+    def count(self, frameType):
+        self.statsLock.acquire()
+        if (frameType == "unhandled"):
+            self.unhandledCount += 1
+        else:
+            self.frameCounts[frameType] = self.frameCounts.get(frameType, 0) + 1
+        self.statsLock.release()
+
+    '''The getStats method returns a dictionary with the number of handled frames per frame type, along with the number
+       of malformed frames, frames from unknown nodes, and frames of a type without a handler.'''
+    def getStats(self):
+        self.statsLock.acquire()
+        stats = {"frames": dict(self.frameCounts), "malformed": self.malformedCount,
+                 "unknownNode": self.unknownNodeCount, "unhandled": self.unhandledCount,
+                 "quarantined": len(self.quarantine)}
+        self.statsLock.release()
+        return stats
@@ -0,0 +1,266 @@
+'''This Python script, spoolClient.py, provides a disk-backed, append-only spool which is used to backup important data
+   in the case that Internet connection is temporarily unavailable. Unlike cache memory, the spool survives restarts and
+   power cuts of the Raspberry Pi. The backed up data will be uploaded to the database server once Internet connection
+   is restored.'''
+import os
+import json
+import time
+import threading
+
+#The file name extension of the spool segment files, and the name of the file holding the read cursor.
+SEGMENT_SUFFIX = ".seg"
+CURSOR_NAME = "cursor"
+
+
+'''The spoolClient class creates a Spool Client Object, which stores backed up data entries as lines of JSON appended to
+   a sequence of numbered segment files in the spool directory. Entries are replayed in the order they were appended,
+   and a persisted read cursor records how far the replay has progressed, so nothing is replayed twice or lost when
+   the script restarts.'''
+class spoolClient(object):
+
+    '''The Spool Client properties are as follows:
+       directory is the folder holding the segment files and the cursor file.
+       segmentSize is the size in bytes after which a new segment file is started.
+       maxBytes is the disk budget of the spool. Once it is exceeded, the oldest segment is deleted, even if it still
+       holds entries which have not been replayed yet. With None, the spool has no budget of its own, and its owner
+       decides which segments to drop with dropOldest.
+       syncCount and syncInterval control the fsync batching: appended entries are forced to disk once syncCount of
+       them are waiting, or once syncInterval seconds have passed since the last fsync.
+
+       The cursor is a pair (segment number, byte offset) pointing at the first entry which has not been replayed yet.'''
+    def __init__(self, directory="spool", segmentSize=4194304, maxBytes=268435456, syncCount=100, syncInterval=1.0):
+        self.directory = directory
+        self.segmentSize = segmentSize
+        self.maxBytes = maxBytes
+        self.syncCount = syncCount
+        self.syncInterval = syncInterval
+        self.spoolLock = threading.RLock()
+        self.segments = []
+        self.writeFile = None
+        self.writeSegment = None
+        self.cursor = None
+        self.pending = 0
+        self.unsynced = 0
+        self.lastSync = time.time()
+        self.droppedCount = 0
+        self.corruptCount = 0
+
+    '''The connect method opens the spool directory, creating it if necessary. It loads the persisted cursor, discards
+       any partially written entry left at the end of the newest segment by a power cut, and counts the entries still
+       waiting to be replayed.'''
+    def connect(self):
+        self.spoolLock.acquire()
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.segments = sorted([int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                                    if name.endswith(SEGMENT_SUFFIX)])
+            if not self.segments:
+                self.segments = [1]
+            self.writeSegment = self.segments[-1]
+            self.repairSegment(self.writeSegment)
+            self.writeFile = open(self.segmentPath(self.writeSegment), "ab")
+
+            self.cursor = self.loadCursor()
+            if self.cursor[0] < self.segments[0]:
+                self.cursor = (self.segments[0], 0)
+            self.pending = self.countFrom(self.cursor)
+        finally:
+            self.spoolLock.release()
+
+    '''The append method adds one data entry to the end of the spool. The entry must be serializable as JSON.'''
+    def append(self, value):
+        line = json.dumps(value, separators=(",", ":")) + "\n"
+        self.spoolLock.acquire()
+        try:
+            self.writeFile.write(line)
+            self.pending += 1
+            self.unsynced += 1
+            if (self.unsynced >= self.syncCount) or (time.time() - self.lastSync >= self.syncInterval):
+                self.sync()
+            if (self.writeFile.tell() >= self.segmentSize):
+                self.rotate()
+        finally:
+            self.spoolLock.release()
+
+    '''The readBatch method returns up to maxCount of the oldest entries which have not been replayed yet, as a list of
+       (position, value) pairs. Passing the position of an entry to commit marks that entry, and every entry before it,
+       as replayed. The entries are not removed from the spool by readBatch itself. Reading starts at the cursor, or at
+       the position "start" of an entry read before, to read on past it without committing.'''
+    def readBatch(self, maxCount, start=None):
+        entries = []
+        self.spoolLock.acquire()
+        try:
+            #Entries still sitting in the write buffer must reach the file before they can be read back.
+            self.writeFile.flush()
+            (segment, offset) = max(start or self.cursor, self.cursor)
+            while (len(entries) < maxCount) and (segment <= self.writeSegment):
+                if segment in self.segments:
+                    readFile = open(self.segmentPath(segment), "rb")
+                    readFile.seek(offset)
+                    while (len(entries) < maxCount):
+                        line = readFile.readline()
+                        if not line.endswith("\n"):
+                            break
+                        offset += len(line)
+                        try:
+                            entries.append(((segment, offset), json.loads(line)))
+                        except ValueError, e:
+                            #A damaged entry cannot be replayed. It is skipped once its position is committed.
+                            self.corruptCount += 1
+                    readFile.close()
+                    if (len(entries) >= maxCount):
+                        break
+                if (segment == self.writeSegment):
+                    break
+                (segment, offset) = (segment + 1, 0)
+        finally:
+            self.spoolLock.release()
+        return entries
+
+    '''The commit method moves the read cursor to "position", as returned by readBatch, and persists it. Segments which
+       have been replayed completely are deleted.'''
+    def commit(self, position):
+        self.spoolLock.acquire()
+        try:
+            if (position <= self.cursor):
+                return
+            self.pending = max(0, self.pending - self.countBetween(self.cursor, position))
+            self.cursor = position
+            self.saveCursor()
+            while (self.segments[0] < self.cursor[0]):
+                self.deleteSegment(self.segments[0])
+        finally:
+            self.spoolLock.release()
+
+    '''The pendingCount method returns the number of entries in the spool which have not been replayed yet.'''
+    def pendingCount(self):
+        return self.pending
+
+    '''The sync method forces all appended entries to be written to the SD card.'''
+    def sync(self):
+        self.spoolLock.acquire()
+        try:
+            self.writeFile.flush()
+            os.fsync(self.writeFile.fileno())
+            self.unsynced = 0
+            self.lastSync = time.time()
+        finally:
+            self.spoolLock.release()
+
+    '''The getStats method returns a dictionary describing the spool: the number of segments, the bytes on disk, the
+       entries waiting to be replayed, and the entries lost to the disk budget or to damage.'''
+    def getStats(self):
+        self.spoolLock.acquire()
+        try:
+            return {"segments": len(self.segments), "bytes": self.totalBytes(), "pending": self.pending,
+                    "dropped": self.droppedCount, "corrupt": self.corruptCount}
+        finally:
+            self.spoolLock.release()
+
+    '''The close method forces all appended entries to disk and closes the current segment file.'''
+    def close(self):
+        self.spoolLock.acquire()
+        try:
+            self.sync()
+            self.writeFile.close()
+        finally:
+            self.spoolLock.release()
+
+    '''The rotate method closes the current segment file and starts a new one. If the disk budget is now exceeded, the
+       oldest segments are deleted until it is met again.'''
+    def rotate(self):
+        self.sync()
+        self.writeFile.close()
+        self.writeSegment += 1
+        self.segments.append(self.writeSegment)
+        self.writeFile = open(self.segmentPath(self.writeSegment), "ab")
+        while (self.maxBytes is not None) and (len(self.segments) > 1) and (self.totalBytes() > self.maxBytes):
+            self.dropOldest()
+
+    '''The dropOldest method deletes the oldest segment, starting a new segment first if it is the only one, and moves
+       the cursor past it. It returns the pair (segment number, number of entries discarded which had not been replayed
+       yet).'''
+    def dropOldest(self):
+        self.spoolLock.acquire()
+        try:
+            if (len(self.segments) == 1):
+                self.rotate()
+            oldest = self.segments[0]
+            lost = 0
+            if (self.cursor[0] <= oldest):
+                lost = self.countBetween(self.cursor, (oldest + 1, 0))
+                self.droppedCount += lost
+                self.pending = max(0, self.pending - lost)
+                print "Spool disk budget exceeded. %d backed up entries discarded." %(lost)
+                self.cursor = (oldest + 1, 0)
+                self.saveCursor()
+            self.deleteSegment(oldest)
+            return (oldest, lost)
+        finally:
+            self.spoolLock.release()
+
+    '''The repairSegment method cuts off a partially written entry at the end of the given segment.'''
+    def repairSegment(self, segment):
+        path = self.segmentPath(segment)
+        if not os.path.exists(path):
+            return
+        segmentFile = open(path, "rb+")
+        data = segmentFile.read()
+        end = data.rfind("\n") + 1
+        if (end < len(data)):
+            segmentFile.truncate(end)
+        segmentFile.close()
+
+    '''The countFrom method returns the number of entries from "position" to the end of the spool.'''
+    def countFrom(self, position):
+        return self.countBetween(position, (self.writeSegment + 1, 0))
+
+    '''The countBetween method returns the number of entries from position "start" up to, but not including, position
+       "end".'''
+    def countBetween(self, start, end):
+        count = 0
+        for segment in self.segments:
+            if (segment < start[0]) or (segment > end[0]):
+                continue
+            segmentFile = open(self.segmentPath(segment), "rb")
+            if (segment == start[0]):
+                segmentFile.seek(start[1])
+            if (segment == end[0]):
+                count += segmentFile.read(max(0, end[1] - segmentFile.tell())).count("\n")
+            else:
+                count += segmentFile.read().count("\n")
+            segmentFile.close()
+        return count
+
+    def deleteSegment(self, segment):
+        self.segments.remove(segment)
+        os.remove(self.segmentPath(segment))
+
+    def totalBytes(self):
+        self.writeFile.flush()
+        return sum([os.path.getsize(self.segmentPath(segment)) for segment in self.segments])
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, "%08d%s" %(segment, SEGMENT_SUFFIX))
+
+    '''The loadCursor method reads the persisted cursor. Without a cursor file, replay starts at the oldest segment.'''
+    def loadCursor(self):
+        try:
+            cursorFile = open(os.path.join(self.directory, CURSOR_NAME), "r")
+            fields = cursorFile.read().strip().split(",")
+            cursorFile.close()
+            return (int(fields[0]), int(fields[1]))
+        except (IOError, ValueError, IndexError), e:
+            return (self.segments[0], 0)
+
+    '''The saveCursor method persists the cursor by writing it to a temporary file and renaming that over the cursor
+       file, so a power cut leaves either the old or the new cursor in place.'''
+    def saveCursor(self):
+        path = os.path.join(self.directory, CURSOR_NAME)
+        cursorFile = open(path + ".tmp", "w")
+        cursorFile.write("%d,%d\n" %(self.cursor[0], self.cursor[1]))
+        cursorFile.flush()
+        os.fsync(cursorFile.fileno())
+        cursorFile.close()
+        os.rename(path + ".tmp", path)
@@ -0,0 +1,486 @@
+'''This Python script, tieredBacklog.py, holds the usage and error data which failed to upload, until connection to the
+   database server is restored. Short interruptions are absorbed by a bounded tier in memory, which holds no more than a
+   few seconds of data. Once it fills up or grows that old, its entries spill to disk, compressed with zlib in blocks,
+   into one spool per priority class. When the disk budget
+   is also reached, the backlog gives up the least important data first: per-minute and per-second data is thinned out
+   as the budget runs low and evicted before any month, day or hour rollup or error message is.'''
+import os
+import time
+import json
+import zlib
+import base64
+import threading
+import spoolClient
+
+'''The priority classes of the disk tier, from the most to the least important. Entries are backed up as [dbStr, ...],
+   and every entry whose dbStr is in LOW_PRIORITY belongs to the "low" class. The "legacy" class is the spool written
+   by earlier versions of the main client, directly in the backlog directory, which is only ever replayed.'''
+PRIORITY_CLASSES = ["high", "low", "legacy"]
+LOW_PRIORITY = ["min", "sec"]
+#The order in which the disk tier is replayed, and the order in which it is evicted.
+REPLAY_ORDER = ["legacy", "high", "low"]
+EVICTION_ORDER = ["low", "legacy", "high"]
+
+
+'''The function priorityOf returns the priority class of the backed up entry "entry".'''
+def priorityOf(entry):
+    if entry[0] in LOW_PRIORITY:
+        return "low"
+    return "high"
+
+
+'''The function meterOf returns the water meter ID of the backed up entry "entry", which is either [dbStr, post],
+   [dbStr, post, backlogCompactor.UNSENT] or, as backed up by older versions of the main client, [dbStr, wmid,
+   counter, ...].'''
+def meterOf(entry):
+    if (len(entry) <= 3):
+        return entry[1].get("wmid")
+    return entry[1]
+
+
+#The errors raised by unpackBlock for a block whose compressed payload is damaged, for instance on the SD card.
+BLOCK_ERRORS = (zlib.error, TypeError, ValueError)
+
+
+'''The function packBlock compresses the list of entries "entries" into one block, as stored on a line of a spool. A
+   block written by a compaction records the position "replaces" of the last block it replaces.'''
+def packBlock(entries, replaces=None):
+    data = zlib.compress(json.dumps(entries, separators=(",", ":")), 6)
+    block = {"n": len(entries), "z": base64.b64encode(data)}
+    if replaces is not None:
+        block["r"] = list(replaces)
+    return block
+
+
+'''The function unpackBlock returns the list of entries held by a value read from a spool: the entries of a block, or
+   the value itself if it was written by an earlier version of the main client without compression. A block whose
+   payload is damaged raises one of BLOCK_ERRORS.'''
+def unpackBlock(value):
+    if isinstance(value, dict) and ("z" in value):
+        return json.loads(zlib.decompress(base64.b64decode(value["z"])))
+    return [value]
+
+
+'''The function blockSize returns the number of entries held by a value read from a spool.'''
+def blockSize(value):
+    if isinstance(value, dict) and ("z" in value):
+        return value["n"]
+    return 1
+
+
+
+'''The tieredBacklog class holds backed up entries in a memory tier and a disk tier. It offers the same methods as the
+   spoolClient (append, readBatch, commit, pendingCount, getStats), so the main client replays it in the same way: the
+   disk tier first, class by class in REPLAY_ORDER, and then the memory tier.'''
+class tieredBacklog(object):
+
+    '''The tieredBacklog properties are as follows:
+       directory is the folder holding one spool subfolder per priority class.
+       memoryLimit is the number of entries held in memory before the oldest of them spill to disk, spillCount entries
+       at a time, in compressed blocks of up to spillCount entries.
+       memoryAge is the greatest number of seconds an entry is held in memory before the whole memory tier is spilled
+       to disk and forced to the SD card, so that a power cut loses no more than that much backed up data.
+       maxBytes is the disk budget shared by the spools of every class, in bytes.
+       downsampleAt is the share of the disk budget in use from which the low priority entries spilling to disk are
+       thinned out, keeping one entry in downsampleFactor per water meter.
+       segmentSize is the size in bytes after which a spool starts a new segment, the smallest unit of eviction.
+       compactor is the backlogCompactor which merges the per-minute entries of both tiers once the backlog is due to be
+       compacted, or None to replay every backed up entry as it is.'''
+    def __init__(self, directory="spool", memoryLimit=2000, spillCount=500, maxBytes=268435456, downsampleAt=0.8,
+                 downsampleFactor=5, segmentSize=1048576, compactor=None, memoryAge=5.0):
+        self.directory = directory
+        self.memoryLimit = memoryLimit
+        self.spillCount = spillCount
+        self.memoryAge = memoryAge
+        self.maxBytes = maxBytes
+        self.downsampleAt = downsampleAt
+        self.downsampleFactor = downsampleFactor
+        self.compactor = compactor
+        self.backlogLock = threading.RLock()
+        self.spools = {}
+        for name in PRIORITY_CLASSES:
+            if (name == "legacy"):
+                path = directory
+            else:
+                path = os.path.join(directory, name)
+            self.spools[name] = spoolClient.spoolClient(path, segmentSize=segmentSize, maxBytes=None)
+        #memory is the list of (sequence number, entry) pairs of the memory tier, oldest first.
+        self.memory = []
+        #memoryStart is the time at which the oldest entry of the memory tier still to be spilled was appended.
+        self.memoryStart = None
+        self.sequence = 0
+        #readSequence is the sequence number of the newest memory entry handed out by readBatch and not yet committed.
+        self.readSequence = 0
+        '''segmentCounts maps (class, segment number) to the number of entries waiting in that segment, and
+           diskPending maps each class to its total, as a block of the disk tier holds many entries.'''
+        self.segmentCounts = {}
+        self.diskPending = dict([(name, 0) for name in PRIORITY_CLASSES])
+        #The actions of the last readBatch, applied by commit: marks[i] is done once entry i is committed.
+        self.readSerial = 0
+        self.marks = []
+        self.committed = 0
+        #compacting is True while the disk tier is being compacted, which holds back the replay.
+        self.compacting = False
+        self.closed = False
+        self.thinning = {}
+        self.stats = {"spilled": 0, "memoryPeak": 0, "evicted": dict([(name, 0) for name in PRIORITY_CLASSES]),
+                      "downsampled": 0, "corrupt": dict([(name, 0) for name in PRIORITY_CLASSES])}
+
+    '''The connect method opens the spool of every class, and counts the entries waiting in each of their segments. The
+       low priority entries on disk count towards the thresholds of the compactor, as they may not have been compacted
+       before the restart. If the power was cut after a compaction wrote its blocks but before it committed the blocks
+       they replace, those blocks are committed now, so that their entries are not replayed a second time.'''
+    def connect(self):
+        self.backlogLock.acquire()
+        try:
+            for name in PRIORITY_CLASSES:
+                spool = self.spools[name]
+                spool.connect()
+                start = None
+                blocks = []
+                replaced = None
+                while 1:
+                    values = spool.readBatch(1000, start)
+                    if not values:
+                        break
+                    for (position, value) in values:
+                        blocks.append((position, blockSize(value)))
+                        if isinstance(value, dict) and ("r" in value):
+                            replaced = max(replaced, tuple(value["r"]))
+                    start = values[-1][0]
+                if (replaced is not None) and (replaced > spool.cursor):
+                    print "Completing an interrupted compaction of the %s priority spool." %(name)
+                    spool.commit(replaced)
+                for ((segment, offset), count) in blocks:
+                    if ((segment, offset) > spool.cursor):
+                        self.countBlock(name, segment, count)
+            if self.compactor:
+                self.compactor.uncompacted += self.diskPending["low"]
+        finally:
+            self.backlogLock.release()
+
+    '''The append method adds one backed up entry to the memory tier, spilling the oldest entries to disk if it is
+       full, and the whole memory tier if its oldest entry is memoryAge seconds old. The entry must be serializable as
+       JSON.'''
+    def append(self, entry):
+        self.backlogLock.acquire()
+        try:
+            self.sequence += 1
+            self.memory.append((self.sequence, entry))
+            if self.memoryStart is None:
+                self.memoryStart = time.time()
+            if self.compactor:
+                self.compactor.track(entry)
+            self.stats["memoryPeak"] = max(self.stats["memoryPeak"], len(self.memory))
+            if (len(self.memory) >= self.memoryLimit):
+                self.spill()
+            self.flushExpired()
+        finally:
+            self.backlogLock.release()
+
+    '''The flushExpired method spills the whole memory tier to disk if its oldest entry still to be spilled is
+       memoryAge seconds old. It is called by append, and periodically by the main client, so that entries backed up
+       just before the backups stop are not held in memory for longer.'''
+    def flushExpired(self):
+        self.backlogLock.acquire()
+        try:
+            if (self.memoryStart is not None) and (time.time() - self.memoryStart >= self.memoryAge):
+                self.flush()
+        finally:
+            self.backlogLock.release()
+
+    '''The flush method spills every entry of the memory tier which is not being replayed to disk, and forces the
+       disk tier to the SD card. The entries being replayed are removed once they are committed.'''
+    def flush(self):
+        self.backlogLock.acquire()
+        try:
+            while (self.replaying() < len(self.memory)):
+                self.spill()
+            self.memoryStart = None
+            self.sync()
+        finally:
+            self.backlogLock.release()
+
+    '''The replaying method returns the number of the oldest entries of the memory tier which have been handed out by
+       readBatch and not yet committed. The caller must hold backlogLock.'''
+    def replaying(self):
+        start = 0
+        while (start < len(self.memory)) and (self.memory[start][0] <= self.readSequence):
+            start += 1
+        return start
+
+    '''The spill method moves the oldest spillCount entries of the memory tier which are not being replayed to the
+       disk tier, compressed into one block per priority class, and then enforces the disk budget.'''
+    def spill(self):
+        start = self.replaying()
+        spilled = self.memory[start:start + self.spillCount]
+        del self.memory[start:start + self.spillCount]
+        groups = {}
+        for (sequence, entry) in spilled:
+            groups.setdefault(priorityOf(entry), []).append(entry)
+        if ("low" in groups) and (self.diskBytes() >= self.downsampleAt * self.maxBytes):
+            groups["low"] = self.downsample(groups["low"])
+        for name in PRIORITY_CLASSES:
+            if groups.get(name):
+                spool = self.spools[name]
+                segment = spool.writeSegment
+                spool.append(packBlock(groups[name]))
+                self.countBlock(name, segment, len(groups[name]))
+        self.stats["spilled"] += len(spilled)
+        self.enforceBudget()
+
+    '''The downsample method thins out the low priority entries "entries", keeping one in downsampleFactor for each
+       water meter.'''
+    def downsample(self, entries):
+        kept = []
+        for entry in entries:
+            wmid = meterOf(entry)
+            count = self.thinning.get(wmid, 0)
+            self.thinning[wmid] = count + 1
+            if (count % self.downsampleFactor == 0):
+                kept.append(entry)
+        self.stats["downsampled"] += len(entries) - len(kept)
+        return kept
+
+    '''The enforceBudget method evicts the oldest segments of the disk tier, class by class in EVICTION_ORDER, until
+       the disk budget is met. A class is only evicted from once every less important class is empty.'''
+    def enforceBudget(self):
+        while (self.diskBytes() > self.maxBytes):
+            for name in EVICTION_ORDER:
+                spool = self.spools[name]
+                if (spool.totalBytes() > 0):
+                    break
+            else:
+                return
+            #The spool counts the blocks it discarded, while segmentCounts holds the entries in them.
+            segment = spool.dropOldest()[0]
+            lost = self.segmentCounts.pop((name, segment), 0)
+            self.diskPending[name] -= lost
+            self.stats["evicted"][name] += lost
+            print "Backlog disk budget exceeded. %d backed up %s priority entries evicted." %(lost, name)
+
+    '''The compactDue method returns whether the backlog is due to be compacted at the Epoch time timeNow, in
+       milliseconds.'''
+    def compactDue(self, timeNow):
+        return (self.compactor is not None) and self.compactor.due(timeNow)
+
+    '''The compact method merges the per-minute entries of the memory tier and of the low priority class of the disk
+       tier with the compactor, if the backlog is due to be compacted at the Epoch time timeNow, in milliseconds, and
+       returns the number of entries merged away. Nothing is done while a batch returned by readBatch is still being
+       replayed, and the replay is held back until the compaction is done. The memory tier is small, and is compacted
+       with backlogLock held. The disk tier is read and compacted without it, so that entries can still be backed up
+       meanwhile.'''
+    def compact(self, timeNow):
+        self.backlogLock.acquire()
+        try:
+            if self.compacting or not self.compactDue(timeNow) or (self.committed < len(self.marks)):
+                return 0
+            self.compacting = True
+            before = len(self.memory)
+            self.memory = self.compactor.compact(self.memory)
+            merged = before - len(self.memory)
+        finally:
+            self.backlogLock.release()
+        try:
+            (written, diskMerged) = self.compactDisk("low")
+        finally:
+            self.backlogLock.acquire()
+            self.compacting = False
+            self.backlogLock.release()
+        self.backlogLock.acquire()
+        try:
+            self.compactor.compacted(written)
+            merged += diskMerged
+            print "Backlog compacted. %d per-minute entries merged away, %d entries left." \
+                  %(merged, self.pendingCount())
+            return merged
+        finally:
+            self.backlogLock.release()
+
+    '''The compactDisk method compacts the class "name" of the disk tier, and returns the pair (number of entries it
+       holds afterwards, number of entries merged away). Its blocks are read and compacted a few at a time, so that only
+       the merged entries are held in memory at once, and without backlogLock, as appending never changes the blocks
+       already written. Only the blocks spilled meanwhile are read with backlogLock held, before the compacted entries
+       are appended as new blocks and forced to disk, and the old blocks are committed, so the compacted entries keep
+       their place after every older entry and a power cut can never lose backed up data. Every new block records the
+       position of the last old block, so that connect commits the old blocks if the power is cut before they are, and
+       their entries are never replayed along with the compacted ones. If the oldest blocks have been evicted
+       meanwhile, the compaction is given up, as it read entries which no longer exist.'''
+    def compactDisk(self, name):
+        spool = self.spools[name]
+        self.backlogLock.acquire()
+        origin = spool.cursor
+        self.backlogLock.release()
+        (items, blocks, start) = self.compactBlocks(spool, [], [], None)
+        self.backlogLock.acquire()
+        try:
+            (items, blocks, start) = self.compactBlocks(spool, items, blocks, start)
+            entries = [entry for (key, entry) in items]
+            count = sum([count for (position, count, valid) in blocks])
+            if (spool.cursor != origin) or (len(entries) == count):
+                return (self.diskPending[name], 0)
+            for (position, count, valid) in blocks:
+                self.countBlock(name, position[0], -count)
+                if not valid:
+                    self.stats["corrupt"][name] += 1
+            for first in range(0, len(entries), self.spillCount):
+                segment = spool.writeSegment
+                spool.append(packBlock(entries[first:first + self.spillCount], blocks[-1][0]))
+                self.countBlock(name, segment, len(entries[first:first + self.spillCount]))
+            spool.sync()
+            spool.commit(blocks[-1][0])
+            return (len(entries), sum([count for (position, count, valid) in blocks]) - len(entries))
+        finally:
+            self.backlogLock.release()
+
+    '''The compactBlocks method reads the blocks of "spool" after the position "start", or from its cursor, 20 at a
+       time, and merges their entries into the compacted list of (key, entry) pairs "items". It returns the new items,
+       the list of (position, number of entries, whether the block could be read) of every block read, "blocks"
+       included, and the position of the last block read. The entries of a damaged block are left out, and the block
+       is discarded with the others once the compacted entries are written.'''
+    def compactBlocks(self, spool, items, blocks, start):
+        while 1:
+            values = spool.readBatch(20, start)
+            if not values:
+                return (items, blocks, start)
+            for (position, value) in values:
+                try:
+                    items.extend([(None, entry) for entry in unpackBlock(value)])
+                    blocks.append((position, blockSize(value), True))
+                except BLOCK_ERRORS, e:
+                    blocks.append((position, blockSize(value), False))
+            items = self.compactor.compact(items)
+            start = values[-1][0]
+
+    '''The readBatch method returns at least maxCount of the oldest backed up entries, if there are as many, as a list
+       of (position, entry) pairs, in the same way as spoolClient.readBatch. A block of the disk tier is returned whole,
+       so a batch may hold more than maxCount entries. Nothing is returned while the disk tier is being compacted. A
+       block whose payload is damaged cannot be replayed: it is counted as corrupt and committed at once if it is the
+       oldest block of its class, and otherwise ends the batch, so that it is the oldest block of the next one.'''
+    def readBatch(self, maxCount):
+        self.backlogLock.acquire()
+        try:
+            if self.compacting:
+                return []
+            self.readSerial += 1
+            self.marks = []
+            self.committed = 0
+            entries = []
+            for name in REPLAY_ORDER:
+                spool = self.spools[name]
+                start = None
+                while (len(entries) < maxCount):
+                    values = spool.readBatch(1, start)
+                    if not values:
+                        break
+                    ((segment, offset), value) = values[0]
+                    try:
+                        blockEntries = unpackBlock(value)
+                    except BLOCK_ERRORS, e:
+                        if start is not None:
+                            return entries
+                        print "Corrupt backlog block in the %s priority spool. %d entries discarded." \
+                              %(name, blockSize(value))
+                        self.stats["corrupt"][name] += 1
+                        spool.commit((segment, offset))
+                        self.countBlock(name, segment, -blockSize(value))
+                        continue
+                    start = (segment, offset)
+                    for entry in blockEntries:
+                        entries.append(((self.readSerial, len(entries)), entry))
+                        self.marks.append(None)
+                    self.marks[-1] = ("disk", name, start, blockSize(value))
+            self.readSequence = 0
+            for (sequence, entry) in self.memory[:max(maxCount - len(entries), 0)]:
+                entries.append(((self.readSerial, len(entries)), entry))
+                self.marks.append(("memory", sequence))
+                self.readSequence = sequence
+            return entries
+        finally:
+            self.backlogLock.release()
+
+    '''The commit method marks the entry at "position", as returned by the last readBatch, and every entry before it,
+       as replayed, removing them from their tier.'''
+    def commit(self, position):
+        self.backlogLock.acquire()
+        try:
+            (serial, index) = position
+            if (serial != self.readSerial):
+                return
+            for mark in self.marks[self.committed:index + 1]:
+                if mark is None:
+                    continue
+                if (mark[0] == "disk"):
+                    (kind, name, start, count) = mark
+                    self.spools[name].commit(start)
+                    #The entries of a segment evicted since the block was read have been uncounted already.
+                    if (name, start[0]) in self.segmentCounts:
+                        self.countBlock(name, start[0], -count)
+                else:
+                    while self.memory and (self.memory[0][0] <= mark[1]):
+                        del self.memory[0]
+                    if not self.memory:
+                        self.memoryStart = None
+            self.committed = max(self.committed, index + 1)
+            if (self.committed >= len(self.marks)):
+                self.readSequence = 0
+        finally:
+            self.backlogLock.release()
+
+    '''The pendingCount method returns the number of backed up entries in both tiers.'''
+    def pendingCount(self):
+        return len(self.memory) + sum(self.diskPending.values())
+
+    '''The sync method forces the disk tier to be written to the SD card.'''
+    def sync(self):
+        for name in PRIORITY_CLASSES:
+            self.spools[name].sync()
+
+    '''The close method spills the whole memory tier to disk, so it survives the restart, and closes every spool. It
+       may be called more than once, as by both the signal handler and the exit handler of the main client.'''
+    def close(self):
+        self.backlogLock.acquire()
+        try:
+            if self.closed:
+                return
+            self.readSequence = 0
+            while self.memory:
+                self.spill()
+            for name in PRIORITY_CLASSES:
+                self.spools[name].close()
+            self.closed = True
+        finally:
+            self.backlogLock.release()
+
+    '''The getStats method returns the occupancy of each tier (entries, and bytes on disk), the entries spilled from
+       memory, evicted from each class and thinned out by downsampling, along with the totals reported by the
+       spoolClient: pending, dropped and bytes.'''
+    def getStats(self):
+        self.backlogLock.acquire()
+        try:
+            tiers = {"memory": {"entries": len(self.memory), "limit": self.memoryLimit, "maxAge": self.memoryAge,
+                                "peak": self.stats["memoryPeak"], "spilled": self.stats["spilled"]}}
+            for name in PRIORITY_CLASSES:
+                spoolStats = self.spools[name].getStats()
+                tiers[name] = {"entries": self.diskPending[name], "blocks": spoolStats["pending"],
+                               "bytes": spoolStats["bytes"], "segments": spoolStats["segments"],
+                               "evicted": self.stats["evicted"][name],
+                               "corrupt": spoolStats["corrupt"] + self.stats["corrupt"][name]}
+            stats = {"tiers": tiers, "pending": self.pendingCount(), "bytes": self.diskBytes(),
+                     "budget": self.maxBytes, "downsampled": self.stats["downsampled"],
+                     "dropped": sum(self.stats["evicted"].values()) + self.stats["downsampled"]}
+            if self.compactor:
+                stats["compaction"] = self.compactor.getStats()
+            return stats
+        finally:
+            self.backlogLock.release()
+
+    def countBlock(self, name, segment, count):
+        key = (name, segment)
+        self.segmentCounts[key] = self.segmentCounts.get(key, 0) + count
+        if (self.segmentCounts[key] <= 0):
+            del self.segmentCounts[key]
+        self.diskPending[name] += count
+
+    def diskBytes(self):
+        return sum([self.spools[name].totalBytes() for name in PRIORITY_CLASSES])
@@ -0,0 +1,49 @@
+'''This Python script, timestampDecoder.py, decodes the 14-digit timestamps (YYYYMMDDHHMMSS) sent over by the measurement
+   nodes. The digits are sliced into integers directly, and the Epoch time of the start of each hour is calculated only
+   once and cached, so that consecutive readings within the same hour only need their minutes and seconds added.'''
+import time
+import calendar
+
+#The number of hour prefixes kept in the cache before it is emptied.
+CACHE_SIZE = 64
+
+
+'''The timestampDecoder class converts node timestamps to milliseconds since Epoch time (local time, as time.mktime
+   does), along with the tuple of period integers (year, month, day, hour, minute, second) of the timestamp.'''
+class timestampDecoder(object):
+
+    '''The hourCache property maps the first ten digits (YYYYMMDDHH) of a timestamp to the Epoch time, in seconds, of
+       the start of that hour.'''
+    def __init__(self):
+        self.hourCache = {}
+
+    '''The decode method takes the timestamp string tstring and returns a pair: its time in milliseconds since Epoch
+       time, and its tuple of period integers. A ValueError is raised if tstring is not a valid timestamp.'''
+    def decode(self, tstring):
+        if (len(tstring) != 14) or (not tstring.isdigit()):
+            raise ValueError("Invalid timestamp: %s" %(tstring))
+        period = (int(tstring[0:4]), int(tstring[4:6]), int(tstring[6:8]),
+                  int(tstring[8:10]), int(tstring[10:12]), int(tstring[12:14]))
+        if (period[4] > 59) or (period[5] > 61):
+            raise ValueError("Invalid timestamp: %s" %(tstring))
+
+        prefix = tstring[0:10]
+        hourStart = self.hourCache.get(prefix)
+        if hourStart is None:
+            hourStart = self.hourEpoch(period, tstring)
+            if (len(self.hourCache) >= CACHE_SIZE):
+                self.hourCache.clear()
+            self.hourCache[prefix] = hourStart
+        return (long(1000*(hourStart + 60*period[4] + period[5])), period)
+
+    '''The period method returns the tuple of period integers of the timestamp string tstring.'''
+    def period(self, tstring):
+        return self.decode(tstring)[1]
+
+    '''The hourEpoch method validates the year, month, day and hour of "period", and returns the Epoch time, in seconds,
+       of the start of that hour.'''
+    def hourEpoch(self, period, tstring):
+        (year, month, day, hour) = period[0:4]
+        if not ((1 <= month <= 12) and (1 <= day <= calendar.monthrange(year, month)[1]) and (hour <= 23)):
+            raise ValueError("Invalid timestamp: %s" %(tstring))
+        return time.mktime((year, month, day, hour, 0, 0, 0, 0, -1))
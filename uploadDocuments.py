@@ -0,0 +1,52 @@
+'''This Python script, uploadDocuments.py, holds what the database clients need to know about the documents they
+   upload, without depending on PyMongo: the deterministic _ids of the usage and error data entries, and the per-entry
+   results of a bulk upload. Both pymongoClient.py and the in-memory fakeDatabase.py use it, so the latter runs where
+   PyMongo is not installed.'''
+
+
+
+'''The function usageID returns the _id of the usage data entry "post" in the usage collection belonging to dbStr,
+   derived from its water meter ID, the granularity of the collection and its timestamp. An upload which is retried,
+   or replayed from the spool, writes the same _id again, so it can never be stored twice. An entry merged from several
+   backed up entries by backlogCompactor.py is identified by the timestamps of its first and last reading instead. Only
+   entries which never reached the server are merged, so none of them can have been stored under its own _id.'''
+def usageID(dbStr, post):
+    if (post.get("merged", 1) > 1):
+        return "usage:%s:%s:%s-%s" %(post["wmid"], dbStr, post["firstTimestamp"], post["timestamp"])
+    return "usage:%s:%s:%s" %(post["wmid"], dbStr, post["timestamp"])
+
+
+
+'''The function errorID returns the _id of the error data entry "post", derived from its water meter ID, error number,
+   current timestamp and error message.'''
+def errorID(post):
+    return "error:%s:%s:%s:%s" %(post["wmid"], post["errorNo"], post["curr_ts"], post["errorMsg"])
+
+
+
+'''The unsentResults class is the list of per-entry results of a bulk upload refused by the open circuit breaker. Its
+   results are all zero, as after a connection failure, but unlike after a connection failure, the entries are known
+   never to have reached the server.'''
+class unsentResults(list):
+    pass
+
+
+
+'''The function resultsOf returns the per-entry results "results" of a bulk upload of "count" entries, or zero for
+   every entry if the upload raised an exception, which a database scheduler reports as None. The entries are then
+   backed up, as after a connection failure.'''
+def resultsOf(results, count):
+    if results is None:
+        return [0] * count
+    return results
+
+
+
+'''The function withID returns the entry "post" with the _id documentID. The entry is copied rather than changed, as
+   the same entry may be uploaded to several collections.'''
+def withID(post, documentID):
+    if (post.get("_id") == documentID):
+        return post
+    post = dict(post)
+    post["_id"] = documentID
+    return post
@@ -0,0 +1,205 @@
+'''This Python script, uploadPipeline.py, decouples the reading of serial messages sent over by the water usage monitor
+   node from the processing and uploading of those messages to the database server. The port reader threads of
+   serialPorts.py place every message they read in a bounded queue, and a pool of upload worker threads drain the
+   queues, so that a slow database call no longer holds up the serial port.'''
+import threading
+from collections import deque
+import uploadScheduler
+
+#The overflow policies of a boundedQueue, deciding what happens to a message that arrives while the queue is full.
+#"block" makes the reader wait for free space, "drop_newest" discards the arriving message, and "drop_oldest"
+#discards the message that has been waiting the longest.
+OVERFLOW_POLICIES = ["block", "drop_newest", "drop_oldest"]
+
+
+'''The boundedQueue class is a first-in first-out queue holding at most maxSize items. It keeps count of the items put
+   in, taken out and dropped, along with the largest depth it has reached. Given a priority function, it holds one
+   queue per priority class of uploadScheduler.py instead, and takes the items by weighted round robin.'''
+class boundedQueue(object):
+
+    '''The boundedQueue properties are as follows:
+       maxSize is the greatest number of items the queue holds at once.
+       overflowPolicy is one of the OVERFLOW_POLICIES, applied when an item is put into a full queue. With
+       "drop_oldest", a queue with priority classes drops the oldest item of the least urgent class.
+       priorityFunction returns the priority class of an item, or is None for a single first-in first-out queue, and
+       weights maps each priority class to its weight.'''
+    def __init__(self, maxSize=1000, overflowPolicy="block", priorityFunction=None, weights=None):
+        if overflowPolicy not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" %(overflowPolicy))
+        self.maxSize = maxSize
+        self.overflowPolicy = overflowPolicy
+        self.priorityFunction = priorityFunction
+        #taken is the (priority class, time queued) pair of the item last returned by get.
+        self.taken = None
+        if priorityFunction:
+            self.items = uploadScheduler.priorityQueues(weights)
+        else:
+            self.items = deque()
+        self.condition = threading.Condition()
+        self.enqueued = 0
+        self.dequeued = 0
+        self.dropped = 0
+        self.maxDepth = 0
+
+    '''The put method appends item to the queue, applying the overflow policy if the queue is full. It returns True if
+       item has been queued, and False if it has been dropped.'''
+    def put(self, item):
+        self.condition.acquire()
+        try:
+            if (len(self.items) >= self.maxSize):
+                if (self.overflowPolicy == "drop_newest"):
+                    self.dropped += 1
+                    return False
+                elif (self.overflowPolicy == "drop_oldest"):
+                    if self.priorityFunction:
+                        self.items.dropOldest()
+                    else:
+                        self.items.popleft()
+                    self.dropped += 1
+                else:
+                    while (len(self.items) >= self.maxSize):
+                        self.condition.wait()
+            if self.priorityFunction:
+                self.items.put(self.priorityFunction(item), item)
+            else:
+                self.items.append(item)
+            self.enqueued += 1
+            if (len(self.items) > self.maxDepth):
+                self.maxDepth = len(self.items)
+            self.condition.notify_all()
+            return True
+        finally:
+            self.condition.release()
+
+    '''The get method removes and returns the oldest item of the queue, waiting until one is available.'''
+    def get(self):
+        self.condition.acquire()
+        try:
+            while not self.items:
+                self.condition.wait()
+            if self.priorityFunction:
+                (priority, queued, item) = self.items.take()
+                self.taken = (priority, queued)
+            else:
+                item = self.items.popleft()
+            self.dequeued += 1
+            self.condition.notify_all()
+            return item
+        finally:
+            self.condition.release()
+
+    '''The handled method records that the item last returned by get has been dealt with, for the latency statistics
+       of its priority class. The queue must have a single consumer.'''
+    def handled(self):
+        if self.priorityFunction:
+            self.condition.acquire()
+            self.items.done(*self.taken)
+            self.condition.release()
+
+    '''The snapshot method returns a copy of the statistics of the priority classes of the queue, as returned by
+       priorityQueues.snapshot.'''
+    def snapshot(self):
+        self.condition.acquire()
+        try:
+            return self.items.snapshot()
+        finally:
+            self.condition.release()
+
+    '''The depth method returns the number of items currently waiting in the queue.'''
+    def depth(self):
+        return len(self.items)
+
+
+
+'''The uploadWorkerThread class is a thread object which takes messages off its queue one at a time and passes them to
+   the handler function, which processes the message and performs the corresponding uploads.'''
+class uploadWorkerThread(threading.Thread):
+    def __init__(self, queue, handler, pipeline):
+        threading.Thread.__init__(self)
+        self.queue = queue
+        self.handler = handler
+        self.pipeline = pipeline
+
+    def run(self):
+        while 1:
+            message = self.queue.get()
+            try:
+                self.handler(message)
+                self.pipeline.countProcessed()
+            except Exception, e:
+                #A message that cannot be handled is discarded, rather than stopping the worker.
+                print "Message handling failed. Error: %s. Discarded." %(e)
+                self.pipeline.countFailed()
+            self.queue.handled()
+
+
+
+'''The ingestPipeline class connects the serial reader to a pool of upload workers. Each worker owns one bounded queue,
+   and every message is routed to a queue by its key, so that all messages sharing a key (for instance, coming from the
+   same measurement node) are handled in the order they were read.'''
+class ingestPipeline(object):
+
+    '''The ingestPipeline properties are as follows:
+       handler is the function called with each message by the upload workers.
+       workerCount is the number of upload worker threads.
+       queueSize and overflowPolicy are the properties of each worker's boundedQueue.
+       keyFunction returns the routing key of a message. Messages without a key go to the first worker.
+       priorityFunction returns the priority class of a message, so that urgent messages overtake the others waiting in
+       the same queue, and weights maps each priority class to its weight. Messages of the same class sharing a key are
+       still handled in order.'''
+    def __init__(self, handler, workerCount=1, queueSize=1000, overflowPolicy="block", keyFunction=None,
+                 priorityFunction=None, weights=None):
+        self.handler = handler
+        self.workerCount = max(1, workerCount)
+        self.keyFunction = keyFunction
+        self.priorityFunction = priorityFunction
+        self.queues = [boundedQueue(queueSize, overflowPolicy, priorityFunction, weights)
+                       for i in range(self.workerCount)]
+        self.workers = []
+        self.statsLock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+
+    '''The start method launches the upload worker threads.'''
+    def start(self):
+        for queue in self.queues:
+            worker = uploadWorkerThread(queue, self.handler, self)
+            self.workers.append(worker)
+            worker.start()
+
+    '''The put method routes message to the queue of the worker responsible for its key. It returns False if the
+       message has been dropped by the queue's overflow policy.'''
+    def put(self, message):
+        key = None
+        if self.keyFunction:
+            key = self.keyFunction(message)
+        if key is None:
+            return self.queues[0].put(message)
+        return self.queues[hash(key) % self.workerCount].put(message)
+
+    def countProcessed(self):
+        self.statsLock.acquire()
+        self.processed += 1
+        self.statsLock.release()
+
+    def countFailed(self):
+        self.statsLock.acquire()
+        self.failed += 1
+        self.statsLock.release()
+
+    '''The getStats method returns a dictionary describing the current state of the pipeline: the depth of every
+       queue, the overall depth, and the number of messages queued, dropped, processed and failed so far. With priority
+       classes, it also returns the depth, counts and waiting time percentiles of every class across the queues.'''
+    def getStats(self):
+        depths = [queue.depth() for queue in self.queues]
+        stats = {"workers": self.workerCount,
+                 "depths": depths,
+                 "depth": sum(depths),
+                 "maxDepth": max([queue.maxDepth for queue in self.queues]),
+                 "enqueued": sum([queue.enqueued for queue in self.queues]),
+                 "dropped": sum([queue.dropped for queue in self.queues]),
+                 "processed": self.processed,
+                 "failed": self.failed}
+        if self.priorityFunction:
+            stats["classes"] = uploadScheduler.classStats([queue.snapshot() for queue in self.queues])
+        return stats
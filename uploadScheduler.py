@@ -0,0 +1,262 @@
+'''This Python script, uploadScheduler.py, schedules the work of the main client by priority class, so that urgent
+   messages overtake bulk traffic. Every class has a queue of its own, and the classes are served by weighted round
+   robin: a class is served in proportion to its weight while it has work waiting, and an idle class gives its turns to
+   the others. The time each piece of work spends waiting, and until it is done, is tracked per class. The classes are
+   used both by the ingest pipeline, for the frames waiting to be handled, and by the uploadScheduler, for the calls
+   waiting for the database connection.'''
+import time
+import threading
+from collections import deque
+
+'''The priority classes, from the most to the least urgent: replies to control frames (key and time requests), alerts
+   (error messages of the measurement nodes, such as a Security Pin Disconnect or Leakage, and security breach
+   updates), live usage data, heartbeat errors and status updates, and the replay of backed up data.'''
+PRIORITY_CLASSES = ["control", "alert", "usage", "status", "backlog"]
+#The share of turns of each class while it has work waiting. Work of the same weight is served in class order.
+DEFAULT_WEIGHTS = {"control": 16, "alert": 8, "usage": 4, "status": 2, "backlog": 1}
+DEFAULT_PRIORITY = "usage"
+#The number of most recent waiting times and latencies of each class kept for the percentiles of getStats.
+LATENCY_SAMPLES = 1000
+
+
+
+'''The function percentiles returns the 50th, 90th and 99th percentiles and the maximum of "samples", in milliseconds,
+   or an empty dictionary if there are no samples.'''
+def percentiles(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    stats = dict([("p%d" %(point), round(1000 * ordered[min(len(ordered) * point / 100, len(ordered) - 1)], 3))
+                  for point in (50, 90, 99)])
+    stats["max"] = round(1000 * ordered[-1], 3)
+    return stats
+
+
+
+'''The priorityQueues class holds one first-in first-out queue per priority class, and takes the next item by smooth
+   weighted round robin. It does no locking of its own: the caller holds a lock, or only uses it from the event loop.'''
+class priorityQueues(object):
+
+    '''The priorityQueues properties are as follows:
+       weights maps each priority class to its weight, and overrides DEFAULT_WEIGHTS.'''
+    def __init__(self, weights=None):
+        self.weights = dict(DEFAULT_WEIGHTS)
+        self.weights.update(weights or {})
+        for name in self.weights:
+            if name not in PRIORITY_CLASSES:
+                raise ValueError("Unknown priority class: %s" %(name))
+        #queues maps each class to its deque of (time queued, item) pairs, and credit to its round robin credit.
+        self.queues = dict([(name, deque()) for name in PRIORITY_CLASSES])
+        self.credit = dict([(name, 0) for name in PRIORITY_CLASSES])
+        self.stats = dict([(name, {"queued": 0, "taken": 0, "done": 0, "dropped": 0, "maxDepth": 0})
+                           for name in PRIORITY_CLASSES])
+        self.waits = dict([(name, deque(maxlen=LATENCY_SAMPLES)) for name in PRIORITY_CLASSES])
+        self.latencies = dict([(name, deque(maxlen=LATENCY_SAMPLES)) for name in PRIORITY_CLASSES])
+
+    def __len__(self):
+        return sum([len(queue) for queue in self.queues.values()])
+
+    '''The put method appends "item" to the queue of the class "priority".'''
+    def put(self, priority, item):
+        if priority not in self.queues:
+            raise ValueError("Unknown priority class: %s" %(priority))
+        queue = self.queues[priority]
+        queue.append((time.time(), item))
+        self.stats[priority]["queued"] += 1
+        self.stats[priority]["maxDepth"] = max(self.stats[priority]["maxDepth"], len(queue))
+
+    '''The take method removes the next item, by weighted round robin among the classes with items waiting, and returns
+       the (priority, time queued, item) triple, or None if every queue is empty. Each waiting class earns its weight in
+       credit, and the class with the most credit is served and pays back the total weight of the waiting classes.'''
+    def take(self):
+        (best, total) = (None, 0)
+        for name in PRIORITY_CLASSES:
+            if not self.queues[name]:
+                self.credit[name] = 0
+                continue
+            self.credit[name] += self.weights[name]
+            total += self.weights[name]
+            if (best is None) or (self.credit[name] > self.credit[best]):
+                best = name
+        if best is None:
+            return None
+        self.credit[best] -= total
+        (queued, item) = self.queues[best].popleft()
+        self.stats[best]["taken"] += 1
+        self.waits[best].append(time.time() - queued)
+        return (best, queued, item)
+
+    '''The dropOldest method removes and returns the oldest item of the least urgent class with items waiting, so that
+       an overflowing queue sheds its bulk traffic first, or returns None if every queue is empty.'''
+    def dropOldest(self):
+        for name in reversed(PRIORITY_CLASSES):
+            if self.queues[name]:
+                self.stats[name]["dropped"] += 1
+                return self.queues[name].popleft()[1]
+        return None
+
+    '''The depth method returns the number of items waiting in the queue of the class "priority", or in every queue.'''
+    def depth(self, priority=None):
+        if priority is None:
+            return len(self)
+        return len(self.queues[priority])
+
+    '''The done method records that the item of the class "priority", queued at the time "queued" as returned by take,
+       has been dealt with.'''
+    def done(self, priority, queued):
+        self.stats[priority]["done"] += 1
+        self.latencies[priority].append(time.time() - queued)
+
+    '''The snapshot method returns a copy of the statistics of every class, to be summed up by classStats.'''
+    def snapshot(self):
+        return dict([(name, (dict(self.stats[name], weight=self.weights[name], depth=len(self.queues[name])),
+                             list(self.waits[name]), list(self.latencies[name]))) for name in PRIORITY_CLASSES])
+
+    '''The getStats method returns the statistics of every class, as returned by classStats.'''
+    def getStats(self):
+        return classStats([self.snapshot()])
+
+
+
+'''The function classStats sums up the statistics of one or more priorityQueues, as returned by their snapshot method.
+   For each class, it returns its weight, the number of items waiting and the greatest number that have waited at once
+   in one queue, the number of items queued, taken, done and dropped so far, and the percentiles of the time recent
+   items have waited to be taken ("wait") and to be done ("latency"), in milliseconds.'''
+def classStats(snapshots):
+    stats = {}
+    for name in PRIORITY_CLASSES:
+        counts = [snapshot[name][0] for snapshot in snapshots]
+        stats[name] = {"weight": counts[0]["weight"], "maxDepth": max([count["maxDepth"] for count in counts]),
+                       "wait": percentiles(sum([snapshot[name][1] for snapshot in snapshots], [])),
+                       "latency": percentiles(sum([snapshot[name][2] for snapshot in snapshots], []))}
+        for field in ["depth", "queued", "taken", "done", "dropped"]:
+            stats[name][field] = sum([count[field] for count in counts])
+    return stats
+
+
+
+'''The uploadScheduler class performs the database calls of the classic runtime on a pool of scheduler threads, taking
+   them from the queues of their priority class by weighted round robin. A security alert submitted while bulk uploads
+   and the backup replay are waiting is therefore the next call made, rather than the last. Its methods mirror those of
+   the asyncDatabase of the async runtime, with the class given by the keyword argument "priority".'''
+class uploadScheduler(object):
+
+    '''The uploadScheduler properties are as follows:
+       client is the pymongoClient instance whose methods are called.
+       workerCount is the number of scheduler threads, and so of database calls in progress at once.
+       weights maps each priority class to its weight, and overrides DEFAULT_WEIGHTS.
+       queueSize is the greatest number of calls waiting in each class. A thread submitting a call to a full class waits
+       for free space, so that a slow database server holds back the bulk traffic rather than filling the memory. The
+       scheduler threads themselves never wait for free space.'''
+    def __init__(self, client, workerCount=4, weights=None, queueSize=1000):
+        self.client = client
+        self.workerCount = max(1, workerCount)
+        self.queueSize = queueSize
+        self.queues = priorityQueues(weights)
+        self.condition = threading.Condition()
+        self.local = threading.local()
+        self.workers = []
+        self.inFlight = 0
+        self.calls = 0
+
+    '''The start method launches the scheduler threads.'''
+    def start(self):
+        for index in range(self.workerCount):
+            worker = threading.Thread(target=self.work)
+            self.workers.append(worker)
+            worker.start()
+
+    '''The schedule method queues the call function(*args) in the class "priority", without waiting for it. Once the
+       call is done, resultCallback is called with its return value on the scheduler thread.'''
+    def schedule(self, priority, function, args, resultCallback=None):
+        self.condition.acquire()
+        try:
+            if not getattr(self.local, "worker", False):
+                while (self.queues.depth(priority) >= self.queueSize):
+                    self.condition.wait()
+            self.queues.put(priority, (function, args, resultCallback))
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+    '''The submit method queues a call of the client method "methodName" with the tuple of arguments args, in the
+       same way as asyncDatabase.submit.'''
+    def submit(self, methodName, args, resultCallback=None, priority=DEFAULT_PRIORITY):
+        self.schedule(priority, getattr(self.client, methodName), args, resultCallback)
+
+    '''The run method calls function(*args) in its turn in the class given by the keyword argument "priority", waits
+       for it, and returns its return value. A scheduler thread makes the call straight away, as waiting for another
+       turn could hold up every scheduler thread.'''
+    def run(self, function, *args, **options):
+        return self.map(function, [args], **options)[0]
+
+    '''The call method calls the client method "methodName" with the arguments args in the same way as the run method,
+       and returns its return value.'''
+    def call(self, methodName, *args, **options):
+        return self.run(getattr(self.client, methodName), *args, **options)
+
+    '''The map method calls function(*args) for each tuple of arguments in "argsList", all of them queued at once in the
+       class given by the keyword argument "priority", and returns the list of their return values once they are all
+       done. A call which raises an exception returns None.'''
+    def map(self, function, argsList, **options):
+        if getattr(self.local, "worker", False):
+            return [function(*args) for args in argsList]
+        results = [None] * len(argsList)
+        remaining = [len(argsList)]
+        finished = threading.Event()
+        def deliver(index, result):
+            results[index] = result
+            self.condition.acquire()
+            remaining[0] -= 1
+            if (remaining[0] == 0):
+                finished.set()
+            self.condition.release()
+        for (index, args) in enumerate(argsList):
+            self.schedule(options.get("priority", DEFAULT_PRIORITY), function, args,
+                          lambda result, index=index: deliver(index, result))
+        if argsList:
+            finished.wait()
+        return results
+
+    '''The work method is run by every scheduler thread. It takes the next call by weighted round robin, makes it, and
+       passes its return value to its resultCallback. A call which raises an exception is reported, and its
+       resultCallback is called with None.'''
+    def work(self):
+        self.local.worker = True
+        while 1:
+            self.condition.acquire()
+            try:
+                taken = self.queues.take()
+                while taken is None:
+                    self.condition.wait()
+                    taken = self.queues.take()
+                self.inFlight += 1
+                self.calls += 1
+                self.condition.notify_all()
+            finally:
+                self.condition.release()
+            (priority, queued, (function, args, resultCallback)) = taken
+            result = None
+            try:
+                result = function(*args)
+            except Exception, e:
+                print "Database call %s failed. Error: %s." %(getattr(function, "__name__", function), e)
+            self.condition.acquire()
+            self.inFlight -= 1
+            self.queues.done(priority, queued)
+            self.condition.release()
+            if resultCallback:
+                try:
+                    resultCallback(result)
+                except Exception, e:
+                    print "Database call result handling failed. Error: %s." %(e)
+
+    '''The getStats method returns the number of database calls made so far and currently in progress, and the
+       statistics of every priority class, as returned by priorityQueues.getStats.'''
+    def getStats(self):
+        self.condition.acquire()
+        try:
+            return {"calls": self.calls, "inFlight": self.inFlight, "workers": self.workerCount,
+                    "classes": self.queues.getStats()}
+        finally:
+            self.condition.release()